@@ -67,6 +67,22 @@ pbar_leave = False
 # Default settings for caching
 warn_caching = True
 
+# Default setting for staleness checks:
+#   If False, neurons check whether cached temporary attributes (e.g. `.graph`
+#   or `.segments`) are outdated by hashing their core data on each access
+#   If True, neurons track modifications via a generation counter which is
+#   bumped whenever core data is replaced through navis. In-place changes
+#   to e.g. the node table need to be flagged via `neuron.mark_modified()`
+track_mutations = False
+
+# Default settings for parallel processing (`parallel=True`):
+#   Backend is either "processes" or "threads" - the latter only makes sense
+#   for functions that release the GIL (e.g. those using navis-fastcore)
+#   If `persistent_pools` is True, worker pools are kept alive and re-used
+#   by subsequent calls (see `navis.core.pool`)
+parallel_backend = 'processes'
+persistent_pools = True
+
 # Default setting for igraph:
 #   If True, will use iGraph if possible
 #   If False, will ignore iGraph even if present
@@ -15,12 +15,13 @@ import os
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import scipy.spatial as ssp
 import scipy.stats as sst
 
 from functools import partial
 from itertools import product
-from typing import Union, Optional, List
+from typing import Union, Optional, List, Iterator
 from typing_extensions import Literal
 
 from concurrent.futures import ProcessPoolExecutor
@@ -31,10 +32,21 @@ from .. import config, core, utils
 logger = config.get_logger(__name__)
 
 
-__all__ = sorted(['connectivity_similarity',  'synapse_similarity'])
+__all__ = sorted(['connectivity_similarity', 'connectivity_similarity_blocks',
+                  'synapse_similarity'])
 
+# Max number of cells (block rows x neurons) and shared partners we allow per
+# block of rows when using the sparse engine. Each cell costs a few 8-byte
+# arrays, i.e. this keeps the working memory per block in the low GBs.
+SIMILARITY_BLOCK_CELLS = 10_000_000
 
-def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
+# Metrics supported by the sparse engine
+SPARSE_METRICS = ('matching_index', 'matching_index_synapses',
+                  'matching_index_weighted_synapses', 'vertex',
+                  'vertex_normalized', 'cosine')
+
+
+def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray, sp.spmatrix],
                             metric: Union[Literal['matching_index'],
                                           Literal['matching_index_synapses'],
                                           Literal['matching_index_weighted_synapses'],
@@ -44,6 +56,9 @@ def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
                                           ] = 'vertex_normalized',
                             threshold: Optional[int] = None,
                             n_cores: int = max(1, os.cpu_count() // 2),
+                            engine: Union[Literal['auto'],
+                                          Literal['sparse'],
+                                          Literal['pairwise']] = 'auto',
                             **kwargs) -> pd.DataFrame:
     r"""Calculate connectivity similarity.
 
@@ -81,7 +96,7 @@ def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
 
     Parameters
     ----------
-    adjacency :         pandas DataFrame | numpy array
+    adjacency :         pandas DataFrame | numpy array | scipy.sparse matrix
                         (N, M) observation vector with M observations for N
                         neurons - e.g. an adjacency matrix. Will calculate
                         similarity for all rows using the columns as observations.
@@ -92,7 +107,18 @@ def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
                         Connections weaker than this will be set to zero.
     n_cores :           int
                         Number of parallel processes to use. Defaults to half
-                        the available cores.
+                        the available cores. Only relevant for the pairwise
+                        engine.
+    engine :            'auto' | 'sparse' | 'pairwise'
+                        How to calculate the scores:
+                         - "sparse" treats `adjacency` as sparse matrix and
+                           computes the scores in blocks of rows using sparse
+                           matrix products (see
+                           [`navis.connectivity_similarity_blocks`][]); this
+                           is much faster and works for all metrics except
+                           `rank_index` but requires non-negative weights
+                         - "pairwise" compares each pair of rows separately
+                         - "auto" uses "sparse" where possible
     **kwargs
                         Additional keyword arguments to pass to the metric function.
                         See notes above for details.
@@ -116,9 +142,29 @@ def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
     if not isinstance(metric, str) or metric.lower() not in FUNC_MAP:
         raise ValueError(f'"metric" must be either: {", ".join(FUNC_MAP.keys())}')
 
-    score_func = FUNC_MAP[metric.lower()]
+    metric = metric.lower()
+    score_func = FUNC_MAP[metric]
+
+    if engine not in ('auto', 'sparse', 'pairwise'):
+        raise ValueError('`engine` must be "auto", "sparse" or "pairwise", '
+                         f'got "{engine}"')
 
-    if isinstance(adjacency, np.ndarray):
+    if engine == 'auto':
+        if metric in SPARSE_METRICS and not _has_negative(adjacency):
+            engine = 'sparse'
+        else:
+            engine = 'pairwise'
+
+    if engine == 'sparse':
+        blocks = connectivity_similarity_blocks(adjacency,
+                                                metric=metric,
+                                                threshold=threshold,
+                                                **kwargs)
+        return pd.concat(list(blocks), axis=0)
+
+    if sp.issparse(adjacency):
+        adjacency = pd.DataFrame(adjacency.toarray())
+    elif isinstance(adjacency, np.ndarray):
         adjacency = pd.DataFrame(adjacency)
     elif not isinstance(adjacency, pd.DataFrame):
         raise TypeError(f'Expected DataFrame, got "{type(adjacency)}"')
@@ -170,6 +216,245 @@ def connectivity_similarity(adjacency: Union[pd.DataFrame, np.ndarray],
     return matching_scores
 
 
+def connectivity_similarity_blocks(adjacency: Union[pd.DataFrame, np.ndarray, sp.spmatrix],
+                                   metric: Union[Literal['matching_index'],
+                                                 Literal['matching_index_synapses'],
+                                                 Literal['matching_index_weighted_synapses'],
+                                                 Literal['vertex'],
+                                                 Literal['vertex_normalized'],
+                                                 Literal['cosine'],
+                                                 ] = 'vertex_normalized',
+                                   threshold: Optional[int] = None,
+                                   block_size: Optional[int] = None,
+                                   progress: bool = True,
+                                   **kwargs) -> Iterator[pd.DataFrame]:
+    """Calculate connectivity similarity in blocks of rows.
+
+    This produces the same scores as [`navis.connectivity_similarity`][] but
+    computes them via sparse matrix products and yields them in blocks of
+    rows. Use this if the full (N, N) score matrix is too big to hold in
+    memory, e.g. to write it to disk or keep only the top matches per neuron.
+
+    Parameters
+    ----------
+    adjacency :         pandas DataFrame | numpy array | scipy.sparse matrix
+                        (N, M) observation vector with M observations for N
+                        neurons - e.g. an adjacency matrix. Weights must not
+                        be negative.
+    metric :            'cosine' | 'matching_index' | 'matching_index_synapses' | 'matching_index_weighted_synapses' | 'vertex' | 'vertex_normalized'
+                        Metric used to compare connectivity. See
+                        [`navis.connectivity_similarity`][] for details.
+    threshold :         int, optional
+                        Connections weaker than this will be set to zero.
+    block_size :        int, optional
+                        Number of rows per block. If not provided, will pick
+                        the block size such that each block has at most
+                        `SIMILARITY_BLOCK_CELLS` scores and shared partners.
+    progress :          bool
+                        Whether to show a progress bar.
+    **kwargs
+                        Additional keyword arguments for the metric (`C1` and
+                        `C2` for vertex similarity).
+
+    Yields
+    ------
+    DataFrame
+                        (n_rows, N) block of the similarity matrix. Neurons
+                        without any connectivity will show up with `np.nan`
+                        for scores.
+
+    Examples
+    --------
+    >>> import navis
+    >>> import numpy as np
+    >>> import scipy.sparse as sp
+    >>> adj = sp.random(1000, 500, density=0.01, format='csr', random_state=1)
+    >>> adj.data = np.ceil(adj.data * 10)
+    >>> for block in navis.connectivity_similarity_blocks(adj, block_size=200,
+    ...                                                   progress=False):
+    ...     best = block.max(axis=1)
+
+    """
+    if not isinstance(metric, str) or metric.lower() not in SPARSE_METRICS:
+        raise ValueError(f'"metric" must be either: {", ".join(SPARSE_METRICS)}')
+    metric = metric.lower()
+
+    kwargs.pop('validate', None)
+    C1 = kwargs.pop('C1', 0.5)
+    C2 = kwargs.pop('C2', 1)
+    if kwargs:
+        raise TypeError(f'Unexpected keyword arguments: {", ".join(kwargs)}')
+
+    if isinstance(adjacency, pd.DataFrame):
+        labels = adjacency.index.values
+        A = sp.csr_matrix(adjacency.values, dtype=np.float64)
+    elif isinstance(adjacency, np.ndarray) or sp.issparse(adjacency):
+        labels = np.arange(adjacency.shape[0])
+        # Do not manipulate original
+        A = sp.csr_matrix(adjacency, dtype=np.float64, copy=True)
+    else:
+        raise TypeError(f'Expected DataFrame, got "{type(adjacency)}"')
+
+    A.sum_duplicates()
+
+    if A.data.size and A.data.min() < 0:
+        raise ValueError('Sparse engine requires non-negative weights.')
+
+    if threshold:
+        A.data[A.data < threshold] = 0
+    A.eliminate_zeros()
+
+    N = A.shape[0]
+    B = A.copy()
+    B.data[:] = 1
+
+    # Per-row summary stats
+    n_partners = np.diff(A.indptr)
+    n_syn = np.asarray(A.sum(axis=1)).ravel()
+    empty = n_partners == 0
+    if metric == 'cosine':
+        norms = np.sqrt(np.asarray(A.multiply(A).sum(axis=1)).ravel())
+    elif metric.startswith('vertex'):
+        Ah = A.copy()
+        Ah.data = Ah.data - C1 * Ah.data * np.exp(-C2 * Ah.data)
+        n_h = np.asarray(Ah.sum(axis=1)).ravel()
+
+    # For vertex similarity we need the pairs of shared partners
+    if metric.startswith('vertex'):
+        A_csc = A.tocsc()
+        col_counts = np.diff(A_csc.indptr)
+        row_cost = B @ col_counts.astype(np.float64)
+    else:
+        row_cost = np.zeros(N)
+
+    for start, stop in config.tqdm(list(_row_blocks(row_cost + N, block_size)),
+                                   desc='Calc. similarity',
+                                   disable=config.pbar_hide or not progress,
+                                   leave=config.pbar_leave):
+        blk = A[start:stop]
+        blk_B = B[start:stop]
+        rows = slice(start, stop)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric == 'matching_index':
+                shared = (blk_B @ B.T).toarray()
+                total = n_partners[rows, None] + n_partners[None, :] - shared
+                scores = shared / total
+            elif metric == 'matching_index_synapses':
+                # Synapses of row neurons onto partners shared with column
+                # neurons and vice versa
+                shared = (blk @ B.T).toarray() + (blk_B @ A.T).toarray()
+                scores = shared / (n_syn[rows, None] + n_syn[None, :])
+            elif metric == 'matching_index_weighted_synapses':
+                shared_a = (blk @ B.T).toarray() / n_syn[rows, None]
+                shared_b = (blk_B @ A.T).toarray() / n_syn[None, :]
+                scores = shared_a * shared_b
+            elif metric == 'cosine':
+                dot = (blk @ A.T).toarray()
+                scores = dot / (norms[rows, None] * norms[None, :])
+                scores = np.clip(scores, -1, 1)
+            else:
+                scores = _vertex_block(blk, A_csc, col_counts, n_syn, n_h,
+                                       rows, C1=C1, C2=C2,
+                                       normalize=metric == 'vertex_normalized')
+
+        # If either neuron is fully disconnected return NaN
+        scores[empty[rows], :] = np.nan
+        scores[:, empty] = np.nan
+
+        yield pd.DataFrame(scores, index=labels[rows], columns=labels)
+
+
+def _has_negative(adjacency):
+    """Check if adjacency has negative weights."""
+    if sp.issparse(adjacency):
+        data = adjacency.tocoo().data
+    else:
+        data = np.asarray(adjacency)
+    if not data.size:
+        return False
+    try:
+        return data.min() < 0
+    except TypeError:
+        return True
+
+
+def _row_blocks(row_cost, block_size=None):
+    """Split rows into blocks with at most `SIMILARITY_BLOCK_CELLS` cost."""
+    N = len(row_cost)
+    if block_size:
+        for start in range(0, N, block_size):
+            yield start, min(start + block_size, N)
+        return
+
+    cs = np.cumsum(row_cost)
+    start = 0
+    while start < N:
+        offset = cs[start - 1] if start else 0
+        stop = np.searchsorted(cs, offset + SIMILARITY_BLOCK_CELLS, side='right')
+        # Always take at least one row
+        stop = int(max(stop, start + 1))
+        yield start, stop
+        start = stop
+
+
+def _vertex_block(blk, A_csc, col_counts, n_syn, n_h, rows, C1=0.5, C2=1,
+                  normalize=False):
+    """Vertex similarity for a block of rows.
+
+    The contribution of a partner connected to only one of the two neurons
+    is simply `-C1 * x` (or `x - C1 * x * exp(-C2 * x)` for the max score).
+    We start from the scores two neurons would get if they had no partners
+    in common (row sums) and correct for the shared partners, which we
+    enumerate by joining the block's non-zero entries with the columns of
+    the full matrix.
+    """
+    n_rows, N = blk.shape[0], A_csc.shape[0]
+
+    # Enumerate all (row, partner, column) triplets with both weights > 0
+    blk = blk.tocoo()
+    rep = col_counts[blk.col]
+    n_triplets = rep.sum()
+    starts = np.repeat(A_csc.indptr[blk.col] - np.cumsum(rep) + rep, rep)
+    ix = starts + np.arange(n_triplets)
+
+    x = np.repeat(blk.data, rep)
+    y = A_csc.data[ix]
+    flat = np.repeat(blk.row, rep) * N + A_csc.indices[ix]
+
+    def h(v):
+        return v - C1 * v * np.exp(-C2 * v)
+
+    this_min = np.minimum(x, y)
+    this_max = np.maximum(x, y)
+
+    # f(x, y) = min(x,y) - C1 * max(x,y) * e^(-C2 * min(x,y)) for shared
+    # partners minus the -C1 * (x + y) we assume for the non-shared case
+    corr = this_min - C1 * this_max * np.exp(-C2 * this_min) + C1 * (x + y)
+
+    def accumulate(weights):
+        return np.bincount(flat, weights=weights,
+                           minlength=n_rows * N).reshape(n_rows, N)
+
+    syn = n_syn[rows, None] + n_syn[None, :]
+    vs = -C1 * syn + accumulate(corr)
+
+    if not normalize:
+        return vs
+
+    # Max possible score is when both synapse counts are the same
+    max_score = (n_h[rows, None] + n_h[None, :]
+                 + accumulate(h(this_max) - h(x) - h(y)))
+
+    # Smallest possible score is when either synapse count is 0:
+    # -C1 * sum(max(x,y)) and sum(max(x, y)) = sum(x + y) - sum(min(x, y))
+    min_score = -C1 * (syn - accumulate(this_min))
+
+    return np.where(min_score < max_score,
+                    (vs - min_score) / (max_score - min_score),
+                    0)
+
+
 def _distributor(args):
     """Help submitting combinations to actual function.
 
@@ -238,38 +523,6 @@ def _calc_matching_index_synapses(vecA, vecB, weighted=False):
         return vecA[is_both].sum() / vecA.sum() * vecB[is_both].sum() / vecB.sum()
 
 
-def _calc_vertex_similarity2(adj, C1=0.5, C2=1, normalize=False):
-    """Calculate vertex similarity between two vectors."""
-    from tqdm import trange
-    sims = []
-    for i in trange(adj.shape[0]):
-        this = np.repeat(adj[i:i+1], adj.shape[0], axis=0)
-        comb = np.dstack((this, adj))
-        this_max = comb.max(axis=2)
-        this_min = comb.min(axis=2)
-
-        # Implement: f(x,y) = min(x,y) - C1 * max(x,y) * e^(-C2 * min(x,y))
-        v_sim = this_min - C1 * this_max * np.exp(- C2 * this_min)
-
-        # Sum over all partners
-        vs = v_sim.sum(axis=1)
-
-        if normalize:
-            # The max possible score is when both synapse counts are the same:
-            # in which case score = max(x,y) - C1 * max(x,y) * e^(-C2 * max(x,y))
-            max_score = (this_max - C1 * this_max * np.exp(- C2 * this_max)).sum(axis=1)
-
-            # The smallest possible score is when either synapse count is 0:
-            # in which case score = -C1 * max(a,b)
-            min_score = (-C1 * this_max).sum(axis=1)
-
-            vs = (vs - min_score) / (max_score - min_score)
-
-        sims.append(vs)
-
-    return np.vstack(sims)
-
-
 def _calc_vertex_similarity(vecA, vecB, C1=0.5, C2=1, normalize=False):
     """Calculate vertex similarity between two vectors."""
     # np.minimum is much faster than np.min(np.vstack(vecA, vecB), axis=1) here
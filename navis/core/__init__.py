@@ -19,6 +19,9 @@ from .dotprop import Dotprops
 from .voxel import VoxelNeuron
 from .neuronlist import NeuronList
 from .core_utils import make_dotprops, to_neuron_space, NeuronProcessor
+from .node_arrays import NodeArrays
+from .packed import PackedNeuronList
+from .lazy import LazyNeuronList
 
 from typing import Union
 
@@ -12,6 +12,7 @@
 #    GNU General Public License for more details.
 
 import copy
+import functools
 import hashlib
 import numbers
 import pint
@@ -167,6 +168,21 @@ class UnitObject:
         return True
 
 
+@functools.lru_cache(maxsize=None)
+def _core_attrs(cls) -> frozenset:
+    """Names of attributes holding the core data of given neuron class.
+
+    Includes the private attributes (e.g. `_nodes` for `nodes`) that
+    properties typically use to store the data.
+    """
+    attrs = set()
+    for prop in cls.CORE_DATA:
+        # e.g. "nodes:node_id,parent_id,x,y,z"
+        prop = prop.split(':')[0]
+        attrs.update({prop, f'_{prop}'})
+    return frozenset(attrs)
+
+
 class BaseNeuron(UnitObject):
     """Base class for all neurons."""
 
@@ -209,6 +225,14 @@ class BaseNeuron(UnitObject):
 
         # Base neurons has no data
         self._current_md5 = None
+        self._clean_generation = 0
+
+    def __setattr__(self, key, value):
+        """Set attribute."""
+        # Replacing core data makes temporary attributes outdated
+        if config.track_mutations and key in _core_attrs(type(self)):
+            self.__dict__['_generation'] = self.__dict__.get('_generation', 0) + 1
+        super().__setattr__(key, value)
 
     def __getattr__(self, key):
         """Get attribute."""
@@ -331,10 +355,13 @@ class BaseNeuron(UnitObject):
             logger.debug(f"Neuron {self.id} at {hex(id(self))} locked.")
             return
 
+        # Temporary attributes are typically cleared because core data has
+        # been modified in place
+        self.mark_modified()
+
         # Must set checksum before recalculating e.g. node types
         # -> otherwise we run into a recursive loop
-        self._current_md5 = self.core_md5
-        self._stale = False
+        self._mark_clean()
 
         for a in [at for at in self.TEMP_ATTR if at not in exclude]:
             try:
@@ -374,11 +401,51 @@ class BaseNeuron(UnitObject):
 
         delattr(self, name)
 
+    def _mark_clean(self) -> None:
+        """Mark temporary attributes as up-to-date with the core data."""
+        # With mutation tracking we don't need the checksum
+        if config.track_mutations:
+            self._current_md5 = None
+        else:
+            self._current_md5 = self.core_md5
+        self._clean_generation = self.generation
+        self._stale = False
+
+    def mark_modified(self) -> None:
+        """Flag core data (e.g. nodes, vertices, points) as modified.
+
+        Only required if `navis.config.track_mutations` is `True` and
+        core data was changed in place (e.g. `n.nodes.loc[0, 'x'] = 0`).
+        Replacing core data (e.g. `n.nodes = new_nodes`) and navis' own
+        functions take care of this automatically.
+
+        Examples
+        --------
+        >>> import navis
+        >>> n = navis.example_neurons(1)
+        >>> gen = n.generation
+        >>> n.nodes.loc[n.nodes.type == 'branch', 'parent_id'] = -1
+        >>> n.generation == gen  # in-place changes are not registered
+        True
+        >>> n.mark_modified()
+        >>> n.generation == gen + 1
+        True
+
+        """
+        self.__dict__['_generation'] = self.generation + 1
+
+    @property
+    def generation(self) -> int:
+        """Counter that goes up whenever core data is modified."""
+        return self.__dict__.get('_generation', 0)
+
     @property
     def core_md5(self) -> str:
         """MD5 checksum of core data.
 
-        Generated from `.CORE_DATA` properties.
+        Generated from `.CORE_DATA` properties. If
+        `navis.config.track_mutations` is `True`, the checksum is only
+        recalculated after the core data has been modified.
 
         Returns
         -------
@@ -386,6 +453,11 @@ class BaseNeuron(UnitObject):
                 MD5 checksum of core data. `None` if no core data.
 
         """
+        if config.track_mutations:
+            cached = self.__dict__.get('_md5_cache', None)
+            if cached and cached[0] == self.generation:
+                return cached[1]
+
         hash = ''
         for prop in self.CORE_DATA:
             cols = None
@@ -395,21 +467,32 @@ class BaseNeuron(UnitObject):
                 prop, cols = prop.split(':')
                 cols = cols.split(',')
 
-            if hasattr(self, prop):
-                data = getattr(self, prop)
-                if isinstance(data, pd.DataFrame):
-                    if cols:
-                        data = data[cols]
-                    data = data.values
-
-                data = np.ascontiguousarray(data)
-
+            data = self._get_core_data(prop, cols)
+            if data is not None:
                 if xxhash:
                     hash += xxhash.xxh128(data).hexdigest()
                 else:
                     hash += hashlib.md5(data).hexdigest()
 
-        return hash if hash else None
+        hash = hash if hash else None
+
+        if config.track_mutations:
+            self.__dict__['_md5_cache'] = (self.generation, hash)
+
+        return hash
+
+    def _get_core_data(self, prop, cols=None):
+        """Get core data as contiguous array (used for hashing)."""
+        if not hasattr(self, prop):
+            return None
+
+        data = getattr(self, prop)
+        if isinstance(data, pd.DataFrame):
+            if cols:
+                data = data[cols]
+            data = data.values
+
+        return np.ascontiguousarray(data)
 
     @property
     def datatables(self) -> List[str]:
@@ -550,6 +633,10 @@ class BaseNeuron(UnitObject):
     @property
     def is_stale(self) -> bool:
         """Test if temporary attributes might be outdated."""
+        # With mutation tracking, we only need to compare generations
+        if config.track_mutations:
+            return self.generation != getattr(self, '_clean_generation', None)
+
         # If we know we are stale, just return True
         if getattr(self, '_stale', False):
             return True
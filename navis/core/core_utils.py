@@ -20,27 +20,23 @@ import pandas as pd
 import numpy as np
 import trimesh as tm
 
+from concurrent.futures import ThreadPoolExecutor
 from scipy.spatial import cKDTree
 from typing import Union, Sequence, Optional, Callable
 from typing_extensions import Literal
 
 from .. import config, graph, utils, core
-
-
-try:
-    #from pathos.multiprocessing import ProcessingPool
-    # pathos' ProcessingPool apparently ignores chunksize
-    # (see https://stackoverflow.com/questions/55611806/how-to-set-chunk-size-when-using-pathos-processingpools-map)
-    import pathos
-    ProcessingPool = pathos.pools._ProcessPool
-except ImportError:
-    ProcessingPool = None
+from . import pool as pools
 
 __all__ = ['make_dotprops', 'to_neuron_space']
 
 # Set up logging
 logger = config.get_logger(__name__)
 
+# Max number of points per batch when generating dotprops for many neurons at
+# once. Memory usage is about `k * 24` bytes per point (for float64).
+DOTPROPS_BATCH_POINTS = 100_000
+
 
 def temp_property(func):
     """Check if neuron is stale. Clear cached temporary attributes if it is."""
@@ -55,13 +51,75 @@ def temp_property(func):
     return wrapper
 
 
+def _make_dotprops_batched(nl, k, resample, threshold, n_threads=None,
+                           progress=True, omit_failures=False):
+    """Generate dotprops for many neurons at once.
+
+    Points are extracted neuron by neuron, then tangent vectors are
+    calculated in batches of about `DOTPROPS_BATCH_POINTS` points (see
+    `_batch_tangents`). Batches are processed in parallel threads if
+    `n_threads > 1`.
+
+    """
+    if k and k == 1:
+        logger.warning('`k=1` is likely to produce nonsense dotprops')
+
+    dotprops = [None] * len(nl)
+    clouds = []
+    for i, n in enumerate(config.tqdm(nl,
+                                      desc='Dotprops',
+                                      leave=False,
+                                      disable=not progress or len(nl) <= 1)):
+        try:
+            res = _dotprops_points(n, k=k, resample=resample, threshold=threshold)
+        except BaseException:
+            if not omit_failures:
+                raise
+            continue
+
+        if isinstance(res, core.Dotprops):
+            dotprops[i] = res
+        else:
+            clouds.append((i, ) + res)
+
+    # Split into batches of about the same number of points
+    batches, this, n_points = [], [], 0
+    for c in clouds:
+        this.append(c)
+        n_points += len(c[1])
+        if n_points >= DOTPROPS_BATCH_POINTS:
+            batches.append(this)
+            this, n_points = [], 0
+    if this:
+        batches.append(this)
+
+    def run(batch):
+        tangents = _batch_tangents([c[1] for c in batch], [c[2]['k'] for c in batch])
+        return [(i, core.Dotprops(points=x, vect=vect, alpha=alpha, **props))
+                for (i, x, props), (vect, alpha) in zip(batch, tangents)]
+
+    with ThreadPoolExecutor(max_workers=n_threads or 1) as pool:
+        for res in config.tqdm(pool.map(run, batches),
+                               desc='Tangents',
+                               total=len(batches),
+                               leave=False,
+                               disable=not progress or len(batches) <= 1):
+            for i, dp in res:
+                dotprops[i] = dp
+
+    return core.NeuronList([dp for dp in dotprops if dp is not None])
+
+
+@utils.map_neuronlist_batched(_make_dotprops_batched)
 @utils.map_neuronlist(desc='Dotprops', allow_parallel=True)
 def make_dotprops(x: Union[pd.DataFrame, np.ndarray,
                            'core.TreeNeuron', 'core.MeshNeuron',
                            'core.VoxelNeuron', 'core.NeuronList'],
                   k: int = 20,
                   resample: Union[float, int, bool, str] = False,
-                  threshold: float = None) -> Union['core.Dotprops', 'core.NeuronList']:
+                  threshold: float = None,
+                  batched: bool = True,
+                  n_threads: Optional[int] = None) -> Union['core.Dotprops', 'core.NeuronList']:
     """Produce dotprops from neurons or x/y/z points.
 
     This is following the implementation in R's `nat` library.
@@ -98,6 +156,15 @@ def make_dotprops(x: Union[pd.DataFrame, np.ndarray,
     threshold : float, optional
                 Only for `VoxelNeurons`: determines which voxels will be
                 converted to dotprops points.
+    batched :   bool
+                Only relevant if input is a `NeuronList`: if True (default),
+                will run the eigen-decomposition for the tangent vectors on
+                the points of many neurons at once. This is much faster for
+                lots of small neurons. Ignored if `parallel=True`. Note that
+                the orientation (i.e. sign) of tangent vectors may differ
+                from the per-neuron path.
+    n_threads : int, optional
+                Only relevant if `batched=True`: number of threads to use.
 
     Returns
     -------
@@ -124,6 +191,46 @@ def make_dotprops(x: Union[pd.DataFrame, np.ndarray,
     if k and k == 1:
         logger.warning('`k=1` is likely to produce nonsense dotprops')
 
+    x = _dotprops_points(x, k=k, resample=resample, threshold=threshold)
+    if isinstance(x, core.Dotprops):
+        return x
+    x, properties = x
+
+    k = properties['k']
+
+    # Create the KDTree and get the k-nearest neighbors for each point
+    tree = cKDTree(x)
+    dist, ix = tree.query(x, k=k)
+    # This makes sure we have (N, k) shaped array even if k = 1
+    ix = ix.reshape(x.shape[0], k)
+
+    # Get points: array of (N, k, 3)
+    pt = x[ix]
+
+    # Generate centers for each cloud of k nearest neighbors
+    centers = np.mean(pt, axis=1)
+
+    # Generate vector from center
+    cpt = pt - centers.reshape((pt.shape[0], 1, 3))
+
+    # Get inertia (N, 3, 3)
+    inertia = cpt.transpose((0, 2, 1)) @ cpt
+
+    # Extract vector and alpha
+    u, s, vh = np.linalg.svd(inertia)
+    vect = vh[:, 0, :]
+    alpha = (s[:, 0] - s[:, 1]) / np.sum(s, axis=1)
+
+    return core.Dotprops(points=x, alpha=alpha, vect=vect, **properties)
+
+
+def _dotprops_points(x, k, resample, threshold):
+    """Extract (cleaned) points and properties for `make_dotprops`.
+
+    Returns either a `(points, properties)` tuple or, if `k` is `None` and
+    `x` is a `TreeNeuron`, the final `Dotprops`.
+
+    """
     utils.eval_param(resample, name='resample',
                      allowed_types=(numbers.Number, type(None), str))
 
@@ -190,30 +297,55 @@ def make_dotprops(x: Union[pd.DataFrame, np.ndarray,
 
     properties['k'] = k
 
-    # Create the KDTree and get the k-nearest neighbors for each point
-    tree = cKDTree(x)
-    dist, ix = tree.query(x, k=k)
-    # This makes sure we have (N, k) shaped array even if k = 1
-    ix = ix.reshape(x.shape[0], k)
+    return x, properties
 
-    # Get points: array of (N, k, 3)
-    pt = x[ix]
 
-    # Generate centers for each cloud of k nearest neighbors
-    centers = np.mean(pt, axis=1)
+def _batch_tangents(clouds, k):
+    """Calculate tangent vectors and alpha for many point clouds at once.
 
-    # Generate vector from center
-    cpt = pt - centers.reshape((pt.shape[0], 1, 3))
+    Parameters
+    ----------
+    clouds :    list of (N, 3) arrays
+                Point clouds.
+    k :         list of int
+                Number of nearest neighbours for each point cloud.
 
-    # Get inertia (N, 3, 3)
-    inertia = cpt.transpose((0, 2, 1)) @ cpt
+    Returns
+    -------
+    list of (vect, alpha) tuples
 
-    # Extract vector and alpha
-    u, s, vh = np.linalg.svd(inertia)
-    vect = vh[:, 0, :]
-    alpha = (s[:, 0] - s[:, 1]) / np.sum(s, axis=1)
+    """
+    out = [None] * len(clouds)
+    for this_k in np.unique(k):
+        ix_c = [i for i, kk in enumerate(k) if kk == this_k]
+        pts = [clouds[i] for i in ix_c]
+        offsets = np.cumsum([0] + [len(p) for p in pts])
 
-    return core.Dotprops(points=x, alpha=alpha, vect=vect, **properties)
+        # Nearest neighbours have to be found within each cloud but we can
+        # stack the indices to process all points at once
+        ix = np.concatenate([cKDTree(p).query(p, k=this_k)[1].reshape(len(p), this_k) + o
+                             for p, o in zip(pts, offsets)])
+
+        # Get points: array of (N, k, 3)
+        pt = np.concatenate(pts)[ix]
+
+        # Vectors from the centers of each cloud of k nearest neighbours
+        cpt = pt - pt.mean(axis=1, keepdims=True)
+
+        # Get inertia (N, 3, 3)
+        inertia = cpt.transpose((0, 2, 1)) @ cpt
+
+        # Inertia is symmetric: eigh is faster than SVD and returns eigenvalues
+        # in ascending order
+        evals, evecs = np.linalg.eigh(inertia)
+        vect = evecs[:, :, -1]
+        alpha = (evals[:, -1] - evals[:, -2]) / np.sum(evals, axis=1)
+
+        for i, p, a, b in zip(ix_c, pts, offsets[:-1], offsets[1:]):
+            out[i] = (vect[a:b].astype(p.dtype, copy=False),
+                      alpha[a:b].astype(p.dtype, copy=False))
+
+    return out
 
 
 def to_neuron_space(units: Union[int, float, pint.Quantity, pint.Unit],
@@ -311,14 +443,19 @@ class NeuronProcessor:
 
     This assumes that the first argument for the function accepts a single
     neuron.
+
+    With `parallel=True` (or "processes"/"threads") neurons are processed
+    by a worker pool (see `navis.core.pool`). Unless `chunksize` is given,
+    neurons are sent to the workers in chunks of about equal cost as
+    estimated from their size (number of nodes, points, etc).
     """
 
     def __init__(self,
                  nl: 'core.NeuronList',
                  function: Callable,
-                 parallel: bool = False,
+                 parallel: Union[bool, str] = False,
                  n_cores: int = os.cpu_count() // 2,
-                 chunksize: int = 1,
+                 chunksize: Union[int, str] = 'auto',
                  progress: bool = True,
                  warn_inplace: bool = True,
                  omit_failures: bool = False,
@@ -353,6 +490,8 @@ class NeuronProcessor:
         # Explicitly providing these parameters overwrites defaults
         parallel = kwargs.pop('parallel', self.parallel)
         n_cores = kwargs.pop('n_cores', self.n_cores)
+        chunksize = kwargs.pop('chunksize', self.chunksize)
+        backend = pools.resolve_backend(parallel)
 
         # We will check, for each argument, if it matches the number of
         # functions to run. If they it does, we will zip the values
@@ -386,34 +525,37 @@ class NeuronProcessor:
             logger.setLevel('WARNING')
 
         # Apply function
-        if parallel:
-            if not ProcessingPool:
-                raise ImportError('navis relies on pathos for multiprocessing!'
-                                  'Please install pathos and try again:\n'
-                                  '  pip3 install pathos -U')
-
-            if self.warn_inplace and kwargs.get('inplace', False):
+        if backend:
+            if (self.warn_inplace and kwargs.get('inplace', False)
+                    and backend == 'processes'):
                 logger.warning('`inplace=True` does not work with '
                                'multiprocessing ')
 
-            with ProcessingPool(n_cores) as pool:
-                combinations = list(zip(self.funcs,
-                                        parsed_args,
-                                        parsed_kwargs))
-                chunksize = kwargs.pop('chunksize', self.chunksize)  # max(int(len(combinations) / 100), 1)
+            combinations = list(zip(self.funcs,
+                                    parsed_args,
+                                    parsed_kwargs))
 
-                if not self.omit_failures:
-                    wrapper = _call
-                else:
-                    wrapper = _try_call
-
-                res = list(config.tqdm(pool.imap(wrapper,
-                                                 combinations,
-                                                 chunksize=chunksize),
-                                       total=len(combinations),
-                                       desc=self.desc,
-                                       disable=config.pbar_hide or not self.progress,
-                                       leave=config.pbar_leave))
+            if not self.omit_failures:
+                wrapper = _call
+            else:
+                wrapper = _try_call
+
+            # Send neurons to the workers in chunks of about equal cost. This
+            # also means that the function is only pickled once per chunk
+            n_cores = max(1, n_cores)
+            costs = [pools.neuron_cost(n) for n in self.nl]
+            chunks = [(wrapper, [combinations[i] for i in ix])
+                      for ix in pools.make_chunks(costs, n_cores, chunksize)]
+
+            res = []
+            with config.tqdm(total=len(combinations),
+                             desc=self.desc,
+                             disable=config.pbar_hide or not self.progress,
+                             leave=config.pbar_leave) as pbar:
+                with pools.worker_pool(n_cores, backend) as pool:
+                    for r in pool.imap(_call_chunk, chunks):
+                        res += r
+                        pbar.update(len(r))
         else:
             res = []
             for i, n in enumerate(config.tqdm(self.nl, desc=self.desc,
@@ -447,7 +589,7 @@ class NeuronProcessor:
         # If result is a list of neurons, combine them back into a single list
         is_neuron = [isinstance(r, (core.NeuronList, core.BaseNeuron)) for r in res]
         if all(is_neuron):
-            return self.nl.__class__(utils.unpack_neurons(res))
+            return self.nl._constructor(utils.unpack_neurons(res))
         # If results are all None return nothing instead of a list of [None, ..]
         if np.all([r is None for r in res]):
             res = None
@@ -461,6 +603,12 @@ def _call(x: Sequence):
     return func(*args, **kwargs)
 
 
+def _call_chunk(x: Sequence):
+    """Run wrapper (`_call` or `_try_call`) for each item in chunk."""
+    wrapper, combinations = x
+    return [wrapper(c) for c in combinations]
+
+
 def _try_call(x: Sequence):
     """Unpack function and args/kwargs and run it."""
     func, args, kwargs = x
@@ -12,6 +12,7 @@
 #    GNU General Public License for more details.
 
 import copy
+import hashlib
 import numbers
 import pint
 import types
@@ -32,6 +33,9 @@ try:
 except ImportError:
     xxhash = None
 
+import scipy
+from scipy.spatial import cKDTree
+
 try:
     from pykdtree.kdtree import KDTree
 except ImportError:
@@ -42,6 +46,10 @@ __all__ = ['Dotprops']
 # Set up logging
 logger = config.get_logger(__name__)
 
+# Serialized KD-trees use scipy's (private) pickle state which may change
+# between versions: trees are only restored if the tag matches
+KDTREE_FORMAT = f"1/scipy-{'.'.join(scipy.__version__.split('.')[:2])}"
+
 # This is to prevent pint to throw a warning about numpy integration
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
@@ -108,7 +116,7 @@ class Dotprops(BaseNeuron):
     TEMP_ATTR = ['_memory_usage']
 
     #: Core data table(s) used to calculate hash
-    _CORE_DATA = ['points', 'vect']
+    CORE_DATA = ['points', 'vect']
 
     def __init__(self,
                  points: np.ndarray,
@@ -142,6 +150,7 @@ class Dotprops(BaseNeuron):
             # If a number, consider this an offset for coordinates
             n = self.copy() if copy else self
             _ = np.divide(n.points, other, out=n.points, casting='unsafe')
+            n.mark_modified()
             if n.has_connectors:
                 n.connectors.loc[:, ['x', 'y', 'z']] /= other
 
@@ -165,6 +174,7 @@ class Dotprops(BaseNeuron):
             # If a number, consider this an offset for coordinates
             n = self.copy() if copy else self
             _ = np.multiply(n.points, other, out=n.points, casting='unsafe')
+            n.mark_modified()
             if n.has_connectors:
                 n.connectors.loc[:, ['x', 'y', 'z']] *= other
 
@@ -213,6 +223,8 @@ class Dotprops(BaseNeuron):
             if value.ndim != 1:
                 raise ValueError(f'alpha must be (N, ) array, got {value.shape}')
         self._alpha = value
+        # Also reset NBLAST self-hits
+        self.__dict__.pop('_self_hits', None)
 
     @property
     def bbox(self) -> np.ndarray:
@@ -254,8 +266,9 @@ class Dotprops(BaseNeuron):
         if value.ndim != 2 or value.shape[1] != 3:
             raise ValueError(f'points must be (N, 3) array, got {value.shape}')
         self._points = value
-        # Also reset KDtree
+        # Also reset KDtree and NBLAST self-hits
         self._tree = None
+        self.__dict__.pop('_self_hits', None)
 
     @property
     def vect(self):
@@ -627,3 +640,97 @@ class Dotprops(BaseNeuron):
 
     def __len__(self):
         return len(self.points)
+
+
+def _kdtree_to_arrays(x):
+    """Serialize KD-tree for the points of given dotprops.
+
+    Uses the dotprops' tree if it is a `scipy.spatial.cKDTree` and builds a
+    new one otherwise.
+
+    Returns
+    -------
+    dict
+            With the tree's node buffer ("buffer"), the order of the points
+            in the tree ("indices"), the "leafsize", the "format" tag (see
+            `KDTREE_FORMAT`) and a "checksum" over tree and points. `None` if
+            the tree's state does not have the expected layout.
+
+    """
+    tree = getattr(x, '_tree', None)
+    if not isinstance(tree, cKDTree):
+        tree = cKDTree(x.points)
+
+    # Note: this relies on the state used by scipy to pickle trees
+    state = tree.__getstate__()
+    if not isinstance(state, tuple) or len(state) != 10:
+        logger.debug('Unable to serialize KD-tree: unexpected state')
+        return None
+    buffer, _, _, _, leafsize, _, _, indices, _, _ = state
+    buffer = np.frombuffer(buffer, dtype=np.uint8)
+
+    return {'buffer': buffer,
+            'indices': indices,
+            'leafsize': leafsize,
+            'format': KDTREE_FORMAT,
+            'checksum': _kdtree_checksum(x.points, buffer, indices, leafsize)}
+
+
+def _kdtree_checksum(points, buffer, indices, leafsize):
+    """Checksum over the serialized tree and the points it was built for."""
+    h = xxhash.xxh128() if xxhash else hashlib.md5()
+    for a in (np.asarray(points, dtype=np.float64),
+              np.asarray(buffer, dtype=np.uint8),
+              np.asarray(indices, dtype=np.int64),
+              np.array([leafsize], dtype=np.int64)):
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+def _kdtree_from_arrays(points, buffer, indices, leafsize, format=None,
+                        checksum=None):
+    """Restore KD-tree from arrays (see `_kdtree_to_arrays`).
+
+    The tree's node buffer is passed to scipy as is. It is therefore only
+    used if `format` and `checksum` match and the restored tree finds
+    (a sample of) the points. Otherwise a new tree is built instead.
+
+    Returns
+    -------
+    scipy.spatial.cKDTree
+
+    """
+    data = np.ascontiguousarray(points, dtype=np.float64)
+    if format != KDTREE_FORMAT:
+        logger.debug(f'Rebuilding KD-tree written in format "{format}" '
+                     f'(expected "{KDTREE_FORMAT}")')
+        return cKDTree(data)
+
+    try:
+        buffer = np.asarray(buffer, dtype=np.uint8)
+        indices = np.asarray(indices, dtype=np.intp)
+        if checksum != _kdtree_checksum(data, buffer, indices, leafsize):
+            raise ValueError('checksum mismatch')
+        if len(indices) != len(data):
+            raise ValueError(f'{len(indices)} indices for {len(data)} points')
+        tree = cKDTree.__new__(cKDTree)
+        tree.__setstate__((buffer.view('S1'),
+                           data,
+                           data.shape[0],
+                           data.shape[1],
+                           int(leafsize),
+                           data.max(axis=0),
+                           data.min(axis=0),
+                           indices,
+                           None,
+                           None))
+
+        # Each point must be its own nearest neighbour
+        sample = data[np.linspace(0, len(data) - 1, min(len(data), 10)).astype(int)]
+        dist, _ = tree.query(sample)
+        if np.any(dist != 0):
+            raise ValueError('restored tree does not find its points')
+    except Exception as e:
+        logger.debug(f'Unable to restore KD-tree - rebuilding: {e}')
+        return cKDTree(data)
+    return tree
@@ -0,0 +1,370 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""NeuronList which loads its neurons on demand."""
+
+import collections
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from typing import Callable, Iterator, Optional, Sequence
+
+from .. import config, core, utils
+from .neuronlist import NeuronList, MAX_SEARCH
+
+__all__ = ['LazyNeuronList']
+
+# Set up logging
+logger = config.get_logger(__name__)
+
+#: Default number of loaded neurons kept in memory
+DEFAULT_CACHE_SIZE = 100
+
+
+class LazyNeuronList(NeuronList):
+    """NeuronList which loads neurons only when they are accessed.
+
+    Holds only the neurons' IDs and a table of metadata which is used for
+    `.summary()`. Neurons are loaded when accessed by index, via `.idx` or
+    when iterating over the list. Subsets (e.g. `nl[:10]` or
+    `nl.idx[ids]`) are again lazy. The most recently used neurons are kept
+    in a cache of bounded size which is shared between a list and its
+    subsets.
+
+    Anything that requires all neurons (e.g. `.nodes`, plotting or most
+    navis functions) will load all of them. Use `.load()` to get a regular
+    [`navis.NeuronList`][]. Note that changes made to a neuron are lost once
+    it drops out of the cache!
+
+    Typically generated via `read_h5(..., lazy=True)` or
+    `read_parquet(..., lazy=True)`.
+
+    Parameters
+    ----------
+    ids :           list-like
+                    IDs of the neurons.
+    loader :        callable
+                    Function that accepts a list of IDs and returns the
+                    corresponding neurons. Neurons are matched to the
+                    requested IDs via `str(neuron.id)`.
+    metadata :      pandas.DataFrame, optional
+                    Summary with one row per neuron (in the same order as
+                    `ids`). Returned by `.summary()`.
+    cache_size :    int
+                    Max number of loaded neurons to keep in memory.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(3, kind='skeleton')
+    >>> lazy = navis.core.LazyNeuronList(nl.id,
+    ...                                  loader=lambda ids: nl.idx[ids],
+    ...                                  cache_size=2)
+    >>> len(lazy)
+    3
+    >>> lazy[0].n_nodes == nl[0].n_nodes
+    True
+    >>> len(lazy[1:])
+    2
+
+    """
+
+    def __init__(self,
+                 ids: Sequence,
+                 loader: Callable[[list], Sequence['core.BaseNeuron']],
+                 metadata: Optional[pd.DataFrame] = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        ids = np.asarray(ids)
+        if metadata is None:
+            metadata = pd.DataFrame({'id': ids})
+        elif len(metadata) != len(ids):
+            raise ValueError(f'Got {len(metadata)} rows of metadata for '
+                             f'{len(ids)} neurons')
+
+        # Bypass NeuronList.__setattr__ which would load the neurons
+        self.__dict__.update(parallel=False,
+                             n_cores=os.cpu_count() // 2,
+                             copy_on_subset=False,
+                             _ids=ids,
+                             _metadata=metadata.reset_index(drop=True),
+                             _cache=_NeuronCache(loader, cache_size))
+        self.__dict__['idx'] = _LazyIdIndexer(self)
+
+    def __setattr__(self, key, value):
+        self.__dict__[key] = value
+
+    def __getstate__(self):
+        """Get state (used e.g. for pickling)."""
+        return dict(self.__dict__)
+
+    def __setstate__(self, d):
+        """Set state (used e.g. for unpickling)."""
+        self.__dict__.update(d)
+
+    @property
+    def _constructor(self):
+        # Anything derived from the loaded neurons is a regular NeuronList
+        return NeuronList
+
+    @property
+    def neurons(self):
+        """Neurons contained in this NeuronList. Loads all neurons!"""
+        return self._cache.get(self._ids)
+
+    @property
+    def id(self) -> np.ndarray:
+        """IDs of the neurons."""
+        return self._ids
+
+    @property
+    def empty(self):
+        """Return True if NeuronList is empty."""
+        return len(self._ids) == 0
+
+    @property
+    def is_degenerated(self):
+        """Return True if contains neurons with non-unique IDs."""
+        return len(set(self._ids)) < len(self._ids)
+
+    @property
+    def n_loaded(self) -> int:
+        """Number of neurons currently held in memory."""
+        return len(self._cache)
+
+    def __len__(self):
+        """Number of neurons in this list."""
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator['core.NeuronObject']:
+        # Load in batches to avoid going back to the file for every neuron
+        batch = max(1, min(self._cache.maxsize, DEFAULT_CACHE_SIZE))
+        for i in range(0, len(self), batch):
+            yield from self._cache.get(self._ids[i:i + batch])
+
+    def __dir__(self):
+        """Custom __dir__ to add some parameters that we want to make searchable."""
+        # Only look at neurons that have already been loaded
+        neurons = self._cache.loaded()[:MAX_SEARCH]
+        if not neurons and not self.empty:
+            neurons = self._cache.get(self._ids[:1])
+        add_attr = set().union(*[set(dir(n)) for n in neurons])
+
+        return list(set(object.__dir__(self)) | add_attr)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._cache.get([self._ids[key]])[0]
+        elif isinstance(key, str):
+            if 'name' not in self._metadata.columns:
+                return super().__getitem__(key)
+            is_match = [re.fullmatch(key, str(n)) is not None
+                        for n in self._metadata['name'].values]
+            if not any(is_match):
+                raise AttributeError('NeuronList does not contain neuron(s) '
+                                     f'with name: "{key}"')
+            ix = np.where(is_match)[0]
+        elif isinstance(key, slice):
+            ix = np.arange(len(self))[key]
+        elif utils.is_iterable(key):
+            if all([isinstance(k, (bool, np.bool_)) for k in key]):
+                if len(key) != len(self):
+                    raise IndexError('boolean index did not match indexed '
+                                     f'NeuronList; dimension is {len(self)} '
+                                     'but corresponding boolean dimension is '
+                                     f'{len(key)}')
+                ix = np.where(key)[0]
+            else:
+                ix = np.asarray(key, dtype=int)
+        else:
+            raise NotImplementedError(f'Indexing NeuronList by {type(key)} not implemented')
+
+        return self._subset(ix)
+
+    def __reprheader__(self, html=False):
+        """Generate header for representation."""
+        head = (f'{type(self)} containing {len(self)} neurons '
+                f'({self.n_loaded} loaded)')
+        if html:
+            head = head.replace('<', '&lt;').replace('>', '&gt;')
+        return head
+
+    def __reprframe__(self):
+        """Return truncated DataFrame for self representation."""
+        if len(self) < 5:
+            return self.summary()
+        s = pd.concat((self.summary(N=slice(3)), self.summary(N=slice(-3, None))))
+        s.index = np.append(np.arange(3), np.arange(len(self) - 3, len(self)))
+        return s
+
+    def _subset(self, ix) -> 'LazyNeuronList':
+        """Generate a lazy subset sharing this list's cache."""
+        ix = np.asarray(ix, dtype=int)
+        x = self.__class__.__new__(self.__class__)
+        x.__dict__.update(self.__dict__)
+        x.__dict__['_ids'] = self._ids[ix]
+        x.__dict__['_metadata'] = self._metadata.iloc[ix].reset_index(drop=True)
+        x.__dict__.pop('_id_map', None)
+        x.__dict__['idx'] = _LazyIdIndexer(x)
+        return x
+
+    def summary(self,
+                N=None,
+                add_props: list = [],
+                progress=False
+                ) -> pd.DataFrame:
+        """Get summary over all neurons in this NeuronList.
+
+        Uses the metadata and hence does not load any neurons unless
+        `add_props` asks for properties not in the metadata.
+
+        Parameters
+        ----------
+        N :         int | slice, optional
+                    If int, get only first N entries.
+        add_props : list, optional
+                    Additional properties to add to summary. If attribute not
+                    available will return 'NA'.
+        progress :  bool
+                    Whether to show a progress bar when loading neurons for
+                    `add_props`.
+
+        Returns
+        -------
+        pandas DataFrame
+
+        """
+        if not isinstance(N, slice):
+            N = slice(N)
+
+        summary = self._metadata.iloc[N].reset_index(drop=True)
+
+        missing = [p for p in add_props if p not in summary.columns]
+        if missing:
+            values = [[getattr(n, p, 'NA') for p in missing]
+                      for n in config.tqdm(self[N],
+                                           total=len(summary),
+                                           desc='Summarizing',
+                                           leave=False,
+                                           disable=not progress)]
+            summary = pd.concat((summary, pd.DataFrame(values, columns=missing)),
+                                axis=1)
+
+        return summary
+
+    def load(self) -> NeuronList:
+        """Load all neurons and return them as regular NeuronList."""
+        return NeuronList(self.neurons)
+
+    def clear_cache(self):
+        """Drop all loaded neurons from memory."""
+        self._cache.clear()
+
+
+class _NeuronCache:
+    """Loads neurons and keeps the most recently used ones in memory."""
+
+    def __init__(self, loader, maxsize):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.neurons = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.neurons)
+
+    def __getstate__(self):
+        # Loaded neurons are not pickled
+        return {'loader': self.loader, 'maxsize': self.maxsize}
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.neurons = collections.OrderedDict()
+
+    def loaded(self):
+        """Neurons currently held in memory."""
+        return list(self.neurons.values())
+
+    def clear(self):
+        self.neurons.clear()
+
+    def get(self, ids):
+        """Get neurons for given IDs - loads those that are not in memory."""
+        keys = [str(i) for i in ids]
+
+        # Load all missing neurons in one go
+        missing = list(dict.fromkeys(i for i, k in zip(ids, keys)
+                                     if k not in self.neurons))
+        loaded = {}
+        if missing:
+            for n in self.loader(missing):
+                loaded[str(n.id)] = n
+            not_found = [str(i) for i in missing if str(i) not in loaded]
+            if not_found:
+                raise ValueError(f'Unable to load neuron(s): {", ".join(not_found)}')
+
+        neurons = [self.neurons[k] if k in self.neurons else loaded[k] for k in keys]
+
+        # Move (newly) accessed neurons to the end and drop the least
+        # recently used ones
+        for k, n in zip(keys, neurons):
+            self.neurons[k] = n
+            self.neurons.move_to_end(k)
+        while len(self.neurons) > self.maxsize:
+            self.neurons.popitem(last=False)
+
+        return neurons
+
+
+class _LazyIdIndexer():
+    """ID-based indexer for LazyNeuronLists (see `_IdIndexer`)."""
+
+    def __init__(self, neuronlist):
+        self.nl = neuronlist
+
+    def __getitem__(self, ids):
+        # Track if a single neuron was requested
+        single = not utils.is_iterable(ids)
+
+        # Turn into list and force strings
+        ids = utils.make_iterable(ids, force_type=str)
+
+        # Map IDs to positions (we might have duplicate IDs in the list)
+        if '_id_map' not in self.nl.__dict__:
+            map = collections.defaultdict(list)
+            for i, id in enumerate(self.nl._ids):
+                map[str(id)].append(i)
+            self.nl.__dict__['_id_map'] = map
+        map = self.nl.__dict__['_id_map']
+
+        # Get selection
+        sel = [map.get(i, []) for i in ids]
+
+        # Check for missing IDs
+        miss = [i for i, k in zip(ids, sel) if len(k) == 0]
+        if miss:
+            raise ValueError(f'No neuron(s) found for ID(s): {", ".join(miss)}')
+
+        # Check for duplicate Ids in query IDs or in resulting selection
+        dupl = [i for i, k in zip(ids, sel) if len(k) > 1]
+        if dupl or len(set(ids)) < len(ids):
+            logger.warning('Selection contains duplicate IDs.')
+
+        # Flatten selection
+        sel = [i for l in sel for i in l]
+
+        if single and len(sel) == 1:
+            return self.nl[sel[0]]
+        else:
+            return self.nl._subset(sel)
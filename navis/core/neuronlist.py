@@ -176,6 +176,11 @@ class NeuronList:
         """Neurons contained in this NeuronList."""
         return self.__dict__.get('neurons', [])
 
+    @property
+    def _constructor(self):
+        """Class used to make new lists (e.g. subsets) from this one."""
+        return self.__class__
+
     @property
     def is_mixed(self):
         """Return True if contains more than one type of neuron."""
@@ -322,13 +327,10 @@ class NeuronList:
                                sort=True)
 
                 # For each row label which neuron (id) it belongs to
-                df['neuron'] = None
-                ix = 0
-                for k, v in enumerate(values):
-                    if isinstance(v, pd.DataFrame):
-                        df.iloc[ix:ix + v.shape[0],
-                                df.columns.get_loc('neuron')] = self.neurons[k].id
-                        ix += v.shape[0]
+                ids = [self.neurons[k].id for k, v in enumerate(values)
+                       if isinstance(v, pd.DataFrame)]
+                counts = [v.shape[0] for v in values if isinstance(v, pd.DataFrame)]
+                df['neuron'] = np.repeat(np.array(ids, dtype=object), counts)
                 return df
             elif all(is_quantity):
                 # See if units are all compatible
@@ -450,7 +452,7 @@ class NeuronList:
         # Make sure we unpack neurons
         subset = utils.unpack_neurons(subset)
 
-        return self.__class__(subset, make_copy=self.copy_on_subset)
+        return self._constructor(subset, make_copy=self.copy_on_subset)
 
     def __setitem__(self, key, value):
         if isinstance(key, str):
@@ -481,17 +483,17 @@ class NeuronList:
     def __add__(self, to_add):
         """Implement addition."""
         if isinstance(to_add, core.BaseNeuron):
-            return self.__class__(self.neurons + [to_add],
+            return self._constructor(self.neurons + [to_add],
                                   make_copy=self.copy_on_subset)
         elif isinstance(to_add, NeuronList):
-            return self.__class__(self.neurons + to_add.neurons,
+            return self._constructor(self.neurons + to_add.neurons,
                                   make_copy=self.copy_on_subset)
         elif utils.is_iterable(to_add):
             if False not in [isinstance(n, core.BaseNeuron) for n in to_add]:
-                return self.__class__(self.neurons + list(to_add),
+                return self._constructor(self.neurons + list(to_add),
                                       make_copy=self.copy_on_subset)
             else:
-                return self.__class__(self.neurons + [core.BaseNeuron[n] for n in to_add],
+                return self._constructor(self.neurons + [core.BaseNeuron[n] for n in to_add],
                                       make_copy=self.copy_on_subset)
         else:
             return NotImplemented
@@ -509,17 +511,17 @@ class NeuronList:
     def __sub__(self, to_sub):
         """Implement substraction."""
         if isinstance(to_sub, core.BaseNeuron):
-            return self.__class__([n for n in self.neurons if n != to_sub],
+            return self._constructor([n for n in self.neurons if n != to_sub],
                                   make_copy=self.copy_on_subset)
         elif isinstance(to_sub, NeuronList):
-            return self.__class__([n for n in self.neurons if n not in to_sub],
+            return self._constructor([n for n in self.neurons if n not in to_sub],
                                   make_copy=self.copy_on_subset)
         else:
             return NotImplemented
 
     def __truediv__(self, other):
         """Implements division for coordinates (nodes, connectors)."""
-        return self.__class__([n / other for n in config.tqdm(self.neurons,
+        return self._constructor([n / other for n in config.tqdm(self.neurons,
                                                               desc='Dividing',
                                                               disable=config.pbar_hide,
                                                               leave=False)])
@@ -527,7 +529,7 @@ class NeuronList:
 
     def __mul__(self, other):
         """Implement multiplication for coordinates (nodes, connectors)."""
-        return self.__class__([n * other for n in config.tqdm(self.neurons,
+        return self._constructor([n * other for n in config.tqdm(self.neurons,
                                                               desc='Multiplying',
                                                               disable=config.pbar_hide,
                                                               leave=False)])
@@ -535,10 +537,10 @@ class NeuronList:
     def __and__(self, other):
         """Implement bitwise AND using the & operator."""
         if isinstance(other, core.BaseNeuron):
-            return self.__class__([n for n in self.neurons if n == other],
+            return self._constructor([n for n in self.neurons if n == other],
                                   make_copy=self.copy_on_subset)
         elif isinstance(other, NeuronList):
-            return self.__class__([n for n in self.neurons if n in other],
+            return self._constructor([n for n in self.neurons if n in other],
                                   make_copy=self.copy_on_subset)
         else:
             return NotImplemented
@@ -549,10 +551,10 @@ class NeuronList:
             neurons = self.neurons
             if not any(n == other for n in neurons):
                 neurons.append(other)
-            return self.__class__(neurons, make_copy=self.copy_on_subset)
+            return self._constructor(neurons, make_copy=self.copy_on_subset)
         elif isinstance(other, NeuronList):
             neurons = self.neurons + [n for n in other.neurons if n not in self]
-            return self.__class__(neurons, make_copy=self.copy_on_subset)
+            return self._constructor(neurons, make_copy=self.copy_on_subset)
         else:
             return NotImplemented
 
@@ -585,7 +587,7 @@ class NeuronList:
     def apply(self,
               func: Callable,
               *,
-              parallel: bool = False,
+              parallel: Union[bool, str] = False,
               n_cores: int = os.cpu_count() // 2,
               omit_failures: bool = False,
               **kwargs):
@@ -596,11 +598,13 @@ class NeuronList:
         func :          callable
                         Function to be applied. Must accept
                         [`navis.BaseNeuron`][] as first argument.
-        parallel :      bool
-                        If True (default) will use multiprocessing. Spawning the
-                        processes takes time (and memory). Using `parallel=True`
-                        makes only sense if the NeuronList is large or the
-                        function takes a long time to run.
+        parallel :      bool | "processes" | "threads"
+                        If True will use a pool of worker processes (see
+                        `navis.config.parallel_backend`). Neurons have to be
+                        sent to the workers which takes time (and memory) -
+                        `parallel=True` makes only sense if the NeuronList is
+                        large or the function takes a long time to run. Use
+                        "threads" for functions that release the GIL.
         n_cores :       int
                         Number of CPUs to use for multiprocessing. Defaults to
                         half the available cores.
@@ -693,7 +697,7 @@ class NeuronList:
 
         indices = list(range(len(self.neurons)))
         random.shuffle(indices)
-        return self.__class__([n for i, n in enumerate(self.neurons) if i in indices[:N]],
+        return self._constructor([n for i, n in enumerate(self.neurons) if i in indices[:N]],
                               make_copy=self.copy_on_subset)
 
     def plot3d(self, **kwargs):
@@ -960,6 +964,30 @@ class NeuronList:
                               key=lambda x: getattr(x, key),
                               reverse=ascending is False)
 
+    def pack(self) -> 'core.PackedNeuronList':
+        """Pack neurons into contiguous arrays.
+
+        Concatenates the nodes (skeletons) or points (dotprops) of all
+        neurons so that e.g. `n_nodes`, `cable_length`, `bbox` or unit
+        conversion are computed for all neurons at once. Use `.unpack()` on
+        the result to get a `NeuronList` again.
+
+        Returns
+        -------
+        navis.core.PackedNeuronList
+
+        Examples
+        --------
+        >>> import navis
+        >>> nl = navis.example_neurons(3, kind='skeleton')
+        >>> p = nl.pack()
+        >>> all(p.n_nodes == nl.n_nodes)
+        True
+        >>> nl2 = p.unpack()
+
+        """
+        return core.PackedNeuronList(self)
+
     def copy(self, **kwargs) -> 'NeuronList':
         """Return copy of this NeuronList.
 
@@ -975,7 +1003,7 @@ class NeuronList:
                                 available - will always be deepcopied.
 
         """
-        return self.__class__([n.copy(**kwargs) for n in config.tqdm(self.neurons,
+        return self._constructor([n.copy(**kwargs) for n in config.tqdm(self.neurons,
                                                                      desc='Copy',
                                                                      leave=False,
                                                                      disable=config.pbar_hide or len(self) < 20)],
@@ -1039,7 +1067,7 @@ class NeuronList:
                 Dictionary of `{Neurontype: NeuronList}`
 
         """
-        return {t: self.__class__([n for n in self.neurons if isinstance(n, t)])
+        return {t: self._constructor([n for n in self.neurons if isinstance(n, t)])
                 for t in self.types}
 
 
@@ -1084,4 +1112,4 @@ class _IdIndexer():
         if single and len(sel) == 1:
             return sel[0]
         else:
-            return self.nl.__class__(sel)
+            return self.nl._constructor(sel)
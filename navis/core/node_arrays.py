@@ -0,0 +1,294 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Compact, array-backed storage for skeleton node tables.
+
+A `TreeNeuron` normally keeps its nodes in a pandas DataFrame which is
+validated and classified on construction. For large collections of skeletons
+the per-table overhead adds up. `NodeArrays` instead holds the node table as
+a handful of contiguous NumPy arrays. The DataFrame is only built (without
+copying the data) when a neuron's `.nodes` is actually requested.
+"""
+
+import numpy as np
+import pandas as pd
+
+from typing import Optional, Sequence, Union
+
+__all__ = ['NodeArrays']
+
+#: Node types in the order used by `navis.graph.classify_nodes`.
+NODE_TYPES = ['end', 'branch', 'root', 'slab']
+
+# Columns stored in the float32 coordinate block
+COORD_COLUMNS = ('x', 'y', 'z', 'radius')
+
+
+class NodeArrays:
+    """Skeleton node table stored as contiguous NumPy arrays.
+
+    Node and parent IDs are stored as 32 bit integers (64 bit if IDs are too
+    large) unless `id_dtype` is given, coordinates and radii as a single
+    `(4, N)` block (`(3, N)` without radii) and node types as categorical
+    codes. Node types are only calculated when first needed.
+
+    Parameters
+    ----------
+    node_id :       (N, ) array
+    parent_id :     (N, ) array
+                    Parent IDs. Roots must have negative parent IDs.
+    xyz :           (N, 3) array
+                    Node coordinates.
+    radius :        (N, ) array, optional
+                    Node radii. If not provided, the node table will not
+                    have a "radius" column.
+    extra :         dict, optional
+                    Additional columns (e.g. SWC labels) as `{name: values}`.
+    columns :       list of str, optional
+                    Order of columns in the DataFrame. Columns not in this
+                    list are appended at the end.
+    dtype :         numpy dtype
+                    Data type for coordinates and radii.
+    id_dtype :      numpy dtype, optional
+                    Data type for node and parent IDs. If not provided, will
+                    use int32 if possible and int64 otherwise.
+
+    Examples
+    --------
+    >>> import navis
+    >>> n = navis.example_neurons(1)
+    >>> arrays = navis.core.NodeArrays.from_dataframe(n.nodes)
+    >>> c = navis.TreeNeuron(arrays, units='8 nm')
+    >>> c.n_nodes == n.n_nodes
+    True
+
+    """
+
+    __slots__ = ('node_id', 'parent_id', 'coords', 'extra', 'columns', '_type')
+
+    def __init__(self,
+                 node_id: Sequence[int],
+                 parent_id: Sequence[int],
+                 xyz: np.ndarray,
+                 radius: Optional[Sequence[float]] = None,
+                 extra: Optional[dict] = None,
+                 columns: Optional[Sequence[str]] = None,
+                 dtype: np.dtype = np.float32,
+                 id_dtype: Optional[np.dtype] = None):
+        node_id = np.asarray(node_id)
+        parent_id = np.asarray(parent_id)
+        xyz = np.asarray(xyz)
+
+        if node_id.ndim != 1 or parent_id.shape != node_id.shape:
+            raise ValueError('`node_id` and `parent_id` must be 1d arrays of '
+                             'the same length')
+        if xyz.shape != (len(node_id), 3):
+            raise ValueError(f'`xyz` must be ({len(node_id)}, 3) array, got '
+                             f'{xyz.shape}')
+
+        if id_dtype is None:
+            id_dtype = _id_dtype(node_id, parent_id)
+        self.node_id = np.ascontiguousarray(node_id, dtype=id_dtype)
+        self.parent_id = np.ascontiguousarray(parent_id, dtype=id_dtype)
+
+        # Each row is a contiguous column in the DataFrame
+        self.coords = np.empty((3 if radius is None else 4, len(node_id)),
+                               dtype=dtype)
+        self.coords[:3] = xyz.T
+        if radius is not None:
+            self.coords[3] = radius
+
+        self.extra = {} if extra is None else dict(extra)
+        for k, v in self.extra.items():
+            if len(v) != len(node_id):
+                raise ValueError(f'Column "{k}" has {len(v)} rows, expected '
+                                 f'{len(node_id)}')
+
+        coords = COORD_COLUMNS[:len(self.coords)]
+        default = ['node_id', 'parent_id', *coords, *self.extra, 'type']
+        columns = list(columns) if columns is not None else []
+        columns = [c for c in columns if c in coords or c not in COORD_COLUMNS]
+        self.columns = tuple(columns + [c for c in default if c not in columns])
+
+        self._type = None
+
+    def __len__(self):
+        return len(self.node_id)
+
+    def __repr__(self):
+        return (f'<{type(self).__name__}(nodes={len(self)}, '
+                f'{self.nbytes / 1e6:.2f} MB)>')
+
+    def __copy__(self):
+        # Mirror `DataFrame.__copy__` which makes a deep copy: neurons must
+        # not share node data after `neuron.copy()`
+        return self.copy()
+
+    def copy(self) -> 'NodeArrays':
+        """Return a copy."""
+        x = self.__class__.__new__(self.__class__)
+        x.node_id = self.node_id.copy()
+        x.parent_id = self.parent_id.copy()
+        x.coords = self.coords.copy()
+        x.extra = {k: v.copy() for k, v in self.extra.items()}
+        x.columns = self.columns
+        x._type = None if self._type is None else self._type.copy()
+        return x
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, d):
+        for k, v in d.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def _from_parts(cls, node_id, parent_id, coords, extra, columns,
+                    type=None) -> 'NodeArrays':
+        """Assemble from already validated arrays without copying them."""
+        x = cls.__new__(cls)
+        x.node_id = node_id
+        x.parent_id = parent_id
+        x.coords = coords
+        x.extra = extra
+        x.columns = tuple(columns)
+        x._type = type
+        return x
+
+    @classmethod
+    def from_dataframe(cls, nodes: pd.DataFrame) -> 'NodeArrays':
+        """Generate from a node table.
+
+        Data types of IDs and coordinates are kept as they are.
+
+        Parameters
+        ----------
+        nodes :     pandas.DataFrame
+                    Must contain `node_id`, `parent_id`, `x`, `y` and `z`
+                    columns. `radius` is optional. Any other columns except
+                    `type` are kept as is.
+
+        """
+        missing = [c for c in ('node_id', 'parent_id', 'x', 'y', 'z')
+                   if c not in nodes.columns]
+        if missing:
+            raise ValueError(f'Node table is missing columns: {", ".join(missing)}')
+
+        core = {'node_id', 'parent_id', 'type', *COORD_COLUMNS}
+        extra = {c: nodes[c].values for c in nodes.columns if c not in core}
+        coords = [c for c in COORD_COLUMNS if c in nodes.columns]
+
+        return cls(nodes.node_id.values,
+                   nodes.parent_id.values,
+                   nodes[['x', 'y', 'z']].values,
+                   radius=nodes.radius.values if 'radius' in nodes.columns else None,
+                   extra=extra,
+                   columns=[c for c in nodes.columns],
+                   dtype=np.result_type(*nodes.dtypes[coords]),
+                   id_dtype=np.result_type(nodes.node_id.dtype,
+                                           nodes.parent_id.dtype))
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the arrays."""
+        extra = sum(getattr(v, 'nbytes', 0) for v in self.extra.values())
+        types = 0 if self._type is None else self._type.nbytes
+        return (self.node_id.nbytes + self.parent_id.nbytes + self.coords.nbytes
+                + extra + types)
+
+    @property
+    def xyz(self) -> np.ndarray:
+        """(N, 3) view of the node coordinates."""
+        return self.coords[:3].T
+
+    @property
+    def type(self) -> np.ndarray:
+        """Node types as codes into `NODE_TYPES`."""
+        if self._type is None:
+            self._type = _classify(self.node_id, self.parent_id)
+        return self._type
+
+    @property
+    def roots(self) -> np.ndarray:
+        """IDs of root nodes."""
+        return self.node_id[self.parent_id < 0]
+
+    @property
+    def bbox(self) -> np.ndarray:
+        """(3, 2) bounding box of the nodes."""
+        return np.vstack((self.coords[:3].min(axis=1),
+                          self.coords[:3].max(axis=1))).T
+
+    def count_type(self, type: str) -> int:
+        """Count nodes of given type (e.g. "branch")."""
+        return int((self.type == NODE_TYPES.index(type)).sum())
+
+    def column(self, name: str) -> Union[np.ndarray, pd.Categorical]:
+        """Values of a single column (same as `nodes[name].values`)."""
+        if name in ('node_id', 'parent_id'):
+            return getattr(self, name)
+        elif name in COORD_COLUMNS and name in self.columns:
+            return self.coords[COORD_COLUMNS.index(name)]
+        elif name == 'type':
+            return pd.Categorical.from_codes(self.type, categories=NODE_TYPES)
+        elif name in self.extra:
+            return self.extra[name]
+        raise KeyError(name)
+
+    def values(self, columns: Sequence[str]) -> np.ndarray:
+        """C-contiguous (N, M) array (same as `nodes[columns].values`)."""
+        cols = [self.column(c) for c in columns]
+        dtype = np.result_type(*[c.dtype for c in cols])
+        out = np.empty((len(self), len(cols)), dtype=dtype)
+        for i, c in enumerate(cols):
+            out[:, i] = c
+        return out
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Generate node table.
+
+        The DataFrame's columns are views of the underlying arrays, i.e.
+        this does not copy any data.
+
+        """
+        data = {c: self.column(c) for c in self.columns}
+        return pd.DataFrame(data, copy=False)
+
+
+def _id_dtype(node_id, parent_id):
+    """Smallest of int32/int64 that can hold given IDs."""
+    for ids in (node_id, parent_id):
+        if ids.dtype.kind not in 'iu':
+            raise TypeError(f'IDs must be integers, got "{ids.dtype}"')
+    if not len(node_id):
+        return np.int32
+
+    info = np.iinfo(np.int32)
+    mn = min(node_id.min(), parent_id.min())
+    mx = max(node_id.max(), parent_id.max())
+    if mn >= info.min and mx <= info.max:
+        return np.int32
+    return np.int64
+
+
+def _classify(node_id, parent_id):
+    """Classify nodes into end, branch, root and slab nodes.
+
+    This follows the same logic as `navis.graph.classify_nodes`.
+    """
+    types = np.full(len(node_id), NODE_TYPES.index('slab'), dtype=np.int8)
+    types[~np.isin(node_id, parent_id)] = NODE_TYPES.index('end')
+    parents, counts = np.unique(parent_id, return_counts=True)
+    types[np.isin(node_id, parents[counts > 1])] = NODE_TYPES.index('branch')
+    types[parent_id < 0] = NODE_TYPES.index('root')
+    return types
@@ -0,0 +1,571 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Packed, array-backed representation of a list of neurons.
+
+A `NeuronList` collects attributes by going over its neurons one at a time.
+`PackedNeuronList` instead concatenates the nodes (skeletons) or points
+(dotprops) of all neurons into a single set of arrays plus offsets, so that
+e.g. the number of nodes, cable length or bounding boxes are calculated for
+all neurons in one go.
+"""
+
+import copy as _copy
+import numbers
+import types
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from typing import Optional, Sequence
+
+from .. import config, utils
+from .dotprop import Dotprops
+from .neuronlist import NeuronList
+from .node_arrays import NodeArrays, NODE_TYPES, COORD_COLUMNS, _id_dtype
+from .skeleton import TreeNeuron
+
+__all__ = ['PackedNeuronList']
+
+# Bookkeeping attributes which are regenerated when unpacking
+_SKIP_ATTR = ('_lock', '_current_md5', '_clean_generation', '_generation',
+              '_stale', '_md5_cache', '_unit_str')
+
+# Core data which is packed for each type of neuron
+_PACKED_ATTR = {TreeNeuron: ('_nodes', '_node_arrays'),
+                Dotprops: ('_points', '_vect', '_alpha', '_tree')}
+
+
+class PackedNeuronList:
+    """Skeletons or dotprops packed into contiguous arrays.
+
+    The nodes (skeletons) or points, vectors and alpha values (dotprops) of
+    all neurons are concatenated into single arrays with `offsets` marking
+    where each neuron starts. Properties such as `n_nodes`, `cable_length` or
+    `bbox` are calculated for all neurons at once. Connectors are packed the
+    same way. Everything else (names, somas, additional node columns, etc.)
+    is kept as is for each neuron.
+
+    Typically generated via `NeuronList.pack()`. Use `.unpack()` to get a
+    `NeuronList` back.
+
+    Parameters
+    ----------
+    x :         NeuronList | list of TreeNeurons or Dotprops
+                Neurons to pack. Must all be of the same type.
+
+    Attributes
+    ----------
+    ids :       (N, ) array
+                IDs of the packed neurons.
+    offsets :   (N + 1, ) array
+                Rows `offsets[i]:offsets[i + 1]` belong to the i-th neuron.
+    connectors : pandas.DataFrame | None
+                Connectors of all neurons. Rows
+                `cn_offsets[i]:cn_offsets[i + 1]` belong to the i-th neuron.
+
+    Examples
+    --------
+    >>> import navis
+    >>> import numpy as np
+    >>> nl = navis.example_neurons(3, kind='skeleton')
+    >>> p = nl.pack()
+    >>> p
+    <PackedNeuronList(3 x TreeNeuron, 13644 nodes)>
+    >>> np.allclose(p.cable_length, nl.cable_length)
+    True
+    >>> p_um = p.convert_units('um')
+    >>> nl_um = p_um.unpack()
+    >>> nl_um[0].units
+    <Quantity(1.0, 'micrometer')>
+
+    """
+
+    def __init__(self, x: Sequence):
+        neurons = NeuronList(x).neurons
+        if not neurons:
+            raise ValueError('Unable to pack an empty NeuronList')
+
+        classes = set(type(n) for n in neurons)
+        if len(classes) > 1:
+            raise TypeError('Unable to pack NeuronList with mixed neuron '
+                            f'types: {", ".join(c.__name__ for c in classes)}')
+
+        self.neuron_class = classes.pop()
+        if issubclass(self.neuron_class, TreeNeuron):
+            self._base_class = TreeNeuron
+            packed = self._pack_nodes(neurons)
+        elif issubclass(self.neuron_class, Dotprops):
+            self._base_class = Dotprops
+            packed = self._pack_points(neurons)
+        else:
+            raise TypeError('Can only pack TreeNeurons or Dotprops, got '
+                            f'"{self.neuron_class.__name__}"')
+
+        self.ids = np.asarray([n.id for n in neurons])
+        self._unit_str = [getattr(n, '_unit_str', None) for n in neurons]
+        self._pack_connectors(neurons)
+        self._pack_meta(neurons, packed)
+
+        self._parent_ix = None
+        # Whether neurons sharing our arrays have been handed out
+        self._has_views = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        what = 'nodes' if self._base_class is TreeNeuron else 'points'
+        return (f'<{type(self).__name__}({len(self)} x '
+                f'{self.neuron_class.__name__}, {self.offsets[-1]} {what})>')
+
+    def __getitem__(self, key):
+        """Unpack a single neuron."""
+        if not isinstance(key, numbers.Integral):
+            raise TypeError('PackedNeuronList can only be indexed by integer, '
+                            f'got "{type(key)}"')
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f'Index {key} out of range')
+        return self._unpack_neuron(key, copy=True)
+
+    def __mul__(self, other):
+        """Multiply coordinates (nodes, points, connectors)."""
+        if isinstance(other, numbers.Number):
+            x = self.copy()
+            x._rescale(np.full(len(x), other, dtype=np.float64))
+            return x
+        return NotImplemented
+
+    def __truediv__(self, other):
+        """Divide coordinates (nodes, points, connectors)."""
+        if isinstance(other, numbers.Number):
+            return self.__mul__(1 / other)
+        return NotImplemented
+
+    def _pack_nodes(self, neurons):
+        """Concatenate node tables of skeletons."""
+        core = {'node_id', 'parent_id', 'type', *COORD_COLUMNS}
+        ids, parents, coords = [], [], [[] for c in COORD_COLUMNS]
+        self._extra, self._columns = [], []
+        for n in neurons:
+            arrays = n.__dict__.get('_node_arrays')
+            if arrays is not None:
+                ids.append(arrays.node_id)
+                parents.append(arrays.parent_id)
+                for i in range(len(COORD_COLUMNS)):
+                    # Skeletons without radii get a placeholder (the
+                    # column is not part of their node table)
+                    coords[i].append(arrays.coords[i] if i < len(arrays.coords)
+                                     else np.zeros(len(arrays), dtype=arrays.coords.dtype))
+                self._extra.append(arrays.extra)
+                self._columns.append(arrays.columns)
+            else:
+                nodes = n.nodes
+                ids.append(nodes.node_id.values)
+                parents.append(nodes.parent_id.values)
+                for i, c in enumerate(COORD_COLUMNS):
+                    coords[i].append(nodes[c].values)
+                self._extra.append({c: nodes[c].values for c in nodes.columns
+                                    if c not in core})
+                self._columns.append(tuple(nodes.columns))
+
+        counts = [len(i) for i in ids]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        self.node_id = np.concatenate(ids)
+        self.parent_id = np.concatenate(parents)
+        dtype = _id_dtype(self.node_id, self.parent_id)
+        self.node_id = self.node_id.astype(dtype, copy=False)
+        self.parent_id = self.parent_id.astype(dtype, copy=False)
+
+        # Each row is one coordinate column (same layout as NodeArrays)
+        dtype = np.result_type(np.float32, *[a.dtype for c in coords for a in c])
+        self.coords = np.empty((len(COORD_COLUMNS), self.offsets[-1]), dtype=dtype)
+        for i, c in enumerate(coords):
+            np.concatenate(c, out=self.coords[i])
+
+        self._type = None
+
+        return _PACKED_ATTR[TreeNeuron] + ('_connectors', )
+
+    def _pack_points(self, neurons):
+        """Concatenate points, vectors and alpha of dotprops."""
+        counts = [len(n.points) for n in neurons]
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        packed = list(_PACKED_ATTR[Dotprops]) + ['connectors']
+        for attr in ('points', 'vect', 'alpha'):
+            values = [n.__dict__.get(f'_{attr}') for n in neurons]
+            # If any of the neurons is missing vectors or alpha (i.e. they
+            # would be calculated on request), we keep those per neuron
+            if any(v is None for v in values):
+                values = None
+                packed.remove(f'_{attr}')
+            else:
+                values = np.concatenate(values)
+            setattr(self, attr, values)
+
+        return tuple(packed)
+
+    def _pack_connectors(self, neurons):
+        """Concatenate connector tables."""
+        cn = [getattr(n, 'connectors', None) for n in neurons]
+        cn = [c if isinstance(c, pd.DataFrame) else None for c in cn]
+
+        counts = [len(c) if c is not None else 0 for c in cn]
+        self.cn_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        self._has_cn = [c is not None for c in cn]
+        if any(self._has_cn):
+            self.connectors = pd.concat([c for c in cn if c is not None],
+                                        axis=0, ignore_index=True, sort=False)
+        else:
+            self.connectors = None
+
+        # If tables differ (e.g. in columns) we need to remember their dtypes
+        # so that each neuron's table can be restored as is
+        self._cn_dtypes = {i: c.dtypes for i, c in enumerate(cn)
+                           if c is not None and not c.dtypes.equals(self.connectors.dtypes)}
+
+    def _pack_meta(self, neurons, packed):
+        """Collect per-neuron attributes that are not packed."""
+        skip = set(_SKIP_ATTR) | set(packed)
+        self._meta = []
+        for n in neurons:
+            meta = {}
+            for k, v in n.__dict__.items():
+                if k in skip or k in n.TEMP_ATTR:
+                    continue
+                # Methods bound to the neuron (e.g. `_soma`) must be bound to
+                # the new neuron when unpacking
+                if isinstance(v, types.MethodType) and v.__self__ is n:
+                    v = _Rebind(v.__func__)
+                meta[k] = v
+            self._meta.append(meta)
+
+    @property
+    def neuron_index(self) -> np.ndarray:
+        """Index of the neuron each node/point belongs to."""
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    @property
+    def parent_ix(self) -> np.ndarray:
+        """Row of each node's parent (-1 for roots)."""
+        self._check_type(TreeNeuron, 'parent_ix')
+        if self._parent_ix is None:
+            # Node IDs are only unique within each neuron, so we combine them
+            # with the neuron's index into a single key
+            nix = self.neuron_index
+            mn = min(self.node_id.min(), self.parent_id.min(), 0)
+            span = int(max(self.node_id.max(), self.parent_id.max())) - int(mn) + 1
+            if len(self) * span < np.iinfo(np.int64).max:
+                offset = nix.astype(np.int64) * span - mn
+                index = pd.Index(self.node_id + offset)
+                query = self.parent_id + offset
+            else:
+                index = pd.MultiIndex.from_arrays([nix, self.node_id])
+                query = pd.MultiIndex.from_arrays([nix, self.parent_id])
+            self._parent_ix = index.get_indexer(query)
+            # Roots (and missing parents) must not accidentally match
+            self._parent_ix[self.parent_id < 0] = -1
+        return self._parent_ix
+
+    @property
+    def type(self) -> np.ndarray:
+        """Node types as codes into `['end', 'branch', 'root', 'slab']`."""
+        self._check_type(TreeNeuron, 'type')
+        if self._type is None:
+            pix = self.parent_ix
+            n_children = np.bincount(pix[pix >= 0], minlength=len(pix))
+            types = np.full(len(pix), NODE_TYPES.index('slab'), dtype=np.int8)
+            types[n_children == 0] = NODE_TYPES.index('end')
+            types[n_children > 1] = NODE_TYPES.index('branch')
+            types[self.parent_id < 0] = NODE_TYPES.index('root')
+            self._type = types
+        return self._type
+
+    @property
+    def n_nodes(self) -> np.ndarray:
+        """Number of nodes for each neuron."""
+        self._check_type(TreeNeuron, 'n_nodes')
+        return np.diff(self.offsets)
+
+    @property
+    def n_points(self) -> np.ndarray:
+        """Number of points for each neuron."""
+        self._check_type(Dotprops, 'n_points')
+        return np.diff(self.offsets)
+
+    @property
+    def n_connectors(self) -> np.ndarray:
+        """Number of connectors for each neuron."""
+        return np.diff(self.cn_offsets)
+
+    @property
+    def nodes(self) -> pd.DataFrame:
+        """Node table of all neurons.
+
+        Same as `NeuronList.nodes`: a `neuron` column has the ID of the
+        neuron each node belongs to. Columns other than `node_id`,
+        `parent_id`, `x`, `y`, `z`, `radius` and `type` are not included.
+
+        """
+        self._check_type(TreeNeuron, 'nodes')
+        data = {'node_id': self.node_id, 'parent_id': self.parent_id}
+        data.update({c: self.coords[i] for i, c in enumerate(COORD_COLUMNS)})
+        data['type'] = pd.Categorical.from_codes(self.type, categories=NODE_TYPES)
+        data['neuron'] = np.repeat(self.ids, self.n_nodes)
+        return pd.DataFrame(data, copy=False)
+
+    @property
+    def xyz(self) -> np.ndarray:
+        """(M, 3) view of the coordinates of all nodes/points."""
+        if self._base_class is TreeNeuron:
+            return self.coords[:3].T
+        return self.points
+
+    @property
+    def cable_length(self) -> np.ndarray:
+        """Cable length for each neuron."""
+        self._check_type(TreeNeuron, 'cable_length')
+        # Roots are their own parent, i.e. have a distance of 0
+        pix = self.parent_ix
+        pix = np.where(pix >= 0, pix, np.arange(len(pix)))
+        dist = np.zeros(len(pix), dtype=self.coords.dtype)
+        for c in self.coords[:3]:
+            diff = c - c[pix]
+            dist += diff * diff
+        return np.bincount(self.neuron_index, weights=np.sqrt(dist),
+                           minlength=len(self))
+
+    @property
+    def bboxes(self) -> np.ndarray:
+        """(N, 3, 2) bounding box for each neuron (includes connectors)."""
+        mn, mx = _reduce_rows(self.xyz, self.offsets)
+        if self.connectors is not None:
+            cn_mn, cn_mx = _reduce_rows(self.connectors[['x', 'y', 'z']].values,
+                                        self.cn_offsets)
+            mn, mx = np.fmin(mn, cn_mn), np.fmax(mx, cn_mx)
+        return np.stack((mn, mx), axis=2)
+
+    @property
+    def bbox(self) -> np.ndarray:
+        """Bounding box across all neurons (same as `NeuronList.bbox`)."""
+        bboxes = self.bboxes
+        return np.vstack((np.nanmin(bboxes[:, :, 0], axis=0),
+                          np.nanmax(bboxes[:, :, 1], axis=0))).T
+
+    @property
+    def units(self) -> list:
+        """Units for each neuron."""
+        return [config.ureg(u) for u in self._unit_str]
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes used by the packed arrays."""
+        if self._base_class is TreeNeuron:
+            arrays = [self.node_id, self.parent_id, self.coords, self._type]
+        else:
+            arrays = [self.points, self.vect, self.alpha]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def _check_type(self, cls, attr):
+        if self._base_class is not cls:
+            raise AttributeError(f'"{attr}" is not available for packed '
+                                 f'{self._base_class.__name__}')
+
+    def _rescale(self, factors):
+        """Multiply coordinates of each neuron by given factor."""
+        if any(utils.is_iterable(u) for u in self._unit_str):
+            raise ValueError('Unable to scale neurons with non-isotropic units')
+
+        f = np.repeat(factors, np.diff(self.offsets))
+        if self._base_class is TreeNeuron:
+            # Scale x/y/z and radius
+            np.multiply(self.coords, f, out=self.coords, casting='unsafe')
+        else:
+            np.multiply(self.points, f[:, None], out=self.points, casting='unsafe')
+
+        if self.connectors is not None:
+            f = np.repeat(factors, np.diff(self.cn_offsets))
+            for c in ('x', 'y', 'z'):
+                # Same type promotion as multiplying the column by a float
+                # (see TreeNeuron.__mul__)
+                values = self.connectors[c].values
+                dtype = np.result_type(values.dtype, 1.0)
+                self.connectors[c] = (values * f).astype(dtype, copy=False)
+                for dtypes in self._cn_dtypes.values():
+                    dtypes[c] = dtype
+
+        for i, meta in enumerate(self._meta):
+            if isinstance(meta.get('soma_radius'), numbers.Number):
+                meta['soma_radius'] = meta['soma_radius'] * factors[i]
+
+        # Update units - there are typically only a handful of unique units
+        new_units = {}
+        for i, (u, f) in enumerate(zip(self._unit_str, factors)):
+            if (u, f) not in new_units:
+                # Suppress pint's RuntimeWarning (see TreeNeuron.__mul__)
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    new_units[(u, f)] = str((config.ureg(u) / f).to_compact())
+            self._unit_str[i] = new_units[(u, f)]
+
+    def convert_units(self,
+                      to: str,
+                      inplace: bool = False) -> Optional['PackedNeuronList']:
+        """Convert coordinates of all neurons to different units.
+
+        Parameters
+        ----------
+        to :        pint.Unit | str
+                    Units to convert to. If string, must be parsable by pint.
+        inplace :   bool, optional
+                    If True will convert in place. If not will return a
+                    copy.
+
+        See Also
+        --------
+        [`navis.TreeNeuron.convert_units`][]
+                    Same for individual neurons.
+
+        """
+        if inplace and self._has_views:
+            raise ValueError('Unable to convert units in place: neurons from '
+                             '`.unpack(copy=False)` share the coordinates but '
+                             'would keep their old units')
+
+        x = self if inplace else self.copy()
+
+        factors = np.ones(len(x))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for u in set(x._unit_str):
+                if utils.is_iterable(u):
+                    raise ValueError('Unable to convert neurons with '
+                                     'non-isotropic units')
+                is_u = np.array([v == u for v in x._unit_str])
+                factors[is_u] = config.ureg(u).to(to).magnitude
+
+        x._rescale(factors)
+
+        if not inplace:
+            return x
+
+    def copy(self) -> 'PackedNeuronList':
+        """Return a copy."""
+        x = self.__class__.__new__(self.__class__)
+        for k, v in self.__dict__.items():
+            if isinstance(v, (np.ndarray, pd.DataFrame)):
+                v = v.copy()
+            elif k == '_meta':
+                v = [{k2: _copy.copy(v2) for k2, v2 in m.items()} for m in v]
+            elif k == '_cn_dtypes':
+                v = {i: d.copy() for i, d in v.items()}
+            elif isinstance(v, list):
+                v = list(v)
+            x.__dict__[k] = v
+        x._has_views = False
+        return x
+
+    def unpack(self, copy: bool = True) -> NeuronList:
+        """Convert back to a NeuronList.
+
+        Parameters
+        ----------
+        copy :      bool
+                    If False, the neurons' data will be views of this object's
+                    arrays: changes to the neurons' coordinates propagate back
+                    and vice versa. Note that these views do not track units
+                    (in-place unit conversion of this object is not allowed
+                    afterwards) or mark the neurons as modified.
+
+        Returns
+        -------
+        NeuronList
+
+        """
+        if not copy:
+            self._has_views = True
+        return NeuronList([self._unpack_neuron(i, copy=copy)
+                           for i in range(len(self))])
+
+    def _unpack_neuron(self, i, copy=True):
+        """Generate the i-th neuron."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        get = (lambda a: a.copy()) if copy else (lambda a: a)
+
+        if self._base_class is TreeNeuron:
+            node_types = None if self._type is None else get(self._type[start:end])
+            arrays = NodeArrays._from_parts(get(self.node_id[start:end]),
+                                            get(self.parent_id[start:end]),
+                                            get(self.coords[:, start:end]),
+                                            {k: get(v) for k, v in self._extra[i].items()},
+                                            self._columns[i],
+                                            type=node_types)
+            n = self.neuron_class(None)
+            data = {'_node_arrays': arrays}
+        else:
+            # Same as in Dotprops.copy: pass vect and alpha to prevent
+            # calculation on initialization
+            n = self.neuron_class(points=np.zeros((0, 3)), k=1,
+                                  vect=np.zeros((0, 3)), alpha=np.zeros(0))
+            data = {f'_{attr}': get(getattr(self, attr)[start:end])
+                    for attr in ('points', 'vect', 'alpha')
+                    if getattr(self, attr) is not None}
+
+        for k, v in self._meta[i].items():
+            if isinstance(v, _Rebind):
+                v = types.MethodType(v.func, n)
+            elif copy:
+                v = _copy.copy(v)
+            data[k] = v
+        data['_unit_str'] = self._unit_str[i]
+
+        if self._has_cn[i]:
+            cn_start, cn_end = self.cn_offsets[i], self.cn_offsets[i + 1]
+            cn = self.connectors.iloc[cn_start:cn_end].reset_index(drop=True)
+            if i in self._cn_dtypes:
+                dtypes = self._cn_dtypes[i]
+                cn = cn[dtypes.index].astype(dtypes.to_dict())
+            data['_connectors' if self._base_class is TreeNeuron else 'connectors'] = get(cn)
+
+        # Bypass __setattr__: this is not a modification of the data
+        n.__dict__.update(data)
+        n._mark_clean()
+
+        return n
+
+
+class _Rebind:
+    """Placeholder for a method bound to a packed neuron."""
+
+    __slots__ = ('func', )
+
+    def __init__(self, func):
+        self.func = func
+
+def _reduce_rows(values, offsets):
+    """Min and max of values for each block of rows. NaN for empty blocks."""
+    counts = np.diff(offsets)
+    has_rows = counts > 0
+    mn = np.full((len(counts), values.shape[1]), np.nan)
+    mx = np.full((len(counts), values.shape[1]), np.nan)
+    if has_rows.any():
+        starts = offsets[:-1][has_rows]
+        mn[has_rows] = np.minimum.reduceat(values, starts, axis=0)
+        mx[has_rows] = np.maximum.reduceat(values, starts, axis=0)
+    return mn, mx
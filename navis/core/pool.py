@@ -0,0 +1,298 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Worker pools used to apply functions across the neurons of a NeuronList.
+
+Starting a pool of worker processes is expensive compared to most per-neuron
+operations. By default pools are therefore kept alive after use and re-used
+by subsequent calls with the same backend and number of workers (see
+`navis.config.persistent_pools`). Pools are shut down when the Python
+session ends or via `shutdown_pools()`.
+
+Neurons are sent to the workers in chunks. Chunks are cut such that each
+contains about the same amount of work as estimated from the neurons' number
+of nodes, points, vertices or voxels (see `neuron_cost`).
+"""
+
+import atexit
+import contextlib
+import os
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Union
+
+from .. import config
+
+try:
+    # pathos' ProcessingPool apparently ignores chunksize
+    # (see https://stackoverflow.com/questions/55611806/how-to-set-chunk-size-when-using-pathos-processingpools-map)
+    import pathos
+    ProcessingPool = pathos.pools._ProcessPool
+except ImportError:
+    ProcessingPool = None
+
+__all__ = ['WorkerPool', 'get_pool', 'worker_pool', 'shutdown_pools',
+           'neuron_cost', 'make_chunks']
+
+logger = config.get_logger(__name__)
+
+#: Available backends
+BACKENDS = ('processes', 'threads')
+
+# Min estimated cost (nodes/points/vertices) of a chunk. Each chunk is one
+# round trip to a worker, so chunks should be large enough to amortise the
+# overhead of sending the neurons back and forth.
+MIN_CHUNK_COST = 1e4
+
+# Number of chunks to aim for per worker. More chunks = better load balancing
+# but also more overhead.
+CHUNKS_PER_WORKER = 4
+
+# Persistent pools: {(backend, n_workers): WorkerPool}
+_POOLS = {}
+
+
+class WorkerPool:
+    """Pool of worker processes or threads.
+
+    Parameters
+    ----------
+    n_workers :     int, optional
+                    Number of workers. Defaults to half the available cores.
+    backend :       "processes" | "threads"
+                    Use "threads" for functions that release the GIL (e.g.
+                    those running mostly in compiled code such as KD-tree
+                    queries or `navis-fastcore`). Threads avoid copying
+                    neurons but are limited by the GIL otherwise.
+
+    Examples
+    --------
+    >>> import navis
+    >>> from navis.core.pool import WorkerPool
+    >>> with WorkerPool(2, backend='threads') as pool:
+    ...     list(pool.imap(abs, [-1, -2, 3]))
+    [1, 2, 3]
+
+    """
+
+    def __init__(self,
+                 n_workers: Optional[int] = None,
+                 backend: str = 'processes'):
+        if backend not in BACKENDS:
+            raise ValueError(f'`backend` must be one of {BACKENDS}, got '
+                             f'"{backend}"')
+        if n_workers is None:
+            n_workers = os.cpu_count() // 2
+        self.n_workers = max(1, int(n_workers))
+        self.backend = backend
+        # Remember the process that started the pool: pools inherited by a
+        # forked child process must not be used
+        self.pid = os.getpid()
+
+        if backend == 'processes':
+            if not ProcessingPool:
+                raise ImportError('navis relies on pathos for multiprocessing!'
+                                  'Please install pathos and try again:\n'
+                                  '  pip3 install pathos -U')
+            self._pool = ProcessingPool(self.n_workers)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_workers)
+        self._closed = False
+
+    def __repr__(self):
+        state = 'closed' if not self.alive else 'alive'
+        return (f'<{type(self).__name__}({self.backend}, '
+                f'n_workers={self.n_workers}, {state})>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def alive(self) -> bool:
+        """Whether this pool can still be used."""
+        return not self._closed and self.pid == os.getpid()
+
+    def imap(self, func: Callable, iterable: Iterable) -> Iterator:
+        """Apply function to each item and yield results in order."""
+        if not self.alive:
+            raise ValueError('Pool has been closed')
+        if self.backend == 'processes':
+            return self._pool.imap(func, iterable, chunksize=1)
+        return self._pool.map(func, iterable)
+
+    def close(self, terminate: bool = False):
+        """Shut down the pool.
+
+        Parameters
+        ----------
+        terminate : bool
+                    If True, will stop workers immediately instead of waiting
+                    for running tasks to finish.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.pid != os.getpid():
+            # Pool belongs to the parent process
+            pass
+        elif self.backend == 'processes':
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+        else:
+            self._pool.shutdown(wait=not terminate, cancel_futures=terminate)
+
+        for k, v in list(_POOLS.items()):
+            if v is self:
+                _POOLS.pop(k)
+
+
+def resolve_backend(parallel: Union[bool, str]) -> Optional[str]:
+    """Turn `parallel` parameter into a backend (None if not parallel)."""
+    if isinstance(parallel, str):
+        if parallel not in BACKENDS:
+            raise ValueError(f'`parallel` must be True, False or one of '
+                             f'{BACKENDS}, got "{parallel}"')
+        return parallel
+    return config.parallel_backend if parallel else None
+
+
+def get_pool(n_workers: Optional[int] = None,
+             backend: str = 'processes') -> WorkerPool:
+    """Get persistent pool - starts a new one if necessary.
+
+    Parameters
+    ----------
+    n_workers :     int, optional
+                    Number of workers. Defaults to half the available cores.
+    backend :       "processes" | "threads"
+                    See `WorkerPool`.
+
+    Returns
+    -------
+    WorkerPool
+
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() // 2
+    key = (backend, max(1, int(n_workers)))
+
+    pool = _POOLS.get(key, None)
+    if pool is None or not pool.alive:
+        pool = _POOLS[key] = WorkerPool(*key[::-1])
+        logger.debug(f'Started {pool}')
+    return pool
+
+
+@contextlib.contextmanager
+def worker_pool(n_workers: Optional[int] = None,
+                backend: str = 'processes'):
+    """Context manager yielding a pool.
+
+    Uses persistent pools if `navis.config.persistent_pools` is True and a
+    new pool (which is shut down on exit) otherwise. Persistent pools are
+    terminated if an exception (e.g. a `KeyboardInterrupt`) occurs so that
+    the next call does not wait on tasks that are still running.
+    """
+    if config.persistent_pools:
+        pool = get_pool(n_workers, backend)
+    else:
+        pool = WorkerPool(n_workers, backend)
+
+    try:
+        yield pool
+    except BaseException:
+        pool.close(terminate=True)
+        raise
+
+    if not config.persistent_pools:
+        pool.close()
+
+
+def shutdown_pools():
+    """Shut down all persistent worker pools."""
+    for pool in list(_POOLS.values()):
+        pool.close()
+    _POOLS.clear()
+
+
+atexit.register(shutdown_pools)
+
+
+def neuron_cost(x) -> float:
+    """Estimate cost of processing a neuron.
+
+    Uses the number of nodes (skeletons), points (dotprops), vertices (meshes)
+    or voxels (voxel neurons). Everything else has a cost of 1.
+    """
+    for attr in ('n_nodes', 'n_points', 'n_vertices', 'n_voxels'):
+        cost = getattr(x, attr, None)
+        if isinstance(cost, (int, np.integer)):
+            return max(float(cost), 1.)
+    return 1.
+
+
+def make_chunks(costs: Sequence[float],
+                n_workers: int,
+                chunksize: Union[int, str] = 'auto',
+                min_cost: float = MIN_CHUNK_COST) -> List[np.ndarray]:
+    """Split items into contiguous chunks.
+
+    Parameters
+    ----------
+    costs :         list of float
+                    Estimated cost per item (see `neuron_cost`).
+    n_workers :     int
+                    Number of workers that will process the chunks.
+    chunksize :     "auto" | int
+                    If "auto", will cut chunks of about the same total cost
+                    (`CHUNKS_PER_WORKER` chunks per worker but at least
+                    `min_cost` per chunk). If int, will use chunks of that
+                    many items.
+    min_cost :      float
+                    Min total cost per chunk if `chunksize="auto"`.
+
+    Returns
+    -------
+    list of arrays
+                    Indices of the items in each chunk.
+
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    ix = np.arange(len(costs))
+    if not len(costs):
+        return []
+
+    if chunksize != 'auto':
+        chunksize = max(1, int(chunksize))
+        return [ix[i:i + chunksize] for i in range(0, len(ix), chunksize)]
+
+    cum = np.cumsum(costs)
+    total = cum[-1]
+    target = max(total / (max(1, n_workers) * CHUNKS_PER_WORKER), min_cost)
+    n_chunks = int(min(len(costs), np.ceil(total / target)))
+
+    # Cut where the cumulative cost crosses multiples of the target
+    bounds = np.searchsorted(cum, np.arange(1, n_chunks) * total / n_chunks,
+                             side='right')
+    bounds = np.unique(bounds[(bounds > 0) & (bounds < len(costs))])
+
+    return np.split(ix, bounds)
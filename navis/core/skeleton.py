@@ -33,6 +33,7 @@ from .. import io  # type: ignore # double import
 
 from .base import BaseNeuron
 from .core_utils import temp_property
+from .node_arrays import NodeArrays
 
 try:
     import xxhash
@@ -55,6 +56,9 @@ def requires_nodes(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         self = args[0]
+        # Compact node arrays are always valid
+        if '_node_arrays' in self.__dict__:
+            return func(*args, **kwargs)
         # Return 0
         if isinstance(self.nodes, str) and self.nodes == 'NA':
             return 'NA'
@@ -82,6 +86,9 @@ class TreeNeuron(BaseNeuron):
                      - `skeletor.Skeleton`
                      - `TreeNeuron` - in this case we will try to copy every
                        attribute
+                     - `navis.core.NodeArrays` - compact node
+                       storage; the node table is only generated when
+                       `.nodes` is first accessed
     units :         str | pint.Units | pint.Quantity
                     Units for coordinates. Defaults to `None` (dimensionless).
                     Strings must be parsable by pint: e.g. "nm", "um",
@@ -154,6 +161,8 @@ class TreeNeuron(BaseNeuron):
 
         if isinstance(x, pd.DataFrame):
             self.nodes = x
+        elif isinstance(x, NodeArrays):
+            self._node_arrays = x
         elif isinstance(x, pd.Series):
             if not hasattr(x, 'nodes'):
                 raise ValueError('pandas.Series must have `nodes` entry.')
@@ -190,7 +199,7 @@ class TreeNeuron(BaseNeuron):
                 raise AttributeError(f"Unable to set neuron's `{k}` attribute.")
 
         self.units = units
-        self._current_md5 = self.core_md5
+        self._mark_clean()
 
         self._lock = 0
 
@@ -200,9 +209,54 @@ class TreeNeuron(BaseNeuron):
         # if a @property raises an Exception, Python falls back to __getattr__
         # and traceback is lost!
 
+        # Generate node table from compact node arrays on first access
+        if '_node_arrays' in self.__dict__:
+            if key == '_nodes':
+                return self._materialize_nodes()
+            elif key == 'n_nodes':
+                return len(self.__dict__['_node_arrays'])
+
         # Last ditch effort - maybe the base class knows the key?
         return super().__getattr__(key)
 
+    def __setattr__(self, key, value):
+        """Set attribute."""
+        # A new node table supersedes compact node arrays
+        if key == '_nodes':
+            self.__dict__.pop('_node_arrays', None)
+        super().__setattr__(key, value)
+
+    def _materialize_nodes(self) -> pd.DataFrame:
+        """Replace compact node arrays with a node table."""
+        # The data does not change, so we bypass __setattr__ to not mark
+        # the neuron as modified
+        nodes = self.__dict__.pop('_node_arrays').to_dataframe()
+        self.__dict__['_nodes'] = nodes
+        return nodes
+
+    def _node_values(self, col: Union[str, List[str]]) -> np.ndarray:
+        """Values of node table column(s) without generating the node table."""
+        arrays = self.__dict__.get('_node_arrays')
+        if arrays is None:
+            return self.nodes[col].values
+        elif isinstance(col, str):
+            return arrays.column(col)
+        return arrays.values(col)
+
+    def _has_node_column(self, col: str) -> bool:
+        """Whether node table has given column."""
+        arrays = self.__dict__.get('_node_arrays')
+        if arrays is None:
+            return col in self.nodes.columns
+        return col in arrays.columns
+
+    def _get_core_data(self, prop, cols=None):
+        """Get core data as contiguous array (used for hashing)."""
+        arrays = self.__dict__.get('_node_arrays')
+        if prop == 'nodes' and arrays is not None:
+            return arrays.values(cols)
+        return super()._get_core_data(prop, cols)
+
     def __truediv__(self, other, copy=True):
         """Implement division for coordinates (nodes, connectors)."""
         if isinstance(other, numbers.Number) or utils.is_iterable(other):
@@ -217,7 +271,8 @@ class TreeNeuron(BaseNeuron):
 
             # If a number, consider this an offset for coordinates
             n = self.copy() if copy else self
-            n.nodes[['x', 'y', 'z', 'radius']] /= other
+            cols = [c for c in ('x', 'y', 'z', 'radius') if c in n.nodes.columns]
+            n.nodes[cols] /= other[:len(cols)] if utils.is_iterable(other) else other
 
             # At this point we can ditch any 4th unit
             if utils.is_iterable(other):
@@ -254,7 +309,8 @@ class TreeNeuron(BaseNeuron):
 
             # If a number, consider this an offset for coordinates
             n = self.copy() if copy else self
-            n.nodes[['x', 'y', 'z', 'radius']] *= other
+            cols = [c for c in ('x', 'y', 'z', 'radius') if c in n.nodes.columns]
+            n.nodes[cols] *= other[:len(cols)] if utils.is_iterable(other) else other
 
             # At this point we can ditch any 4th unit
             if utils.is_iterable(other):
@@ -526,11 +582,11 @@ class TreeNeuron(BaseNeuron):
         elif utils.is_iterable(soma):
             if all(pd.isnull(soma)):
                 soma = None
-            elif not any(self.nodes.node_id.isin(soma)):
+            elif not np.isin(self._node_values('node_id'), soma).any():
                 logger.warning(f'Soma(s) {soma} not found in node table.')
                 soma = None
         else:
-            if soma not in self.nodes.node_id.values:
+            if soma not in self._node_values('node_id'):
                 logger.warning(f'Soma {soma} not found in node table.')
                 soma = None
 
@@ -546,7 +602,7 @@ class TreeNeuron(BaseNeuron):
         elif isinstance(value, bool) and not value:
             self._soma = None
         else:
-            if value in self.nodes.node_id.values:
+            if value in self._node_values('node_id'):
                 self._soma = value
             else:
                 raise ValueError('Soma must be function, None or a valid node ID.')
@@ -597,6 +653,8 @@ class TreeNeuron(BaseNeuron):
     @requires_nodes
     def root(self) -> Sequence:
         """Root node(s)."""
+        if '_node_arrays' in self.__dict__:
+            return self._node_arrays.roots
         roots = self.nodes[self.nodes.parent_id < 0].node_id.values
         return roots
 
@@ -614,12 +672,16 @@ class TreeNeuron(BaseNeuron):
     @requires_nodes
     def n_branches(self) -> Optional[int]:
         """Number of branch points."""
+        if '_node_arrays' in self.__dict__:
+            return self._node_arrays.count_type('branch')
         return self.nodes[self.nodes.type == 'branch'].shape[0]
 
     @property
     @requires_nodes
     def n_leafs(self) -> Optional[int]:
         """Number of leaf nodes."""
+        if '_node_arrays' in self.__dict__:
+            return self._node_arrays.count_type('end')
         return self.nodes[self.nodes.type == 'end'].shape[0]
 
     @property
@@ -685,8 +747,9 @@ class TreeNeuron(BaseNeuron):
     @property
     def bbox(self) -> np.ndarray:
         """Bounding box (includes connectors)."""
-        mn = np.min(self.nodes[['x', 'y', 'z']].values, axis=0)
-        mx = np.max(self.nodes[['x', 'y', 'z']].values, axis=0)
+        xyz = self._node_values(['x', 'y', 'z'])
+        mn = np.min(xyz, axis=0)
+        mx = np.max(xyz, axis=0)
 
         if self.has_connectors:
             cn_mn = np.min(self.connectors[['x', 'y', 'z']].values, axis=0)
@@ -217,6 +217,7 @@ def merge_duplicate_nodes(x, round=False, inplace=False):
 
         # Rewire kept nodes
         x.nodes['parent_id'] = x.nodes.node_id.map(lambda x: new_parents.get(x, -1))
+        x.mark_modified()
 
         # Reset temporary attributes
         x._clear_temp_attr()
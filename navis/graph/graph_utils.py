@@ -104,9 +104,13 @@ def _generate_segments(
                 root_dist=0,
             )
 
-        return utils.fastcore.generate_segments(
+        segs = utils.fastcore.generate_segments(
             x.nodes.node_id.values, x.nodes.parent_id.values, weights=weight
         )
+        # More recent versions of fastcore also return the segments' lengths
+        if isinstance(segs, tuple):
+            segs = segs[0]
+        return segs
 
     d = dist_to_root(x, igraph_indices=False, weight=weight)
     endNodeIDs = x.nodes[x.nodes.type == "end"].node_id.values
@@ -1579,6 +1583,9 @@ def reroot_skeleton(
     if x.nodes.node_id.dtype != nodeid_dtype:
         x.nodes["node_id"] = x.nodes.node_id.astype(nodeid_dtype, copy=False)
 
+    # Node table was modified in place
+    x.mark_modified()
+
     # Finally: only reset non-graph related attributes
     if x.igraph and config.use_igraph:
         x._clear_temp_attr(exclude=["igraph", "classify_nodes"])
@@ -1803,6 +1810,7 @@ def _cut_networkx(
         # Change new root for dist
         dist.nodes.loc[dist.nodes.node_id == cut_node, "parent_id"] = -1
         dist.nodes.loc[dist.nodes.node_id == cut_node, "type"] = "root"
+        dist.mark_modified()
 
         # Reassign graphs
         dist._graph_nx = dist_graph
@@ -2269,6 +2277,7 @@ def remove_nodes(
 
     # Rewire neuron
     x.nodes["parent_id"] = x.nodes.node_id.map(lop)
+    x.mark_modified()
 
     # Drop nodes
     x.nodes = x.nodes[~x.nodes.node_id.isin(which)].copy()
@@ -2354,6 +2363,7 @@ def rewire_skeleton(
 
     # Update parent IDs
     x.nodes["parent_id"] = x.nodes.node_id.map(lambda x: lop.get(x, -1))
+    x.mark_modified()
 
     x._clear_temp_attr()
 
@@ -282,6 +282,7 @@ def fetch_mesh_neuron(x, *, lod=1, with_synapses=False, missing_mesh='raise',
         # Meshes come out in units (e.g. nanometers) but most other data (synapses,
         # skeletons, etc) come out in voxels, we will therefore scale meshes to voxels
         n.vertices /= np.array(client.meta['voxelSize']).reshape(1, 3)
+        n.mark_modified()
         n.units=f'{client.meta["voxelSize"][0]} {client.meta["voxelUnits"]}'
 
         if n.somaLocation:
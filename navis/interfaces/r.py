@@ -1149,6 +1149,7 @@ def xform_brain(x: Union['core.NeuronObject', 'pd.DataFrame', 'np.ndarray'],
                         # Fix radius based on our best estimate
                         if 'radius' in n.nodes.columns:
                             n.nodes['radius'] *= 10**magnitude
+                        n.mark_modified()
                     elif isinstance(n, core.Dotprops):
                         n.points = xyz_xf[offset:offset + n.points.shape[0]]
                         # Set tangent vectors and alpha to None so they will be regenerated
@@ -1179,7 +1180,7 @@ def xform_brain(x: Union['core.NeuronObject', 'pd.DataFrame', 'np.ndarray'],
                                       fallback=fallback,
                                       verbose=verbose,
                                       **kwargs))
-            return x.__class__(xf)
+            return x._constructor(xf)
 
     if not isinstance(x, (core.BaseNeuron, np.ndarray, pd.DataFrame, core.Volume)):
         raise TypeError(f'Unable to transform data of type "{type(x)}"')
@@ -1218,6 +1219,7 @@ def xform_brain(x: Union['core.NeuronObject', 'pd.DataFrame', 'np.ndarray'],
             # Fix radius based on our best estimate
             if 'radius' in xf.nodes.columns:
                 xf.nodes['radius'] *= 10**magnitude
+            xf.mark_modified()
         elif isinstance(xf, core.Dotprops):
             xf.points = xyz_xf[:xf.points.shape[0]]
             # Set tangent vectors and alpha to None so they will be regenerated
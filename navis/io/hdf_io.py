@@ -14,6 +14,7 @@
 import h5py
 import os
 import pickle
+import re
 import pint
 import warnings
 
@@ -296,7 +297,8 @@ class H5ReaderV1(BaseH5Reader):
 
         return parsed_an
 
-    def read_treeneuron(self, id, strict=False, prefer_raw=False, **kwargs):
+    def read_treeneuron(self, id, strict=False, prefer_raw=False,
+                        compact=False, **kwargs):
         """Read given TreeNeuron from file."""
         # Get the group for this neuron
         neuron_grp = self.f[id]
@@ -315,6 +317,9 @@ class H5ReaderV1(BaseH5Reader):
                                             'x', 'y', 'z',
                                             'radius'] if strict else None)
 
+        if compact:
+            nodes = core.NodeArrays.from_dataframe(nodes)
+
         n = core.TreeNeuron(nodes, id=id)
 
         # Check if we have units
@@ -337,7 +342,9 @@ class H5ReaderV1(BaseH5Reader):
         dp_grp = neuron_grp['dotprops']
 
         if '.serialized_navis' in dp_grp and not prefer_raw:
-            return pickle.loads(dp_grp['.serialized_navis'][()])
+            n = pickle.loads(dp_grp['.serialized_navis'][()])
+            self.parse_add_kdtree(dp_grp, n)
+            return n
 
         # Parse dotprop arrays
         points = dp_grp['points']
@@ -365,8 +372,27 @@ class H5ReaderV1(BaseH5Reader):
             self.parse_add_datasets(dp_grp, n,
                                     exclude=['points', 'vect', 'alpha'])
 
+        # Restore KD-tree and self-hits
+        self.parse_add_kdtree(dp_grp, n)
+
         return n
 
+    def parse_add_kdtree(self, grp, neuron):
+        """Restore serialized KD-tree and NBLAST self-hits for Dotprops."""
+        if '.kdtree_buffer' in grp:
+            buffer = grp['.kdtree_buffer']
+            tree = core.dotprop._kdtree_from_arrays(neuron.points,
+                                       buffer[()],
+                                       grp['.kdtree_indices'][()],
+                                       buffer.attrs['leafsize'],
+                                       buffer.attrs.get('format', None),
+                                       buffer.attrs.get('checksum', None))
+            if tree is not None:
+                neuron._tree = tree
+
+        if '.self_hits' in grp:
+            neuron._self_hits = {k: float(v) for k, v in grp['.self_hits'].attrs.items()}
+
     def read_meshneuron(self, id, strict=False, prefer_raw=False, **kwargs):
         """Read given MeshNeuron from file."""
         # Get the group for this neuron
@@ -519,7 +545,8 @@ class H5WriterV1(BaseH5Writer):
             for n in config.tqdm(neuron, desc='Writing',
                                  leave=False,
                                  disable=config.pbar_hide):
-                self.write_neurons(n, overwrite=overwrite,
+                self.write_neurons(n, serialized=serialized, raw=raw,
+                                   overwrite=overwrite,
                                    annotations=annotations, **kwargs)
             return
 
@@ -612,7 +639,8 @@ class H5WriterV1(BaseH5Writer):
 
     def write_dotprops(self, neuron,
                        serialized=True, raw=False,
-                       overwrite=True, **kwargs):
+                       overwrite=True, kdtree=False,
+                       self_hits=None, **kwargs):
         """Write Dotprops to file."""
         assert isinstance(neuron, core.Dotprops)
 
@@ -650,6 +678,22 @@ class H5WriterV1(BaseH5Writer):
                 data = getattr(neuron, d)
                 dp_grp.create_dataset(d, data=data, compression='gzip')
 
+        # These are "hidden" datasets and hence ignored by other readers
+        if kdtree:
+            tree = core.dotprop._kdtree_to_arrays(neuron)
+            if tree is not None:
+                buffer = dp_grp.create_dataset('.kdtree_buffer', data=tree['buffer'])
+                buffer.attrs['leafsize'] = tree['leafsize']
+                buffer.attrs['format'] = tree['format']
+                buffer.attrs['checksum'] = tree['checksum']
+                dp_grp.create_dataset('.kdtree_indices', data=tree['indices'])
+
+        if self_hits:
+            from ..nbl.nblast_funcs import calc_self_hits
+            sh_grp = dp_grp.require_group('.self_hits')
+            for k, v in calc_self_hits(neuron, self_hits).items():
+                sh_grp.attrs[k] = v
+
     def write_meshneuron(self, neuron,
                          serialized=True, raw=False,
                          overwrite=True, **kwargs):
@@ -698,7 +742,9 @@ def read_h5(filepath: str,
             reader='auto',
             on_error='stop',
             ret_errors=False,
-            parallel='auto') -> 'core.NeuronObject':
+            parallel='auto',
+            compact=False,
+            lazy=False) -> 'core.NeuronObject':
     """Read Neuron/List from Hdf5 file.
 
     This import is following the schema specified
@@ -750,6 +796,15 @@ def read_h5(filepath: str,
     ret_errors :        bool
                         If True, will also return a list of errors encountered
                         while parsing the neurons.
+    lazy :              bool | int
+                        If True, will return a `navis.core.LazyNeuronList`
+                        which only loads neurons when they are accessed. Its
+                        summary (type, name, number of nodes, etc.) is
+                        generated without reading any neurons. Integer will
+                        be interpreted as the maximum number of loaded neurons
+                        to keep in memory (otherwise defaults to 100). Does not
+                        work with multiple representations per neuron (e.g.
+                        `read='mesh,skeleton'`).
 
     Only relevant for raw data:
 
@@ -777,14 +832,18 @@ def read_h5(filepath: str,
                         the HDF5 file. You can also directly provide a subclass
                         of BaseH5Reader that is capable of reading neurons from
                         the file.
+    compact :           bool
+                        If True, skeletons will store their nodes as compact
+                        arrays (see `navis.core.NodeArrays`) and generate the
+                        node table only when `.nodes` is first accessed.
 
     Returns
     -------
-    neurons :           navis.NeuronList
+    neurons :           navis.NeuronList | navis.core.LazyNeuronList
 
     errors :            dict
                         If `ret_errors=True` return dictionary with errors:
-                        `{id: "error"}`.
+                        `{id: "error"}`. Always empty if `lazy=True`.
 
     Examples
     --------
@@ -827,6 +886,33 @@ def read_h5(filepath: str,
         raise TypeError('If provided, the reader must be a subclass of '
                         f'BaseH5Reader - got "{type(reader)}"')
 
+    if lazy:
+        if ',' in read:
+            raise ValueError('`lazy=True` requires a single representation per '
+                             f'neuron but `read="{read}"`')
+        ids = list(info['neurons'])
+        if isinstance(subset, slice):
+            ids = ids[subset]
+        elif not isinstance(subset, type(None)):
+            subset = set(utils.make_iterable(subset).astype(str))
+            ids = [i for i in ids if i in subset]
+
+        summary = _h5_lazy_summary(filepath, ids, read, prefer_raw=prefer_raw)
+        loader = _H5Loader(reader, filepath,
+                           read=read,
+                           strict=strict,
+                           prefer_raw=prefer_raw,
+                           on_error=on_error,
+                           annotations=annotations,
+                           compact=compact)
+        nl = core.LazyNeuronList(summary['id'].values,
+                                 loader=loader,
+                                 metadata=summary,
+                                 **({} if lazy is True else {'cache_size': int(lazy)}))
+        if ret_errors:
+            return nl, {}
+        return nl
+
     # By default only use parallel if there are more than 200 neurons
     if parallel == 'auto':
         if len(info['neurons']) > 200:
@@ -840,8 +926,10 @@ def read_h5(filepath: str,
             nl, errors = r.read_neurons(subset=subset,
                                         read=read,
                                         strict=strict,
+                                        prefer_raw=prefer_raw,
                                         on_error=on_error,
-                                        annotations=annotations)
+                                        annotations=annotations,
+                                        compact=compact)
     else:
         # Do not swap this as `isinstance(True, int)` returns `True`
         if isinstance(parallel, (bool, str)):
@@ -871,6 +959,7 @@ def read_h5(filepath: str,
                                                          prefer_raw=prefer_raw,
                                                          on_error=on_error,
                                                          annotations=annotations,
+                                                         compact=compact,
                                                          subset=[x]) for x in subset],
                                 chunksize=1)
 
@@ -908,6 +997,7 @@ def _h5_reader_worker(kwargs):
     strict = kwargs['strict']
     on_error = kwargs['on_error']
     prefer_raw = kwargs['prefer_raw']
+    compact = kwargs['compact']
     # This opens the file
     with reader(filepath) as r:
         return r.read_neurons(subset=subset,
@@ -916,7 +1006,67 @@ def _h5_reader_worker(kwargs):
                               on_error=on_error,
                               prefer_raw=prefer_raw,
                               progress=False,
-                              annotations=annotations)
+                              annotations=annotations,
+                              compact=compact)
+
+
+class _H5Loader:
+    """Read given neurons from H5 file (used by lazy NeuronLists)."""
+
+    def __init__(self, reader, filepath, **kwargs):
+        self.reader = reader
+        self.filepath = filepath
+        self.kwargs = kwargs
+
+    def __call__(self, ids):
+        with self.reader(self.filepath) as r:
+            neurons, _ = r.read_neurons(subset=[str(i) for i in ids],
+                                        progress=False,
+                                        **self.kwargs)
+        return neurons
+
+
+def _h5_lazy_summary(filepath, ids, read, prefer_raw=False):
+    """Summarize neurons in H5 file without reading their data."""
+    types = {'skeleton': 'navis.TreeNeuron',
+             'mesh': 'navis.MeshNeuron',
+             'dotprops': 'navis.Dotprops'}
+    # Counts we can get from the shape of the datasets
+    counts = {'skeleton': {'n_nodes': 'node_id'},
+              'mesh': {'n_vertices': 'vertices', 'n_faces': 'faces'},
+              'dotprops': {'n_points': 'points'}}
+    priorities = [p.strip() for p in read.split('->')]
+
+    records = []
+    with h5py.File(filepath, 'r') as f:
+        for id in ids:
+            grp = f[id]
+            # Find the representation that would be read
+            rep = [p for p in priorities if p in grp]
+            if not rep:
+                continue
+            rep = rep[0]
+
+            # Neurons read from the raw data use the group name as ID while
+            # serialized neurons keep their original ID. `write_h5` names
+            # groups via `str(neuron.id)`, i.e. numerical group names were
+            # integer IDs
+            if (not prefer_raw and '.serialized_navis' in grp[rep]
+                    and re.fullmatch('-?[0-9]+', id)):
+                id = int(id)
+
+            this = {'type': types[rep],
+                    'name': grp.attrs.get('neuron_name', None),
+                    'id': id}
+            for prop, ds in counts[rep].items():
+                if ds in grp[rep]:
+                    this[prop] = grp[rep][ds].shape[0]
+            records.append(this)
+
+    summary = pd.DataFrame.from_records(records, columns=None if records else ['type', 'name', 'id'])
+    if len(summary) and all(isinstance(i, int) for i in summary['id']):
+        summary['id'] = summary['id'].astype(np.int64)
+    return summary
 
 
 def write_h5(n: 'core.NeuronObject',
@@ -926,7 +1076,9 @@ def write_h5(n: 'core.NeuronObject',
              annotations: Optional[Union[str, list]] = None,
              format: str = 'latest',
              append: bool = True,
-             overwrite_neurons: bool = False) -> 'core.NeuronObject':
+             overwrite_neurons: bool = False,
+             kdtree: bool = False,
+             self_hits: Optional[Union[bool, dict, list]] = None) -> 'core.NeuronObject':
     """Write Neuron/List to Hdf5 file.
 
     Parameters
@@ -950,6 +1102,21 @@ def write_h5(n: 'core.NeuronObject',
     overwrite_neurons : bool
                         If a given neuron already exists in the h5 file whether
                         to overwrite it or throw an exception.
+    kdtree :            bool
+                        Dotprops only: if True, will also write a serialized
+                        KD-tree for each neuron which is restored by
+                        [`navis.read_h5`][]. This is faster than building the
+                        tree from scratch but note that restored trees are
+                        `scipy.spatial.cKDTree` which can be somewhat slower
+                        to query than the `pykdtree` trees used otherwise.
+                        NBLAST scores can also differ slightly (in the order
+                        of 1e-4) from those obtained with `pykdtree`.
+    self_hits :         True | dict | list of dicts, optional
+                        Dotprops only: scoring configuration(s) (keyword
+                        arguments for `navis.nbl.nblast_funcs.NBlaster`, e.g.
+                        `{'use_alpha': True}`) for which to calculate and
+                        store the NBLAST self-hits. If True, will use the
+                        default configuration.
 
     Only relevant if `raw=True`:
 
@@ -1005,7 +1172,9 @@ def write_h5(n: 'core.NeuronObject',
                         raw=raw,
                         serialized=serialized,
                         overwrite=overwrite_neurons,
-                        annotations=annotations)
+                        annotations=annotations,
+                        kdtree=kdtree,
+                        self_hits=self_hits)
 
 
 def inspect_h5(filepath, inspect_neurons=True, inspect_annotations=True):
@@ -10,6 +10,8 @@
 #    but WITHOUT ANY WARRANTY; without even the implied warranty of
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
 #    GNU General Public License for more details.
+import json
+
 import pandas as pd
 import numpy as np
 
@@ -83,6 +85,10 @@ def scan_parquet(file: Union[str, Path]):
 
         id, prop = k.split(':')
 
+        # Skip "private" properties such as serialized KD-trees
+        if prop.startswith('_'):
+            continue
+
         if id not in records:  # there might be an "ARROW:schema" entry
             continue
 
@@ -103,7 +109,8 @@ def read_parquet(f: Union[str, Path],
                  read_meta: bool = True,
                  limit: Optional[int] = None,
                  subset: Optional[List[Union[str, int]]] = None,
-                 progress=True
+                 progress=True,
+                 lazy: Union[bool, int] = False
                  ) -> 'core.NeuronObject':
     """Read parquet file into Neuron/List.
 
@@ -128,13 +135,26 @@ def read_parquet(f: Union[str, Path],
                         use this to select the IDs of the neurons to load. Only
                         works if the parquet file actually contains multiple
                         neurons.
+    lazy :              bool | int
+                        If True, will return a `navis.core.LazyNeuronList`
+                        which only loads neurons when they are accessed. Its
+                        summary is generated from the meta data (see
+                        [`navis.scan_parquet`][]) without reading any neurons.
+                        Integer will be interpreted as the maximum number of
+                        loaded neurons to keep in memory (otherwise defaults
+                        to 100). Only works if the parquet file contains
+                        multiple neurons.
 
     Returns
     -------
     navis.TreeNeuron/Dotprops
-                        If parquet file contains a single neuron.
+                        If parquet file contains a single neuron. KD-trees and
+                        self-hits stored with dotprops (see
+                        [`navis.write_parquet`][]) are restored.
     navis.NeuronList
                         If parquet file contains multiple neurons.
+    navis.core.LazyNeuronList
+                        If `lazy=True`.
 
     See Also
     --------
@@ -168,6 +188,10 @@ def read_parquet(f: Union[str, Path],
     if isinstance(subset, (pd.Series)):
         subset = subset.values
 
+    if lazy:
+        return _read_parquet_lazy(f, read_meta=read_meta, subset=subset,
+                                  cache_size=None if lazy is True else int(lazy))
+
     # Read the table
     if subset is None or subset is False:
         table = pq.read_table(f)
@@ -221,6 +245,63 @@ def read_parquet(f: Union[str, Path],
         return core.NeuronList(neurons)
 
 
+def _read_parquet_lazy(f, read_meta, subset, cache_size):
+    """Generate a lazy NeuronList for given parquet file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(f)
+    if 'neuron' not in schema.names:
+        raise ValueError('`lazy=True` requires a parquet file containing '
+                         'multiple neurons')
+
+    # Get IDs and summary from the meta data if possible
+    try:
+        summary = scan_parquet(f) if read_meta else None
+    except KeyError:  # no meta data
+        summary = None
+    if summary is None:
+        ids = pq.read_table(f, columns=['neuron'])['neuron'].unique()
+        summary = pd.DataFrame({'id': ids.to_numpy(zero_copy_only=False)})
+    elif pa.types.is_integer(schema.field('neuron').type):
+        # IDs in meta data are strings
+        summary['id'] = summary['id'].astype(np.int64)
+
+    # Same order as `read_parquet` which groups by neuron ID
+    summary = summary.sort_values('id', kind='stable').reset_index(drop=True)
+
+    if 'node_id' in schema.names:
+        summary.insert(0, 'type', 'navis.TreeNeuron')
+    else:
+        summary.insert(0, 'type', 'navis.Dotprops')
+    if 'name' in summary.columns:
+        summary.insert(1, 'name', summary.pop('name'))
+
+    if subset is not None and subset is not False:
+        subset = set(str(i) for i in np.asarray(subset).ravel())
+        summary = summary[summary['id'].astype(str).isin(subset)]
+
+    kwargs = {} if cache_size is None else {'cache_size': cache_size}
+    return core.LazyNeuronList(summary['id'].values,
+                               loader=_ParquetLoader(f, read_meta),
+                               metadata=summary,
+                               **kwargs)
+
+
+class _ParquetLoader:
+    """Read given neurons from parquet file (used by lazy NeuronLists)."""
+
+    def __init__(self, f, read_meta):
+        self.f = f
+        self.read_meta = read_meta
+
+    def __call__(self, ids):
+        return read_parquet(self.f,
+                            read_meta=self.read_meta,
+                            subset=np.asarray(ids).tolist(),
+                            progress=False)
+
+
 def _extract_skeleton(nodes, id, metadata):
     """Extract a single skeleton."""
     # Meta data is encoded as "{ID}_{PROPERTY}"
@@ -262,6 +343,12 @@ def _extract_dotprops(table, id, metadata):
     # Drop "Nones"
     this_meta = {k: v for k, v in this_meta.items() if v != "None"}
 
+    # Pop serialized KD-tree and self-hits
+    leafsize = this_meta.pop('_kdtree_leafsize', None)
+    kdtree_format = this_meta.pop('_kdtree_format', None)
+    kdtree_checksum = this_meta.pop('_kdtree_checksum', None)
+    self_hits = this_meta.pop('_self_hits', None)
+
     # Make the neuron
     this_meta['id'] = id
     this_meta['k'] = this_meta.get('k', 5)  # <- set a default K of 5
@@ -271,9 +358,24 @@ def _extract_dotprops(table, id, metadata):
     if 'alpha' in table:
         this_meta['alpha'] = table['alpha'].values
 
-    return core.Dotprops(table[['x', 'y', 'z']].values,
+    dp = core.Dotprops(table[['x', 'y', 'z']].values,
                        **this_meta)
 
+    if leafsize is not None and '_kdtree' in table and len(table):
+        tree = core.dotprop._kdtree_from_arrays(dp.points,
+                                   np.frombuffer(table['_kdtree'].values[0], dtype=np.uint8),
+                                   table['kdtree_ix'].values,
+                                   leafsize,
+                                   kdtree_format,
+                                   kdtree_checksum)
+        if tree is not None:
+            dp._tree = tree
+
+    if self_hits:
+        dp._self_hits = json.loads(self_hits)
+
+    return dp
+
 
 def _try_int(x):
     """Try converting `x` into an integer."""
@@ -295,7 +397,9 @@ def _bytes_to_int(x):
 
 def write_parquet(x: 'core.NeuronObject',
                   filepath: Union[str, Path],
-                  write_meta: bool = True) -> None:
+                  write_meta: bool = True,
+                  kdtree: bool = False,
+                  self_hits: Optional[Union[bool, dict, List[dict]]] = None) -> None:
     """Write TreeNeuron(s) or Dotprops to parquet file.
 
     See [here](https://github.com/navis-org/navis/blob/master/navis/io/pq_io.md)
@@ -313,6 +417,21 @@ def write_parquet(x: 'core.NeuronObject',
                         default this is `.name`, `.units` and `.soma`. You can
                         change which properties are written by providing them as
                         list of strings.
+    kdtree :            bool
+                        Dotprops only: if True, will also write a serialized
+                        KD-tree for each neuron which is restored when reading
+                        the file back in. This is faster than building the
+                        tree from scratch but note that restored trees are
+                        `scipy.spatial.cKDTree` which can be somewhat slower
+                        to query than the `pykdtree` trees used otherwise.
+                        NBLAST scores can also differ slightly (in the order
+                        of 1e-4) from those obtained with `pykdtree`.
+    self_hits :         True | dict | list of dicts, optional
+                        Dotprops only: scoring configuration(s) (keyword
+                        arguments for `navis.nbl.nblast_funcs.NBlaster`, e.g.
+                        `{'use_alpha': True}`) for which to calculate and
+                        store the NBLAST self-hits. If True, will use the
+                        default configuration.
 
     See Also
     --------
@@ -370,6 +489,12 @@ def write_parquet(x: 'core.NeuronObject',
             raise TypeError('Can only write TreeNeurons or Dotprops to parquet, '
                             f'got "{type(x)}"')
 
+    if _write_parquet is _write_parquet_dotprops:
+        return _write_parquet(x, filepath=filepath, write_meta=write_meta,
+                              kdtree=kdtree, self_hits=self_hits)
+    elif kdtree or self_hits:
+        raise ValueError('`kdtree` and `self_hits` are only supported for Dotprops')
+
     return _write_parquet(x, filepath=filepath, write_meta=write_meta)
 
 
@@ -407,6 +532,8 @@ def _write_parquet_skeletons(x: 'core.TreeNeuron',
 def _write_parquet_dotprops(x: 'core.Dotprops',
                             filepath: Union[str, Path],
                             write_meta: bool = True,
+                            kdtree: bool = False,
+                            self_hits=None,
                             ) -> None:
     """Write Dotprops to parquet file.
 
@@ -422,6 +549,11 @@ def _write_parquet_dotprops(x: 'core.Dotprops',
     >>> assert len(dp) == len(dp2)
     >>> assert all([i in dp2.id for i in dp.id])
 
+    Write KD-trees and self-hits along with the dotprops
+
+    >>> navis.write_parquet(dp, tmp_dir / 'dotprops.parquet', kdtree=True, self_hits=True)
+    >>> dp2 = navis.read_parquet(tmp_dir / 'dotprops.parquet')
+
     """
     try:
         import pyarrow as pa
@@ -449,12 +581,33 @@ def _write_parquet_dotprops(x: 'core.Dotprops',
     # Add neuron ID
     table['neuron'] = np.repeat(x.id, x.n_points)
 
-    # Convert to pyarrow table
-    table = pa.Table.from_pandas(table)
-
     # Compile metadata
     metadata = _compile_meta(x, write_meta=write_meta)
 
+    if kdtree:
+        # Order of points in the tree goes into a column, the tree's node
+        # buffer into the first row of each neuron
+        trees = [core.dotprop._kdtree_to_arrays(n) if n.n_points else None for n in x]
+        table['kdtree_ix'] = np.concatenate([t['indices'] if t else np.full(n.n_points, -1)
+                                             for n, t in zip(x, trees)] + [[]]).astype(np.int64)
+        buffers = np.full(len(table), None, dtype=object)
+        first = np.cumsum(np.append(0, x.n_points[:-1]))
+        for n, t, i in zip(x, trees, first):
+            if t:
+                buffers[i] = t['buffer'].tobytes()
+                metadata[f'{n.id}:_kdtree_leafsize'] = str(t['leafsize'])
+                metadata[f'{n.id}:_kdtree_format'] = t['format']
+                metadata[f'{n.id}:_kdtree_checksum'] = t['checksum']
+        table['_kdtree'] = buffers
+
+    if self_hits:
+        from ..nbl.nblast_funcs import calc_self_hits
+        for n in x:
+            metadata[f'{n.id}:_self_hits'] = json.dumps(calc_self_hits(n, self_hits))
+
+    # Convert to pyarrow table
+    table = pa.Table.from_pandas(table)
+
     # Generate a schema with the new meta data
     schema = pa.schema([table.schema.field(i) for i in range(len(table.schema))],
                        metadata=metadata)
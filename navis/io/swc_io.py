@@ -16,6 +16,7 @@ import datetime
 import io
 import json
 
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
@@ -55,7 +56,8 @@ class SwcReader(base.BaseReader):
         precision: int = DEFAULT_PRECISION,
         read_meta: bool = False,
         fmt: str = DEFAULT_FMT,
-        attrs: Optional[Dict[str, Any]] = None
+        attrs: Optional[Dict[str, Any]] = None,
+        compact: bool = False
     ):
         if not fmt.endswith('.swc'):
             raise ValueError('`fmt` must end with ".swc"')
@@ -68,6 +70,7 @@ class SwcReader(base.BaseReader):
         self.soma_label = soma_label
         self.delimiter = delimiter
         self.read_meta = read_meta
+        self.compact = compact
 
         int_, float_ = base.parse_precision(precision)
         self._dtypes = {
@@ -145,16 +148,20 @@ class SwcReader(base.BaseReader):
         -------
         core.TreeNeuron
         """
-        n = core.TreeNeuron(
-            sanitise_nodes(
+        if self.compact:
+            sanitised = self._compact_nodes(nodes)
+        else:
+            sanitised = sanitise_nodes(
                 nodes.astype(self._dtypes, errors='ignore', copy=False)
-            ),
-            connectors=self._extract_connectors(nodes))
+            )
+
+        n = core.TreeNeuron(sanitised,
+                            connectors=self._extract_connectors(nodes))
 
         if self.soma_label is not None:
-            is_soma_node = n.nodes.label.values == self.soma_label
+            is_soma_node = n._node_values('label') == self.soma_label
             if any(is_soma_node):
-                n.soma = n.nodes.node_id.values[is_soma_node][0]
+                n.soma = n._node_values('node_id')[is_soma_node][0]
 
         attrs = self._make_attributes({'name': 'SWC', 'origin': 'DataFrame'}, attrs)
 
@@ -175,6 +182,44 @@ class SwcReader(base.BaseReader):
 
         return n
 
+    def _compact_nodes(self, nodes: pd.DataFrame) -> 'core.NodeArrays':
+        """Convert SWC-like DataFrame into compact node arrays.
+
+        Same as `sanitise_nodes` but works directly on the arrays which is
+        much faster than casting and subsetting the DataFrame.
+        """
+        cols = {c: nodes[c].to_numpy() for c in nodes.columns}
+
+        # Remove nodes with missing data
+        is_na = np.zeros(len(nodes), dtype=bool)
+        for c in ('node_id', 'parent_id', 'x', 'y', 'z'):
+            is_na |= pd.isnull(cols[c])
+        if is_na.any():
+            cols = {k: v[~is_na] for k, v in cols.items()}
+            cols['parent_id'] = np.where(np.isin(cols['parent_id'], cols['node_id']),
+                                         cols['parent_id'], -1)
+
+        for c in ('node_id', 'parent_id'):
+            cols[c] = cols[c].astype(np.int64, copy=False)
+
+        if self._dtypes['label'] == 'category' and 'label' in cols:
+            cols['label'] = pd.Categorical(cols['label'])
+
+        # Use the same data types as `sanitise_nodes` would
+        coords = [c for c in ('x', 'y', 'z', 'radius') if c in cols]
+        float_ = self._dtypes['x'] or np.result_type(*[cols[c].dtype for c in coords])
+        int_ = self._dtypes['node_id'] or np.int64
+
+        xyz = np.stack([cols.pop(c) for c in ('x', 'y', 'z')], axis=1)
+        return core.NodeArrays(cols.pop('node_id'),
+                               cols.pop('parent_id'),
+                               xyz,
+                               radius=cols.pop('radius', None),
+                               extra=cols,
+                               columns=nodes.columns,
+                               dtype=float_,
+                               id_dtype=int_)
+
     def _extract_connectors(
         self, nodes: pd.DataFrame
     ) -> Optional[pd.DataFrame]:
@@ -265,6 +310,7 @@ def read_swc(f: Union[str, pd.DataFrame, Iterable],
              fmt: str = "{name}.swc",
              read_meta: bool = True,
              limit: Optional[int] = None,
+             compact: bool = False,
              **kwargs) -> 'core.NeuronObject':
     """Create Neuron/List from SWC file.
 
@@ -335,6 +381,13 @@ def read_swc(f: Union[str, pd.DataFrame, Iterable],
                         read only the first `limit` SWC files. Useful if
                         wanting to get a sample from a large library of
                         skeletons.
+    compact :           bool
+                        If True, will store nodes as compact arrays (see
+                        `navis.core.NodeArrays`) instead of a
+                        DataFrame. The node table is only generated when
+                        `.nodes` is first accessed. This is faster and uses
+                        less memory when reading large numbers of skeletons.
+                        Data types follow `precision`.
     **kwargs
                         Keyword arguments passed to the construction of
                         `navis.TreeNeuron`. You can use this to e.g. set
@@ -392,7 +445,8 @@ def read_swc(f: Union[str, pd.DataFrame, Iterable],
                        precision=precision,
                        read_meta=read_meta,
                        fmt=fmt,
-                       attrs=kwargs)
+                       attrs=kwargs,
+                       compact=compact)
     res = reader.read_any(f, include_subdirs, parallel, limit=limit)
 
     failed = []
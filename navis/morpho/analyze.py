@@ -59,12 +59,12 @@ def find_soma(x: 'core.TreeNeuron') -> Sequence[int]:
     soma_radius = getattr(x, 'soma_detection_radius', None)
     soma_label = getattr(x, 'soma_detection_label', None)
 
-    check_labels = not isinstance(soma_label, type(None)) and 'label' in x.nodes.columns
+    check_labels = not isinstance(soma_label, type(None)) and x._has_node_column('label')
     check_radius = not isinstance(soma_radius, type(None))
 
     # If no label or radius is given, return empty array
     if not check_labels and not check_radius:
-        return np.array([], dtype=x.nodes.node_id.values.dtype)
+        return np.array([], dtype=x._node_values('node_id').dtype)
 
     # Note to self: I've optimised the s**t out of this function
     # The reason reason why we're using a mask and this somewhat
@@ -72,7 +72,7 @@ def find_soma(x: 'core.TreeNeuron') -> Sequence[int]:
     # because that's really slow.
 
     # Start with a mask that includes all nodes
-    mask = np.ones(len(x.nodes), dtype=bool)
+    mask = np.ones(x.n_nodes, dtype=bool)
 
     if check_radius:
         # When checking for radii, we use an empty mask and fill it
@@ -80,7 +80,7 @@ def find_soma(x: 'core.TreeNeuron') -> Sequence[int]:
         mask[:] = False
 
         # Drop nodes that don't have a radius
-        radii = x.nodes.radius.values
+        radii = x._node_values('radius')
         has_radius = ~np.isnan(radii)
 
         # Filter further to nodes that have a large enough radius
@@ -107,11 +107,11 @@ def find_soma(x: 'core.TreeNeuron') -> Sequence[int]:
         # Important: we need to use np.asarray here because the `label` column
         # can be categorical in which case a `soma_nodes.label.astype(str)` might
         # throw annoying runtime warnings
-        soma_node_ids = x.nodes.node_id.values[mask]
-        soma_node_labels = np.asarray(x.nodes.label.values[mask]).astype(str)
+        soma_node_ids = x._node_values('node_id')[mask]
+        soma_node_labels = np.asarray(x._node_values('label')[mask]).astype(str)
 
         return soma_node_ids[soma_node_labels == str(soma_label)]
     # If no labels to check we can return the mask directly
     else:
-        return x.nodes.node_id.values[mask]
+        return x._node_values('node_id')[mask]
 
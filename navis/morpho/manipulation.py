@@ -269,6 +269,7 @@ def prune_by_strahler(x: NeuronObject,
     # Theoretically we can end up with disconnected pieces, i.e. with more
     # than 1 root node -> we have to fix the nodes that lost their parents
     neuron._nodes.loc[~neuron._nodes.parent_id.isin(neuron._nodes.node_id.values), 'parent_id'] = -1
+    neuron.mark_modified()
 
     # Remove temporary attributes
     neuron._clear_temp_attr()
@@ -530,6 +531,7 @@ def _prune_twigs_precise(neuron: 'core.TreeNeuron',
         neuron.nodes.loc[is_new_leaf, ['x', 'y', 'z']] = new_loc.astype(
             neuron.nodes.x.dtype, copy=False
         )
+        neuron.mark_modified()
 
     if any(to_remove):
         leafs_to_remove = new_leafs[to_remove]
@@ -1131,6 +1133,7 @@ def stitch_skeletons(*x: Union[Sequence[NeuronObject], 'core.NeuronList'],
                 # Remap parent IDs
                 new_map[None] = -1  # type: ignore
                 n.nodes['parent_id'] = n.nodes.parent_id.map(lambda x: new_map.get(x, x)).astype(int)
+                n.mark_modified()
 
                 # Add new nodes to seen
                 seen_tn = seen_tn | set(new_tn)
@@ -1352,6 +1355,7 @@ def average_skeletons(x: 'core.NeuronList',
     bn.nodes['x'] = mean_x
     bn.nodes['y'] = mean_y
     bn.nodes['z'] = mean_z
+    bn.mark_modified()
 
     return bn
 
@@ -1688,9 +1688,9 @@ def cable_length(x) -> Union[int, float]:
         cable_length = np.sum(np.linalg.norm(xyz - xyz_parent, axis=1))
     else:
         cable_length = utils.fastcore.dag.parent_dist(
-            x.nodes.node_id.values,
-            x.nodes.parent_id.values,
-            x.nodes[["x", "y", "z"]].values,
+            x._node_values("node_id"),
+            x._node_values("parent_id"),
+            x._node_values(["x", "y", "z"]),
             root_dist=0,
         ).sum()
 
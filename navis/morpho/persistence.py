@@ -19,8 +19,8 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 
+from scipy import sparse
 from scipy.spatial.distance import pdist, cdist, squareform
-from scipy.stats import gaussian_kde
 from typing import Union, Optional
 from typing_extensions import Literal
 
@@ -30,13 +30,112 @@ from .. import utils, config, core, graph
 # Setup logging
 logger = config.get_logger(__name__)
 
+# Max number of persistence points (i.e. segments) for which we sample the
+# Gaussian kernels in one go. Memory use is about 8 bytes * this * samples.
+PERSISTENCE_BATCH_POINTS = 50_000
 
+# Max number of distances calculated in one go when searching for nearest
+# neighbours in `persistence_distances`
+PERSISTENCE_BATCH_DISTANCES = 10_000_000
+
+
+def _persistence_points_batched(nl, descriptor='root_dist'):
+    """Calculate persistence points for all neurons in one go.
+
+    Node tables are concatenated into a single forest so that segments and
+    distances to root can be computed with one call to `navis-fastcore`
+    each.
+
+    Returns
+    -------
+    list of pandas.DataFrame
+
+    """
+    if descriptor not in ('root_dist', ):
+        raise ValueError(f'Unknown "descriptor" parameter: {descriptor}')
+
+    skeletons = []
+    for n in nl:
+        if isinstance(n, core.MeshNeuron):
+            n = n.skeleton
+        elif not isinstance(n, core.TreeNeuron):
+            raise ValueError(f'Expected TreeNeuron(s), got "{type(n)}"')
+        skeletons.append(n)
+
+    if not skeletons:
+        return []
+
+    n_nodes = np.array([n.n_nodes for n in skeletons])
+    node_ids = np.concatenate([n.nodes.node_id.values for n in skeletons]).astype(np.int64)
+    parent_ids = np.concatenate([n.nodes.parent_id.values for n in skeletons]).astype(np.int64)
+    # Use double precision like the neurons' graphs (see `neuron2nx`)
+    xyz = np.concatenate([n.nodes[['x', 'y', 'z']].values for n in skeletons]).astype(np.float64)
+    owner = np.repeat(np.arange(len(skeletons)), n_nodes)
+
+    # Node IDs are only unique within each neuron -> combine neuron and
+    # (ranked) node ID into a single key to map parents to their index
+    uni = np.unique(node_ids)
+    n_uni = len(uni)
+    keys = owner * n_uni + np.searchsorted(uni, node_ids)
+    srt = np.argsort(keys, kind='stable')
+
+    p_rank = np.searchsorted(uni, parent_ids).clip(max=n_uni - 1)
+    p_keys = owner * n_uni + p_rank
+    pos = np.searchsorted(keys, p_keys, sorter=srt).clip(max=len(keys) - 1)
+    parents = srt[pos]
+    # Roots (and parents that don't exist) have no parent
+    parents[(keys[parents] != p_keys) | (uni[p_rank] != parent_ids)] = -1
+
+    index = np.arange(len(node_ids))
+    weights = utils.fastcore.dag.parent_dist(index, parents, xyz, root_dist=0)
+    segs = utils.fastcore.generate_segments(index, parents, weights=weights)
+    # More recent versions of fastcore also return the segments' lengths
+    if isinstance(segs, tuple):
+        segs = segs[0]
+
+    # Grab starts and ends of each segment
+    ends = np.array([s[0] for s in segs], dtype=np.int64)
+    starts = np.array([s[-1] for s in segs], dtype=np.int64)
+
+    # Get geodesic distances to roots. fastcore only returns single
+    # precision, so we add up edge lengths from the roots outwards ourselves:
+    # this gives the same values as `graph.dist_to_root`
+    has_parent = parents >= 0
+    lengths = np.zeros(len(index))
+    lengths[has_parent] = np.sqrt(np.sum((xyz[has_parent] - xyz[parents[has_parent]]) ** 2, axis=1))
+    depth = utils.fastcore.dist_to_root(index, parents).astype(np.int64)
+    srt = np.argsort(depth, kind='stable')
+    dist = np.zeros(len(index))
+    for level in np.split(srt, np.searchsorted(depth[srt], np.arange(1, depth.max() + 1)))[1:]:
+        dist[level] = dist[parents[level]] + lengths[level]
+
+    # Sort segments by neuron (keeping them sorted by length within neurons)
+    by_neuron = np.argsort(owner[ends], kind='stable')
+    ends, starts = ends[by_neuron], starts[by_neuron]
+    counts = np.bincount(owner[ends], minlength=len(skeletons))
+
+    pers = pd.DataFrame()
+    pers['start_node'] = node_ids[starts]
+    pers['end_node'] = node_ids[ends]
+    pers['birth'] = dist[starts].astype(np.float64)
+    pers['death'] = dist[ends].astype(np.float64)
+
+    # Node IDs keep the data type of each neuron's node table
+    offsets = np.cumsum(counts)[:-1]
+    return [pers.iloc[i:j].reset_index(drop=True).astype({'start_node': n.nodes.node_id.dtype,
+                                                          'end_node': n.nodes.node_id.dtype})
+            for n, i, j in zip(skeletons, np.append(0, offsets), np.append(offsets, len(pers)))]
+
+
+@utils.map_neuronlist_batched(_persistence_points_batched,
+                              when=lambda p: utils.fastcore and not p['remove_cbf'])
 @utils.map_neuronlist(desc='Calc. persistence', allow_parallel=True)
 def persistence_points(x: 'core.NeuronObject',
                        descriptor: Union[
                                          Literal['root_dist']
                                          ] = 'root_dist',
-                       remove_cbf: bool = False
+                       remove_cbf: bool = False,
+                       batched: bool = True
                        ) -> pd.DataFrame:
     """Calculate points for a persistence diagram.
 
@@ -63,6 +162,12 @@ def persistence_points(x: 'core.NeuronObject',
                 If `remove_cbf=True` and the neuron has a soma (!) we ignore
                 the CBF for the birth & death times. Neurons will also be
                 automatically be rooted onto their soma!
+    batched :   bool
+                If True (default) and `navis-fastcore` is installed, the
+                nodes of all neurons in a NeuronList are combined into a
+                single forest and segments and distances are calculated for
+                all neurons in one go. Does not apply with `remove_cbf=True`
+                or `parallel=True`.
 
     Returns
     -------
@@ -139,6 +244,7 @@ def persistence_distances(q: 'core.NeuronObject',
                           augment: bool = True,
                           normalize: bool = True,
                           bw: float = .2,
+                          n_neighbors: Optional[int] = None,
                           **persistence_kwargs):
     """Calculate morphological similarity using persistence diagrams.
 
@@ -148,6 +254,9 @@ def persistence_distances(q: 'core.NeuronObject',
          evenly spaced points to create a feature vector.
       3. Calculate Euclidean distance.
 
+    For large numbers of neurons, use `n_neighbors` to get only the closest
+    targets for each query instead of the full distance matrix.
+
     Parameters
     ----------
     q/t :       NeuronList
@@ -163,12 +272,21 @@ def persistence_distances(q: 'core.NeuronObject',
     augment :   bool
                 Whether to augment the persistence vectors with other neuron
                 properties (number of branch points & leafs and cable length).
+    n_neighbors : int, optional
+                If provided, will return only the `n_neighbors` closest
+                targets for each query. The distances are calculated in
+                chunks (see `PERSISTENCE_BATCH_DISTANCES`) such that the full
+                distance matrix is never held in memory.
     **persistence_kwargs
                 Keyword arguments are passed to [`navis.persistence_points`][].
 
     Returns
     -------
     distances : pandas.DataFrame
+                If `n_neighbors=None` (default), a queries x targets
+                distance matrix. Otherwise, one row per query with
+                `match_{i}` and `score_{i}` (i.e. distance) columns in the
+                same format as [`navis.nbl.extract_matches`][].
 
     See Also
     --------
@@ -235,6 +353,14 @@ def persistence_distances(q: 'core.NeuronObject',
 
         vectors = np.append(vectors, vec_aug, axis=1)
 
+    if n_neighbors:
+        q_vec = vectors[:len(q)]
+        t_vec = vectors[len(q):] if t else vectors
+        return _nearest_vectors(q_vec, t_vec,
+                                q.id,
+                                t.id if t else q.id,
+                                N=n_neighbors)
+
     if t:
         # Extract source and target vectors
         q_vec = vectors[:len(q)]
@@ -244,6 +370,34 @@ def persistence_distances(q: 'core.NeuronObject',
         return pd.DataFrame(squareform(pdist(vectors)), index=q.id, columns=q.id)
 
 
+def _nearest_vectors(q_vec, t_vec, q_ids, t_ids, N):
+    """Find the `N` closest target vectors for each query vector."""
+    N = min(N, len(t_vec))
+    t_ids = np.asarray(t_ids)
+
+    top_ix = np.zeros((len(q_vec), N), dtype=np.int64)
+    top_dist = np.zeros((len(q_vec), N), dtype=np.float64)
+    chunk = max(1, PERSISTENCE_BATCH_DISTANCES // max(1, len(t_vec)))
+    for i in range(0, len(q_vec), chunk):
+        d = cdist(q_vec[i:i + chunk], t_vec)
+        if N < d.shape[1]:
+            ix = np.argpartition(d, N - 1, axis=1)[:, :N]
+        else:
+            ix = np.tile(np.arange(d.shape[1]), (len(d), 1))
+        dd = np.take_along_axis(d, ix, axis=1)
+        srt = np.argsort(dd, axis=1, kind='stable')
+        top_ix[i:i + chunk] = np.take_along_axis(ix, srt, axis=1)
+        top_dist[i:i + chunk] = np.take_along_axis(dd, srt, axis=1)
+
+    matches = pd.DataFrame()
+    matches['id'] = q_ids
+    for i in range(N):
+        matches[f'match_{i + 1}'] = t_ids[top_ix[:, i]]
+        matches[f'score_{i + 1}'] = top_dist[:, i]
+
+    return matches
+
+
 def persistence_vectors(x,
                         threshold: Optional[float] = None,
                         samples: int = 100,
@@ -303,7 +457,7 @@ def persistence_vectors(x,
     if isinstance(x, pd.DataFrame):
         pers = [x]
     elif isinstance(x, core.NeuronList):
-        pers = [persistence_points(n, **kwargs) for n in x]
+        pers = persistence_points(x, **kwargs)
     elif isinstance(x, list):
         if not all([isinstance(l, pd.DataFrame) for l in x]):
             raise ValueError('Expected lists to contain only DataFrames')
@@ -317,21 +471,7 @@ def persistence_vectors(x,
     samples = np.linspace(0, max_pdist * 1.05, samples)
 
     # Now get a persistence vector
-    vectors = []
-    for p in pers:
-        weights = p.death.values - p.birth.values
-        if threshold:
-            p = p.loc[weights >= threshold]
-            weights = weights[weights >= threshold]
-
-        # For each persistence generate a weighted Gaussian kernel
-        kernel = gaussian_kde(p.birth.values,
-                              weights=weights,
-                              bw_method=bw)
-
-        # And sample probabilities at the sample points
-        vectors.append(kernel(samples))
-    vectors = np.array(vectors)
+    vectors = _kde_vectors(pers, samples, bw=bw, threshold=threshold)
 
     if center:
         # Shift each vector such that the highest value lies in the center.
@@ -344,6 +484,71 @@ def persistence_vectors(x,
     return vectors, samples
 
 
+def _kde_vectors(pers, samples, bw, threshold=None):
+    """Sample weighted Gaussian kernels for persistence points.
+
+    Equivalent to sampling a `scipy.stats.gaussian_kde` (weighted by
+    segment length) for each neuron but evaluates the kernels for all
+    neurons as one (sparse) matrix product.
+
+    Returns
+    -------
+    (N, len(samples)) np.ndarray
+
+    """
+    births, weights = [], []
+    for p in pers:
+        b = p.birth.values.astype(np.float64)
+        w = p.death.values - b
+        if threshold:
+            b, w = b[w >= threshold], w[w >= threshold]
+        births.append(b)
+        weights.append(w)
+
+    counts = np.array([len(b) for b in births])
+    owner = np.repeat(np.arange(len(pers)), counts)
+    births = np.concatenate(births) if len(births) else np.zeros(0)
+    weights = np.concatenate(weights) if len(weights) else np.zeros(0)
+
+    # Weighted variance of the births per neuron (see `np.cov` with `aweights`)
+    w_sum = np.bincount(owner, weights, minlength=len(pers))
+    w_sq = np.bincount(owner, weights ** 2, minlength=len(pers))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(owner, weights * births, minlength=len(pers)) / w_sum
+        var = (np.bincount(owner, weights * (births - mean[owner]) ** 2, minlength=len(pers))
+               / (w_sum - w_sq / w_sum))
+
+    bad = ~(var > 0)
+    if any(bad):
+        raise ValueError('Unable to generate persistence vectors: need at least '
+                         'two persistence points with different births for '
+                         f'each neuron (failed for indices {np.where(bad)[0]})')
+
+    # Kernel variance is the data variance scaled by the bandwidth
+    kvar = var * bw ** 2
+    coef = weights / w_sum[owner] / np.sqrt(2 * np.pi * kvar[owner])
+
+    vectors = np.zeros((len(pers), len(samples)))
+    offsets = np.append(0, np.cumsum(counts))
+    start = 0
+    while start < len(pers):
+        # Process as many neurons as fit into the batch
+        stop = np.searchsorted(offsets, offsets[start] + PERSISTENCE_BATCH_POINTS, side='right') - 1
+        stop = min(max(stop, start + 1), len(pers))
+        p0, p1 = offsets[start], offsets[stop]
+
+        # (points, samples) matrix of unweighted kernels
+        kernels = np.exp(-(samples.reshape(1, -1) - births[p0:p1].reshape(-1, 1)) ** 2
+                         / (2 * kvar[owner[p0:p1]].reshape(-1, 1)))
+        # (neurons, points) matrix of weights
+        W = sparse.csr_matrix((coef[p0:p1], (owner[p0:p1] - start, np.arange(p1 - p0))),
+                              shape=(stop - start, p1 - p0))
+        vectors[start:stop] = W @ kernels
+        start = stop
+
+    return vectors
+
+
 def persistence_diagram(pers, ax=None, **kwargs):
     """Plot a persistence diagram.
 
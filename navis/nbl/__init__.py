@@ -16,7 +16,10 @@
 from .nblast_funcs import nblast, nblast_allbyall, nblast_smart
 from .synblast_funcs import synblast
 from .ablast_funcs import nblast_align
+from .search import nblast_search
 from .utils import (extract_matches, update_scores, dendrogram, make_clusters, compress_scores)
+from .cache import ScoreCache, AlignmentCache
+from .server import NBlastServer, NBlastClient
 
 __all__ = ['nblast', 'nblast_allbyall', 'nblast_smart', 'synblast',
-           'nblast_align']
+           'nblast_align', 'nblast_search']
@@ -27,9 +27,11 @@ from typing_extensions import Literal
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from .. import config, utils, core
-from ..transforms.align import align_rigid, align_deform, align_pca, _align_rigid_deform
+from ..transforms.align import (align_rigid, align_deform, align_pca,
+                                _align_rigid_deform, _extract_coords, _set_coords)
 
 from .base import Blaster, NestedIndices
+from .cache import AlignmentCache, alignment_key, parse_alignment_cache
 from .nblast_funcs import (nblast_preflight,find_optimal_partition, set_omp_flag)
 from .smat import Lookup2d, _nblast_v1_scoring
 
@@ -84,6 +86,19 @@ class NBlasterAlign(Blaster):
                     scoring matrix.
     progress :      bool
                     If True, will show a progress bar.
+    alignments :    dict, optional
+                    Previously computed alignments (see `alignment_key`). If
+                    provided, alignments are looked up here before running
+                    `align_func` and new alignments are added to it and
+                    tracked in `.new_alignments`. If None, alignments are not
+                    kept.
+    align_method :  str, optional
+                    Name of the alignment method. Used to key `alignments`.
+                    Defaults to `align_func`.
+    skip :          set of (int, int) tuples, optional
+                    Pairs of neuron indices for which to skip the alignment
+                    and return the floor score (see `floor_score`) instead.
+                    Both directions are skipped.
 
     """
 
@@ -95,6 +110,9 @@ class NBlasterAlign(Blaster):
                  smat_kwargs=dict(),
                  align_kwargs=dict(),
                  dotprop_kwargs=dict(),
+                 alignments=None,
+                 align_method=None,
+                 skip=None,
                  ):
         """Initialize class."""
         super().__init__(progress=progress, dtype=dtype)
@@ -110,6 +128,11 @@ class NBlasterAlign(Blaster):
         self.self_hits = {}
         self.dotprops = {}
         self.neurons = []
+        self.alignments = alignments
+        self.new_alignments = {}
+        self.align_method = align_func if align_method is None else align_method
+        self.skip = set() if skip is None else skip
+        self._md5 = {}
 
         if smat is None:
             self.score_fn = operator.mul
@@ -172,6 +195,41 @@ class NBlasterAlign(Blaster):
                 self.dotprops[ix] = self.neurons[ix]
         return self.dotprops[ix]
 
+    def get_md5(self, ix):
+        if ix not in self._md5:
+            self._md5[ix] = self.neurons[ix].core_md5
+        return self._md5[ix]
+
+    def align_key(self, q_idx, t_idx):
+        """Key for the alignment of query onto target."""
+        return alignment_key(self.get_md5(q_idx), self.get_md5(t_idx),
+                             self.align_method, self.sample_align,
+                             **self.align_kwargs)
+
+    def align(self, q_idx, t_idx):
+        """Align query to target.
+
+        Uses `.alignments` (if any) to skip previously computed alignments.
+
+        """
+        if self.alignments is not None:
+            key = self.align_key(q_idx, t_idx)
+            if key in self.alignments:
+                q_xf = self.neurons[q_idx].copy()
+                _set_coords(q_xf, self.alignments[key])
+                return q_xf
+
+        q_xf = self.align_func(self.neurons[q_idx],
+                               target=self.neurons[t_idx],
+                               sample=self.sample_align,
+                               progress=False,
+                               **self.align_kwargs)[0][0]
+
+        if self.alignments is not None:
+            self.alignments[key] = self.new_alignments[key] = _extract_coords(q_xf)
+
+        return q_xf
+
     def get_self_hit(self, ix):
         if ix not in self.self_hits:
             self.self_hits[ix] = self.calc_self_hit(self.get_dotprop(ix))
@@ -187,6 +245,16 @@ class NBlasterAlign(Blaster):
             dots = np.repeat(1, len(dotprops.points)) * np.sqrt(alpha)
             return self.score_fn(dists, dots).sum()
 
+    def floor_score(self, q_idx):
+        """Score for query without any matches in the target."""
+        n = len(self.get_dotprop(q_idx).points)
+        scr = self.score_fn(np.full(n, np.inf), np.zeros(n)).sum()
+
+        if self.normalized:
+            scr /= self.get_self_hit(q_idx)
+
+        return scr
+
     def score_single(self, q_dp, t_dp, q_idx):
         """Calculate score for single query/target dotprop pair."""
         # Run nearest-neighbor search for query against target
@@ -219,25 +287,30 @@ class NBlasterAlign(Blaster):
                 return 1
             return self.get_self_hit(q_idx)
 
-        # Align the query to the target
-        q_xf = self.align_func(self.neurons[q_idx],
-                               target=self.neurons[t_idx],
-                               sample=self.sample_align,
-                               progress=False,
-                               **self.align_kwargs)[0][0]
+        # Pairs that didn't pass the gate get the floor score
+        skip = (q_idx, t_idx) in self.skip or (t_idx, q_idx) in self.skip
 
-        # The query must always be made into new dotprops because it has been
-        # moved around
-        q_dp = core.make_dotprops(q_xf, **self.dotprop_kwargs)
+        if not skip:
+            # Align the query to the target
+            q_xf = self.align(q_idx, t_idx)
 
-        # The target dotprop has to be compute only once
-        t_dp = self.get_dotprop(t_idx)
+            # The query must always be made into new dotprops because it has been
+            # moved around
+            q_dp = core.make_dotprops(q_xf, **self.dotprop_kwargs)
 
-        scr = self.score_single(q_dp, t_dp, q_idx)
+            # The target dotprop has to be compute only once
+            t_dp = self.get_dotprop(t_idx)
+
+            scr = self.score_single(q_dp, t_dp, q_idx)
+        else:
+            scr = self.floor_score(q_idx)
 
         # For the mean score we also have to produce the reverse score
         if scores in ('mean', 'min', 'max', 'both'):
-            reverse = self.score_single(t_dp, q_dp, t_idx)
+            if not skip:
+                reverse = self.score_single(t_dp, q_dp, t_idx)
+            else:
+                reverse = self.floor_score(t_idx)
             if scores == 'mean':
                 scr = (scr + reverse) / 2
             elif scores == 'min':
@@ -277,7 +350,11 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                  progress: bool = True,
                  dotprop_kwargs: Optional[Dict] = dict(),
                  align_kwargs: Optional[Dict] = dict(),
-                 smat_kwargs: Optional[Dict] = dict()) -> pd.DataFrame:
+                 smat_kwargs: Optional[Dict] = dict(),
+                 align_cache: Optional[Union[bool, str, AlignmentCache]] = None,
+                 gate: Optional[Literal['pca']] = None,
+                 gate_threshold: float = .25
+                 ) -> pd.DataFrame:
     """Run NBLAST on pairwise-aligned neurons.
 
     Requires the `pycpd` library at least version 2.0.1 which at the time of
@@ -380,6 +457,28 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                     Dictionary with additional parameters passed to
                     `navis.make_dotprops`. Only relevant if inputs aren't
                     already dotprops.
+    align_cache :   bool | str | AlignmentCache, optional
+                    Cache for pairwise alignments (see
+                    `navis.nbl.cache.AlignmentCache`) or path to one. Aligned
+                    coordinates are keyed by the neurons' content hashes, the
+                    alignment method, `sample_align` and `align_kwargs`. Only
+                    alignments not already in the cache are computed. This
+                    makes re-running with e.g. a different `smat` or
+                    `dotprop_kwargs` much faster. If True, will use an
+                    in-memory cache which still saves on alignments for
+                    `two_way_align=True` when queries and targets overlap.
+    gate :          "pca" | None
+                    Cheap check to drop obviously unrelated pairs before
+                    running the (expensive) alignment:
+                      - "pca" compares the neurons' bounding boxes after
+                        aligning them along their principal axes (see
+                        `navis.nbl.ablast_funcs.pca_overlap`)
+                    Pairs that don't pass get the score of a query without
+                    any matches in the target (i.e. the worst possible score).
+    gate_threshold : float
+                    Pairs with a `gate` score below this threshold are
+                    skipped. For "pca", this is the fraction of overlap
+                    between the bounding boxes [0-1].
 
 
     Returns
@@ -440,6 +539,17 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
     else:
         align_func = align_method
 
+    align_cache = parse_alignment_cache(align_cache)
+
+    # Find pairs that can be skipped
+    if gate is None:
+        passed = np.ones((len(query), len(target)), dtype=bool)
+    elif gate == 'pca':
+        passed = pca_overlap(query, target) >= gate_threshold
+        logger.info(f'{(~passed).sum():,} of {passed.size:,} pairs did not pass the gate.')
+    else:
+        raise ValueError(f'Unknown `gate`: "{gate}"')
+
     # Run NBLAST preflight checks
     nblast_preflight(query, target, n_cores,
                      req_dotprops=False,
@@ -493,7 +603,8 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                                              progress=progress,
                                              align_kwargs=align_kwargs,
                                              dotprop_kwargs=dotprop_kwargs,
-                                             smat_kwargs=smat_kwargs)
+                                             smat_kwargs=smat_kwargs,
+                                             align_method=align_method)
 
                         # Add queries and targets
                         for i, ix in enumerate(qix):
@@ -504,6 +615,19 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                         # Keep track of indices of queries and targets
                         this.queries = np.arange(len(qix))
                         this.targets = np.arange(len(tix)) + len(qix)
+
+                        # Pairs that did not pass the gate
+                        this.skip = {(q, t) for q, t in zip(*np.where(~passed[np.ix_(qix, tix)]))}
+                        this.skip = {(int(q), int(t) + len(qix)) for q, t in this.skip}
+
+                        # Fetch the alignments we already have
+                        if align_cache is not None:
+                            pairs = [(q, t) for q in this.queries for t in this.targets
+                                     if (q, t) not in this.skip]
+                            keys = [this.align_key(q, t) for q, t in pairs]
+                            if two_way_align:
+                                keys += [this.align_key(t, q) for q, t in pairs]
+                            this.alignments = align_cache.lookup(keys)
                         this.queries_ix = qix  # this facilitates filling in the big matrix later
                         this.targets_ix = tix  # this facilitates filling in the big matrix later
                         this.pbar_position = len(nblasters) if not utils.is_jupyter() else None
@@ -514,7 +638,8 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                         # If multiple cores requested, submit job to the pool right away
                         if n_cores and n_cores > 1 and (n_cols > 1 or n_rows > 1):
                             this.progress=False  # no progress bar for individual NBLASTERs
-                            futures[pool.submit(this.multi_query_target,
+                            futures[pool.submit(_align_job,
+                                                this,
                                                 q_idx=this.queries,
                                                 t_idx=this.targets,
                                                 scores=scores)] = this
@@ -539,13 +664,80 @@ def nblast_align(query: Union[core.BaseNeuron, core.NeuronList],
                                      smoothing=0,
                                      disable=not progress,
                                      leave=False):
-                    res = f.result()
+                    res, new_alignments = f.result()
                     this = futures[f]
                     # Fill-in big score matrix
                     scores.iloc[this.queries_ix, this.targets_ix] = res.values
+                    if align_cache is not None:
+                        align_cache.store(new_alignments)
             else:
-                scores = this.multi_query_target(this.queries,
-                                                 this.targets,
-                                                 scores=scores)
+                scores, new_alignments = _align_job(this,
+                                                    this.queries,
+                                                    this.targets,
+                                                    scores=scores)
+                if align_cache is not None:
+                    align_cache.store(new_alignments)
 
     return scores
+
+
+def pca_overlap(query, target):
+    """Overlap between neurons after aligning them along their principal axes.
+
+    Each neuron is centered on its centroid and rotated onto its principal
+    axes. For each pair we then calculate the overlap (intersection over
+    union) of the extents along each axis and multiply them. Because the
+    direction of principal axes is arbitrary, we take the best of the four
+    possible orientations.
+
+    This is very cheap and hence useful as a first check whether a pair is
+    worth aligning (see `gate` parameter in [`navis.nblast_align`][]).
+
+    Parameters
+    ----------
+    query,target :  NeuronList
+                    Neurons to compare.
+
+    Returns
+    -------
+    np.ndarray
+                    (N, M) array of overlaps between 0 (no overlap) and 1
+                    (same extents).
+
+    """
+    q_box = np.stack([_pca_box(n) for n in core.NeuronList(query)])
+    t_box = np.stack([_pca_box(n) for n in core.NeuronList(target)])
+
+    q_min, q_max = q_box[:, None, 0], q_box[:, None, 1]
+    best = np.zeros((len(q_box), len(t_box)))
+    # Flipping two axes = rotating the neuron by 180 degrees
+    for flip in ((1, 1, 1), (-1, -1, 1), (-1, 1, -1), (1, -1, -1)):
+        flip = np.array(flip)
+        t_min = np.where(flip > 0, t_box[:, 0], -t_box[:, 1])[None]
+        t_max = np.where(flip > 0, t_box[:, 1], -t_box[:, 0])[None]
+        inter = (np.minimum(q_max, t_max) - np.maximum(q_min, t_min)).clip(min=0)
+        union = np.maximum(q_max, t_max) - np.minimum(q_min, t_min)
+        iou = np.divide(inter, union, out=np.ones_like(inter), where=union > 0)
+        best = np.maximum(best, iou.prod(axis=2))
+
+    return best
+
+
+def _pca_box(x):
+    """Extents of neuron in its principal axes frame centered on the centroid."""
+    co = np.asarray(_extract_coords(x), dtype=np.float64)
+    co = co - co.mean(axis=0)
+    # Eigenvectors come in ascending order of eigenvalues
+    _, vec = np.linalg.eigh(co.T @ co)
+    vec = vec[:, ::-1]
+    # Make sure this is a rotation (not a reflection)
+    if np.linalg.det(vec) < 0:
+        vec[:, -1] *= -1
+    co = co @ vec
+    return np.stack([co.min(axis=0), co.max(axis=0)])
+
+
+def _align_job(nblaster, q_idx, t_idx, scores):
+    """Run NBlasterAlign and return scores and newly computed alignments."""
+    res = nblaster.multi_query_target(q_idx, t_idx, scores=scores)
+    return res, nblaster.new_alignments
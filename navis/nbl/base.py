@@ -125,26 +125,13 @@ class Blaster(ABC):
             for k, t in enumerate(t_idx):
                 res[i, k] = self.single_query_target(q, t, scores=scores)
 
-        # Generate results
-        if res.ndim == 2:
-            res = pd.DataFrame(res)
-            res.columns = [self.ids[t] for t in t_idx]
-            res.index = [self.ids[q] for q in q_idx]
-            res.index.name = 'query'
-            res.columns.name = 'target'
-        else:
-            # For scores='both' we will create a DataFrame with multi-index
-            ix = pd.MultiIndex.from_product([[self.ids[q] for q in q_idx],
-                                             ['forward', 'reverse']],
-                                            names=["query", "score"])
-            res = pd.DataFrame(np.hstack((res[:, :, 0],
-                                          res[:, :, 1])).reshape(len(q_idx) * 2,
-                                                                 len(t_idx)),
-                               index=ix,
-                               columns=[self.ids[t] for t in t_idx])
-            res.columns.name = 'target'
+        return self._results_to_frame(res, q_idx, t_idx)
 
-        return res
+    def _results_to_frame(self, res, q_idx, t_idx):
+        """Turn (N, M) or (N, M, 2) array of scores into DataFrame."""
+        return scores_to_frame(res,
+                               [self.ids[q] for q in q_idx],
+                               [self.ids[t] for t in t_idx])
 
     def all_by_all(self, scores='forward'):
         """BLAST all-by-all neurons."""
@@ -173,3 +160,62 @@ class Blaster(ABC):
 
     def __len__(self):
         return len(self.neurons)
+
+
+def combine_scores(fwd, rev, scores='forward'):
+    """Combine forward and reverse scores.
+
+    Parameters
+    ----------
+    fwd :       (N, M) np.ndarray
+                Forward (query->target) scores.
+    rev :       (N, M) np.ndarray | None
+                Reverse (target->query) scores. Note that this must already
+                be transposed to match the shape of `fwd`. Ignored if
+                `scores='forward'`.
+    scores :    "forward" | "mean" | "min" | "max" | "both"
+                How to combine the scores.
+
+    Returns
+    -------
+    np.ndarray
+                (N, M) array of scores or (N, M, 2) if `scores='both'`.
+
+    """
+    if scores == 'forward':
+        return fwd
+    elif scores == 'mean':
+        return (fwd + rev) / 2
+    elif scores == 'min':
+        return np.minimum(fwd, rev)
+    elif scores == 'max':
+        return np.maximum(fwd, rev)
+    elif scores == 'both':
+        return np.dstack((fwd, rev))
+
+    raise ValueError(f'Unknown scores "{scores}"')
+
+
+def scores_to_frame(res, query_ids, target_ids):
+    """Turn (N, M) or (N, M, 2) array of scores into DataFrame.
+
+    For (N, M, 2) arrays (i.e. `scores='both'`) a DataFrame with multi-index
+    is generated.
+    """
+    if res.ndim == 2:
+        res = pd.DataFrame(res, index=list(query_ids), columns=list(target_ids))
+        res.index.name = 'query'
+        res.columns.name = 'target'
+    else:
+        # For scores='both' we will create a DataFrame with multi-index
+        ix = pd.MultiIndex.from_product([list(query_ids),
+                                         ['forward', 'reverse']],
+                                        names=["query", "score"])
+        res = pd.DataFrame(np.hstack((res[:, :, 0],
+                                      res[:, :, 1])).reshape(res.shape[0] * 2,
+                                                             res.shape[1]),
+                           index=ix,
+                           columns=list(target_ids))
+        res.columns.name = 'target'
+
+    return res
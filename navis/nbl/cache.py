@@ -0,0 +1,460 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Persistent on-disk caches for pairwise (NBLAST) scores and alignments."""
+
+import io
+import sqlite3
+
+import numpy as np
+
+from pathlib import Path
+
+from .. import config
+from .checkpoint import hash_params
+
+__all__ = ['ScoreCache', 'AlignmentCache']
+
+logger = config.get_logger(__name__)
+
+# Max number of host parameters per SQL statement
+SQL_MAX_VARS = 900
+
+
+class ScoreCache:
+    """Persistent cache for pairwise scores.
+
+    Scores are stored in an SQLite database keyed by the content hashes of
+    query and target (e.g. `core_md5` for dotprops) plus a hash of the
+    scoring parameters. Re-running a BLAST after changing only a few neurons
+    will therefore only compute scores for pairs that are actually new.
+
+    Parameters
+    ----------
+    path :          str
+                    Path to the SQLite database file. Will be created if it
+                    doesn't exist.
+    max_size :      int, optional
+                    Max number of scores to keep. If exceeded, the least
+                    recently used scores are evicted. Each score takes up
+                    about 30 bytes on disk.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(n=5)
+    >>> dp = navis.make_dotprops(nl, k=5) / 125
+    >>> cache = navis.nbl.ScoreCache('~/nblast_cache.db')   # doctest: +SKIP
+    >>> scores = navis.nblast(dp, dp, cache=cache)          # doctest: +SKIP
+    >>> # Only the scores involving the modified neuron need re-computing
+    >>> _ = dp[0].downsample(2, inplace=True)               # doctest: +SKIP
+    >>> scores = navis.nblast(dp, dp, cache=cache)          # doctest: +SKIP
+
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = Path(path).expanduser()
+        self.max_size = max_size
+
+        self.con = sqlite3.connect(self.path)
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS keys '
+                             '(key TEXT PRIMARY KEY, id INTEGER UNIQUE)')
+            self.con.execute('CREATE TABLE IF NOT EXISTS scores '
+                             '(params INTEGER, query INTEGER, target INTEGER, '
+                             'score REAL, accessed INTEGER, '
+                             'PRIMARY KEY (params, query, target)) WITHOUT ROWID')
+            self.con.execute('CREATE INDEX IF NOT EXISTS scores_accessed '
+                             'ON scores (accessed)')
+
+        self.n_scores = self.con.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        # We use a counter instead of timestamps to track access
+        self._clock = self.con.execute('SELECT MAX(accessed) FROM scores').fetchone()[0] or 0
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(path="{self.path}", n_scores={self.n_scores})>'
+
+    def __getstate__(self):
+        raise TypeError('`ScoreCache` can not be pickled.')
+
+    def close(self):
+        """Close connection to the database."""
+        self.con.close()
+
+    def clear(self):
+        """Remove all scores."""
+        with self.con:
+            self.con.execute('DELETE FROM scores')
+            self.con.execute('DELETE FROM keys')
+        self.n_scores = 0
+
+    def lookup(self, params, query_keys, target_keys):
+        """Fetch scores from the cache.
+
+        Parameters
+        ----------
+        params :        str
+                        Hash of the scoring parameters (see `hash_params`).
+        query_keys :    (N, ) iterable of str
+        target_keys :   (M, ) iterable of str
+                        Content hashes of queries and targets.
+
+        Returns
+        -------
+        (N, M) np.ndarray
+                        Cached scores. Missing scores are `np.nan`.
+
+        """
+        params = self._params_id(params)
+        q_ids = self._key_ids(query_keys)
+        t_ids = self._key_ids(target_keys)
+
+        scores = np.full((len(q_ids), len(t_ids)), np.nan)
+        t_srt = np.argsort(t_ids)
+        t_ids_srt = t_ids[t_srt]
+
+        self._clock += 1
+        touched = []
+        for i, q in enumerate(q_ids):
+            res = self.con.execute('SELECT target, score FROM scores '
+                                   'WHERE params = ? AND query = ?',
+                                   (params, int(q))).fetchall()
+            if not res:
+                continue
+            res = np.array(res, dtype=np.float64)
+            t, s = res[:, 0].astype(np.int64), res[:, 1]
+            # Map to the requested targets
+            ix = np.searchsorted(t_ids_srt, t).clip(max=len(t_ids_srt) - 1)
+            is_req = t_ids_srt[ix] == t
+            scores[i, t_srt[ix[is_req]]] = s[is_req]
+            touched += [(self._clock, params, int(q), int(tt)) for tt in t[is_req]]
+
+        # Mark these scores as recently used
+        with self.con:
+            self.con.executemany('UPDATE scores SET accessed = ? '
+                                 'WHERE params = ? AND query = ? AND target = ?',
+                                 touched)
+
+        return scores
+
+    def store(self, params, query_keys, target_keys, scores, mask=None):
+        """Add scores to the cache.
+
+        Parameters
+        ----------
+        params :        str
+                        Hash of the scoring parameters (see `hash_params`).
+        query_keys :    (N, ) iterable of str
+        target_keys :   (M, ) iterable of str
+                        Content hashes of queries and targets.
+        scores :        (N, M) array
+        mask :          (N, M) boolean array, optional
+                        If provided, will only store scores where mask is True.
+
+        """
+        params = self._params_id(params)
+        q_ids = self._key_ids(query_keys, create=True)
+        t_ids = self._key_ids(target_keys, create=True)
+
+        scores = np.asarray(scores, dtype=np.float64)
+        if mask is None:
+            mask = np.ones(scores.shape, dtype=bool)
+        qi, ti = np.where(mask)
+
+        self._clock += 1
+        with self.con:
+            cur = self.con.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)',
+                                       zip([params] * len(qi),
+                                           q_ids[qi].tolist(),
+                                           t_ids[ti].tolist(),
+                                           scores[qi, ti].tolist(),
+                                           [self._clock] * len(qi)))
+        # Note: this slightly overestimates if scores were replaced
+        self.n_scores += max(cur.rowcount, 0)
+
+        self.evict()
+
+    def evict(self):
+        """Evict least recently used scores if cache is too large."""
+        if not self.max_size or self.n_scores <= self.max_size:
+            return
+
+        n_evict = self.n_scores - self.max_size
+        cutoff = self.con.execute('SELECT accessed FROM scores ORDER BY accessed '
+                                  'LIMIT 1 OFFSET ?', (n_evict - 1, )).fetchone()
+        if cutoff is None:
+            return
+        with self.con:
+            self.con.execute('DELETE FROM scores WHERE accessed <= ?', cutoff)
+        self.n_scores = self.con.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        logger.debug(f'Evicted {n_evict} scores from cache.')
+
+    def _params_id(self, params):
+        """Map hash of parameters to integer ID."""
+        return int(self._key_ids([f'params:{params}'], create=True)[0])
+
+    def _key_ids(self, keys, create=False):
+        """Map keys to integer IDs. Unknown keys get -1 unless `create=True`."""
+        keys = [str(k) for k in keys]
+        uni = list(set(keys))
+        if create:
+            with self.con:
+                nxt = self.con.execute('SELECT COALESCE(MAX(id), -1) + 1 FROM keys').fetchone()[0]
+                known = self._fetch_ids(uni)
+                new = [k for k in uni if k not in known]
+                self.con.executemany('INSERT INTO keys VALUES (?, ?)',
+                                     zip(new, range(nxt, nxt + len(new))))
+        ids = self._fetch_ids(uni)
+        return np.array([ids.get(k, -1) for k in keys], dtype=np.int64)
+
+    def _fetch_ids(self, keys):
+        ids = {}
+        for i in range(0, len(keys), SQL_MAX_VARS):
+            chunk = keys[i:i + SQL_MAX_VARS]
+            q = ','.join('?' * len(chunk))
+            ids.update(self.con.execute(f'SELECT key, id FROM keys WHERE key IN ({q})',
+                                        chunk).fetchall())
+        return ids
+
+
+def parse_cache(cache):
+    """Parse `cache` parameter into a ScoreCache."""
+    if cache is None or isinstance(cache, ScoreCache):
+        return cache
+    elif isinstance(cache, (str, Path)):
+        return ScoreCache(cache)
+    raise TypeError(f'`cache` must be None, a filepath or a ScoreCache, got "{type(cache)}"')
+
+
+def cached_scores(func, query, target, cache, params, query_keys, target_keys,
+                  **kwargs):
+    """Run a BLAST function only for pairs whose score isn't cached.
+
+    Parameters
+    ----------
+    func :          callable
+                    BLAST function. Must accept `query`, `target` and
+                    `**kwargs` and return a DataFrame of forward scores.
+    query,target :  NeuronList
+    cache :         ScoreCache
+    params :        dict
+                    Scoring parameters. Hashed to key the scores in the cache.
+    query_keys :    (N, ) array of str
+    target_keys :   (M, ) array of str
+                    Content hashes for queries and targets.
+    **kwargs
+                    Keyword arguments passed to `func`.
+
+    Returns
+    -------
+    (N, M) np.ndarray
+                    Forward scores.
+
+    """
+    params = hash_params(**params)
+    scores = cache.lookup(params, query_keys, target_keys)
+    missing = np.isnan(scores)
+
+    logger.info(f'Found {(~missing).sum():,} of {missing.size:,} scores in cache.')
+
+    if not missing.any():
+        return scores
+
+    # Targets missing for all queries (e.g. new or changed targets) are run
+    # against all queries, remaining gaps (e.g. new or changed queries) are
+    # filled by running the affected queries against the affected targets
+    t_new = missing.all(axis=0)
+    rest = missing & ~t_new
+    q_rest = rest.any(axis=1)
+    t_rest = rest.any(axis=0)
+    for qix, tix in ((np.arange(len(query)), np.where(t_new)[0]),
+                     (np.where(q_rest)[0], np.where(t_rest)[0])):
+        if not len(qix) or not len(tix):
+            continue
+        res = func(query[qix], target[tix], **kwargs)
+        scores[np.ix_(qix, tix)] = res.values
+
+    cache.store(params, query_keys, target_keys, scores, mask=missing)
+
+    return scores
+
+
+class AlignmentCache:
+    """Cache for pairwise alignments as used by `navis.nblast_align`.
+
+    For each pair, we store the coordinates of the query after it has been
+    aligned to the target. These are keyed by the content hashes of query
+    and target plus the alignment method and its parameters (see
+    `alignment_key`). Re-running an aligned NBLAST (e.g. with a different
+    scoring matrix) can then skip the expensive registration step entirely.
+
+    Parameters
+    ----------
+    path :          str, optional
+                    Path to the SQLite database file. Will be created if it
+                    doesn't exist. If not provided, alignments are only kept
+                    in memory.
+    max_size :      int, optional
+                    Max number of alignments to keep. If exceeded, the least
+                    recently used alignments are evicted. Each alignment
+                    takes up about 24 bytes per point of the query neuron.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(n=3) * (8 / 1000)
+    >>> cache = navis.nbl.AlignmentCache('~/align_cache.db')         # doctest: +SKIP
+    >>> scores = navis.nblast_align(nl, nl, align_cache=cache)       # doctest: +SKIP
+    >>> # This will re-use the alignments from above
+    >>> scores = navis.nblast_align(nl, nl, smat='v1', align_cache=cache)  # doctest: +SKIP
+
+    """
+
+    def __init__(self, path=None, max_size=None):
+        self.path = Path(path).expanduser() if path is not None else None
+        self.max_size = max_size
+
+        self.con = sqlite3.connect(self.path if self.path else ':memory:')
+        with self.con:
+            self.con.execute('CREATE TABLE IF NOT EXISTS alignments '
+                             '(key TEXT PRIMARY KEY, coords BLOB, accessed INTEGER)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS alignments_accessed '
+                             'ON alignments (accessed)')
+
+        self.n_alignments = self.con.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+        self._clock = self.con.execute('SELECT MAX(accessed) FROM alignments').fetchone()[0] or 0
+
+    def __repr__(self):
+        return (f'<{type(self).__name__}(path="{self.path}", '
+                f'n_alignments={self.n_alignments})>')
+
+    def __len__(self):
+        return self.n_alignments
+
+    def __getstate__(self):
+        raise TypeError('`AlignmentCache` can not be pickled.')
+
+    def close(self):
+        """Close connection to the database."""
+        self.con.close()
+
+    def clear(self):
+        """Remove all alignments."""
+        with self.con:
+            self.con.execute('DELETE FROM alignments')
+        self.n_alignments = 0
+
+    def lookup(self, keys):
+        """Fetch alignments from the cache.
+
+        Parameters
+        ----------
+        keys :      iterable of str
+                    Alignment keys (see `alignment_key`).
+
+        Returns
+        -------
+        dict
+                    Maps keys to aligned coordinates. Keys not in the cache
+                    are missing.
+
+        """
+        keys = list(set(keys))
+        found = {}
+        for i in range(0, len(keys), SQL_MAX_VARS):
+            chunk = keys[i:i + SQL_MAX_VARS]
+            q = ','.join('?' * len(chunk))
+            for k, blob in self.con.execute('SELECT key, coords FROM alignments '
+                                            f'WHERE key IN ({q})', chunk):
+                found[k] = np.load(io.BytesIO(blob), allow_pickle=False)
+
+        # Mark these alignments as recently used
+        self._clock += 1
+        with self.con:
+            self.con.executemany('UPDATE alignments SET accessed = ? WHERE key = ?',
+                                 [(self._clock, k) for k in found])
+
+        return found
+
+    def store(self, alignments):
+        """Add alignments to the cache.
+
+        Parameters
+        ----------
+        alignments :    dict
+                        Maps keys (see `alignment_key`) to aligned
+                        coordinates.
+
+        """
+        if not alignments:
+            return
+
+        rows = []
+        for k, co in alignments.items():
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(co), allow_pickle=False)
+            rows.append((k, buf.getvalue()))
+
+        self._clock += 1
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)',
+                                 [(k, b, self._clock) for k, b in rows])
+        self.n_alignments = self.con.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+
+        self.evict()
+
+    def evict(self):
+        """Evict least recently used alignments if cache is too large."""
+        if not self.max_size or self.n_alignments <= self.max_size:
+            return
+
+        n_evict = self.n_alignments - self.max_size
+        with self.con:
+            self.con.execute('DELETE FROM alignments WHERE key IN '
+                             '(SELECT key FROM alignments ORDER BY accessed LIMIT ?)',
+                             (n_evict, ))
+        self.n_alignments = self.con.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+        logger.debug(f'Evicted {n_evict} alignments from cache.')
+
+
+def alignment_key(query_md5, target_md5, method, sample, **kwargs):
+    """Generate key for the alignment of query onto target.
+
+    Parameters
+    ----------
+    query_md5,target_md5 :  str
+                            Content hashes (`core_md5`) of query and target.
+    method :                str | callable
+                            Alignment method.
+    sample :                float, optional
+                            Fraction of points used for the alignment.
+    **kwargs
+                            Additional parameters for the alignment.
+
+    """
+    if callable(method):
+        method = f'{method.__module__}.{method.__qualname__}'
+    return hash_params(query=query_md5, target=target_md5, method=method,
+                       sample=sample, kwargs=sorted(kwargs.items()))
+
+
+def parse_alignment_cache(cache):
+    """Parse `align_cache` parameter into an AlignmentCache."""
+    if cache is None or isinstance(cache, AlignmentCache):
+        return cache
+    elif cache is True:
+        return AlignmentCache()
+    elif isinstance(cache, (str, Path)):
+        return AlignmentCache(cache)
+    raise TypeError('`align_cache` must be None, True, a filepath or an '
+                    f'AlignmentCache, got "{type(cache)}"')
@@ -0,0 +1,153 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Checkpointing of NBLAST jobs."""
+
+import hashlib
+import os
+import pickle
+import uuid
+
+import numpy as np
+
+from pathlib import Path
+
+from .. import config
+
+try:
+    import xxhash
+except ModuleNotFoundError:
+    xxhash = None
+
+__all__ = ['Checkpoint']
+
+logger = config.get_logger(__name__)
+
+
+class Checkpoint:
+    """Directory-backed store for the results of finished NBLAST tiles.
+
+    Each tile is saved as `{key}.npy` where the key is a hash of the scoring
+    parameters and of whatever identifies the tile (typically the IDs and
+    `core_md5` of the query and target neurons). Re-running the same NBLAST
+    with the same checkpoint directory will skip tiles that have already
+    been computed.
+
+    Parameters
+    ----------
+    path :      str
+                Directory to store tiles in. Will be created if it doesn't
+                exist.
+    **params
+                Scoring parameters (e.g. `smat`, `limit_dist`, etc.) that
+                affect the scores. Tiles computed with different parameters
+                will not be re-used.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(n=5)
+    >>> dp = navis.make_dotprops(nl, k=5) / 125
+    >>> scores = navis.nblast(dp, dp, n_cores=1,
+    ...                       checkpoint='/tmp/nblast_checkpoint')   # doctest: +SKIP
+    >>> # Running it again will load the tiles from the checkpoint
+    >>> scores = navis.nblast(dp, dp, n_cores=1,
+    ...                       checkpoint='/tmp/nblast_checkpoint')   # doctest: +SKIP
+
+    """
+
+    def __init__(self, path, **params):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.params = hash_params(**params)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(path="{self.path}", n_tiles={self.n_tiles})>'
+
+    @property
+    def n_tiles(self):
+        """Number of tiles in the checkpoint."""
+        return len(list(self.path.glob('*.npy')))
+
+    def key(self, *x):
+        """Generate key from the scoring parameters and `x`.
+
+        Parameters
+        ----------
+        *x :    str | array-like
+                Anything that identifies the tile.
+
+        """
+        h = _hasher()
+        h.update(self.params.encode())
+        for v in x:
+            h.update(np.ascontiguousarray(np.asarray(v).astype(str)).tobytes())
+            # Separator so that ("ab", "c") and ("a", "bc") give different keys
+            h.update(b'|')
+        return h.hexdigest()
+
+    def load(self, key):
+        """Load tile. Returns `None` if the tile doesn't exist."""
+        fp = self.path / f'{key}.npy'
+        if not fp.is_file():
+            return None
+        try:
+            return np.load(fp)
+        except (ValueError, OSError, EOFError):
+            # This could happen if the file was corrupted somehow
+            logger.warning(f'Unable to load checkpoint "{fp}" - will recompute.')
+            return None
+
+    def save(self, key, data):
+        """Save tile."""
+        fp = self.path / f'{key}.npy'
+        # Write to a temporary file first and then move: this way we never
+        # end up with half-written tiles if the process is killed
+        tmp = self.path / f'.{key}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(data))
+        os.replace(tmp, fp)
+
+    def clear(self):
+        """Remove all tiles."""
+        for fp in self.path.glob('*.npy'):
+            fp.unlink()
+
+
+def hash_params(**params):
+    """Generate a hash for a set of (scoring) parameters.
+
+    Parameters are pickled where possible (e.g. for DataFrames, scoring
+    functions, etc.) and represented as strings otherwise.
+
+    """
+    h = _hasher()
+    for k in sorted(params):
+        try:
+            v = pickle.dumps(params[k], protocol=4)
+        except BaseException:
+            v = repr(params[k]).encode()
+        h.update(k.encode())
+        h.update(v)
+    return h.hexdigest()
+
+
+def neuron_keys(x):
+    """Generate "{id}:{core_md5}" key for each neuron."""
+    return np.array([f'{n.id}:{n.core_md5}' for n in x])
+
+
+def _hasher():
+    if xxhash:
+        return xxhash.xxh128()
+    return hashlib.md5()
@@ -15,6 +15,7 @@
 """Module contains functions implementing NBLAST."""
 
 import time
+import itertools
 import numbers
 import os
 import operator
@@ -25,14 +26,22 @@ import pandas as pd
 import multiprocessing as mp
 
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import SimpleNamespace
 from typing import Callable, Dict, Union, Optional
 from typing_extensions import Literal
 
-from navis.nbl.smat import Lookup2d, smat_fcwb, _nblast_v1_scoring
+from navis.nbl.smat import (Lookup2d, LookupNd, Digitizer, SimpleLookup,
+                            smat_fcwb, _nblast_v1_scoring)
 
 from .. import utils, config
 from ..core import NeuronList, Dotprops, make_dotprops
-from .base import Blaster, NestedIndices
+from .base import Blaster, NestedIndices, FLOAT_DTYPES, combine_scores
+from .cache import ScoreCache, cached_scores, parse_cache
+from .checkpoint import Checkpoint, hash_params, neuron_keys
+from .scheduler import (TILES_PER_WORKER, Tile, TileScheduler, make_tiles,
+                        point_cost, run_tiles)
+from .shared import share_dotprops
+from .writers import ScoreWriter, collect_scores, parse_writer
 
 __all__ = ['nblast', 'nblast_smart', 'nblast_allbyall', 'sim_to_dist']
 
@@ -46,7 +55,6 @@ logger = config.get_logger(__name__)
 # Larger multiplier = larger job sizes = fewer jobs = slower updates & less overhead
 # Smaller multiplier = smaller job sizes = more jobs = faster updates & more overhead
 JOB_SIZE_MULTIPLIER = 1
-JOB_MAX_TIME_SECONDS = 60 * 30
 
 # This controls how many threads we allow pykdtree to use during multi-core
 # NBLAST
@@ -54,6 +62,11 @@ OMP_NUM_THREADS_LIMIT = 1
 
 ALLOWED_SCORES = ('forward', 'mean', 'min', 'max', 'both')
 
+# Max number of query points that are concatenated into a single block for
+# the batched NBLAST kernel (see `NBlaster.multi_query_target`). Larger blocks
+# mean fewer KD-tree queries but also more memory (~40 bytes per point).
+BATCH_MAX_POINTS = 1_000_000
+
 
 class NBlaster(Blaster):
     """Implements version 2 of the NBLAST algorithm.
@@ -94,6 +107,20 @@ class NBlaster(Blaster):
                     highest distance considered by the scoring function. If
                     "auto", will extract that value from the first axis of the
                     scoring matrix.
+    batched :       bool
+                    If True (default), `multi_query_target` will use a batched
+                    kernel that concatenates the points of many queries,
+                    queries each target's KD-tree once per block of queries
+                    and scores all matches with a single call to the scoring
+                    function. This removes most of the per-pair overhead
+                    which dominates for small dotprops.
+    prune_bbox :    bool
+                    If True and `limit_dist` is set, will skip pairs whose
+                    bounding boxes are farther apart than `limit_dist`. None
+                    of the query's points can have a nearest neighbour within
+                    `limit_dist` in such targets, so their score is known to
+                    be the "no neighbour" floor: `score_fn(limit_dist, 0)`
+                    for each query point.
     progress :      bool
                     If True, will show a progress bar.
 
@@ -101,12 +128,15 @@ class NBlaster(Blaster):
 
     def __init__(self, use_alpha=False, normalized=True, smat='auto',
                  limit_dist=None, approx_nn=False, dtype=np.float64,
-                 progress=True, smat_kwargs=dict()):
+                 batched=True, prune_bbox=False, progress=True,
+                 smat_kwargs=dict()):
         """Initialize class."""
         super().__init__(progress=progress, dtype=dtype)
         self.use_alpha = use_alpha
         self.normalized = normalized
         self.approx_nn = approx_nn
+        self.batched = batched
+        self.bboxes = []
         self.desc = "NBlasting"
 
         if smat is None:
@@ -136,6 +166,13 @@ class NBlaster(Blaster):
         else:
             self.distance_upper_bound = limit_dist
 
+        # Pruning only works if there is an upper bound for the distances
+        self.prune_bbox = bool(prune_bbox and self.distance_upper_bound)
+        if self.prune_bbox:
+            # Score for a point without a nearest neighbour within the bound
+            self.floor_score = float(np.asarray(self.score_fn(np.array([self.distance_upper_bound], dtype=float),
+                                                              np.array([0.0]))).ravel()[0])
+
     def append(self, dotprops: Dotprops, self_hit: Optional[float] = None) -> NestedIndices:
         """Append dotprops.
 
@@ -158,6 +195,13 @@ class NBlaster(Blaster):
         next_id = len(self)
         self.neurons.append(dotprops)
         self.ids.append(dotprops.id)
+        if self.prune_bbox:
+            # Bounding box of the points (NaN for empty dotprops)
+            bbox = np.full((2, 3), np.nan)
+            if len(dotprops.points):
+                bbox = np.vstack((dotprops.points.min(axis=0),
+                                  dotprops.points.max(axis=0)))
+            self.bboxes.append(bbox)
         # Calculate score for self hit
         if not self_hit:
             self.self_hits.append(self.calc_self_hit(dotprops))
@@ -165,8 +209,21 @@ class NBlaster(Blaster):
             self.self_hits.append(self_hit)
         return next_id
 
+    @property
+    def self_hit_key(self):
+        """Key for self-hits stored with dotprops (see `navis.write_h5`)."""
+        if not hasattr(self, '_self_hit_key'):
+            self._self_hit_key = hash_params(use_alpha=self.use_alpha,
+                                             score_fn=_score_fn_key(self.score_fn))
+        return self._self_hit_key
+
     def calc_self_hit(self, dotprops):
         """Non-normalized value for self hit."""
+        # Use the stored self-hit if there is one for this scoring function
+        stored = getattr(dotprops, '_self_hits', None)
+        if stored and self.self_hit_key in stored:
+            return stored[self.self_hit_key]
+
         if not self.use_alpha:
             return len(dotprops.points) * self.score_fn(0, 1.0)
         else:
@@ -183,19 +240,23 @@ class NBlaster(Blaster):
                 return 1
             return self.self_hits[q_idx]
 
-        # Run nearest-neighbor search for query against target
-        data = self.neurons[q_idx].dist_dots(self.neurons[t_idx],
-                                             alpha=self.use_alpha,
-                                             # eps=0.1 means we accept 10% inaccuracy
-                                             eps=.1 if self.approx_nn else 0,
-                                             distance_upper_bound=self.distance_upper_bound)
-        if self.use_alpha:
-            dists, dots, alpha = data
-            dots *= np.sqrt(alpha)
+        if self.prune_bbox and not self.within_reach([q_idx], [t_idx])[0, 0]:
+            # No point in the query can have a nearest neighbour in the target
+            scr = len(self.neurons[q_idx].points) * self.floor_score
         else:
-            dists, dots = data
+            # Run nearest-neighbor search for query against target
+            data = self.neurons[q_idx].dist_dots(self.neurons[t_idx],
+                                                 alpha=self.use_alpha,
+                                                 # eps=0.1 means we accept 10% inaccuracy
+                                                 eps=.1 if self.approx_nn else 0,
+                                                 distance_upper_bound=self.distance_upper_bound)
+            if self.use_alpha:
+                dists, dots, alpha = data
+                dots *= np.sqrt(alpha)
+            else:
+                dists, dots = data
 
-        scr = self.score_fn(dists, dots).sum()
+            scr = self.score_fn(dists, dots).sum()
 
         # Normalize against best hit
         if self.normalized:
@@ -216,6 +277,217 @@ class NBlaster(Blaster):
 
         return scr
 
+    def multi_query_target(self, q_idx, t_idx, scores='forward'):
+        """NBLAST multiple queries against multiple targets.
+
+        Parameters
+        ----------
+        q_idx,t_idx :       iterable
+                            Iterable of query/target neuron indices to BLAST.
+        scores :            "forward" | "mean" | "min" | "max" | "both"
+                            Which scores to return.
+
+        """
+        if not self.batched:
+            return super().multi_query_target(q_idx, t_idx, scores=scores)
+
+        q_idx = np.asarray(q_idx, dtype=int)
+        t_idx = np.asarray(t_idx, dtype=int)
+
+        res = self._batched_scores(q_idx, t_idx)
+
+        # For anything but forward scores we also need the reverse scores
+        if scores != 'forward':
+            res = combine_scores(res, self._batched_scores(t_idx, q_idx).T,
+                                 scores=scores)
+
+        return self._results_to_frame(res.astype(self.dtype, copy=False),
+                                      q_idx, t_idx)
+
+    def _batched_scores(self, q_idx, t_idx):
+        """Forward scores for all queries against all targets.
+
+        Points of (blocks of) queries are concatenated and queried against
+        each target's KD-tree in one go. Scores per query are then produced
+        from a single call to the scoring function and a segmented sum.
+
+        Returns
+        -------
+        np.ndarray
+                    (len(q_idx), len(t_idx)) array of forward scores.
+
+        """
+        res = np.empty((len(q_idx), len(t_idx)), dtype=np.float64)
+        self_hits = np.asarray(self.self_hits, dtype=np.float64)
+
+        # Scipy's KDTree does not like the distance to be None
+        diub = self.distance_upper_bound if self.distance_upper_bound else np.inf
+
+        blocks = self._query_blocks(q_idx)
+        with config.tqdm(desc=self.desc,
+                         total=len(blocks) * len(t_idx),
+                         leave=False,
+                         position=getattr(self, 'pbar_position', None),
+                         disable=not self.progress) as pbar:
+            for block in blocks:
+                qs = [self.neurons[q] for q in q_idx[block]]
+                n_points = np.array([len(q.points) for q in qs])
+                offsets = np.cumsum([0] + [len(q.points) for q in qs[:-1]])
+                points = np.concatenate([q.points for q in qs])
+                vect = np.concatenate([q.vect for q in qs])
+                if self.use_alpha:
+                    alpha = np.concatenate([q.alpha for q in qs])
+
+                if self.prune_bbox:
+                    # (queries, targets) array of pairs that are within reach
+                    reach = self.within_reach(q_idx[block], t_idx)
+                    # Index of the query each point belongs to
+                    owner = np.repeat(np.arange(len(qs)), n_points)
+
+                # pykdtree requires query points to be of the same dtype
+                # as the tree -> cache the cast points
+                cast = {}
+
+                for k, t in enumerate(t_idx):
+                    tn = self.neurons[t]
+                    dt = tn.points.dtype
+                    if dt not in cast:
+                        cast[dt] = points.astype(dt, copy=False)
+
+                    this_points, this_vect = cast[dt], vect
+                    this_offsets, this_block = offsets, block
+                    if self.use_alpha:
+                        this_alpha = alpha
+
+                    if self.prune_bbox:
+                        near = reach[:, k]
+                        if not near.all():
+                            res[block[~near], k] = n_points[~near] * self.floor_score
+                            if not near.any():
+                                pbar.update()
+                                continue
+                            # Only query points of queries within reach
+                            sel = near[owner]
+                            this_points, this_vect = this_points[sel], vect[sel]
+                            this_offsets = np.cumsum(np.append(0, n_points[near][:-1]))
+                            this_block = block[near]
+                            if self.use_alpha:
+                                this_alpha = alpha[sel]
+
+                    dists, ix = tn.kdtree.query(this_points,
+                                                distance_upper_bound=diub,
+                                                # eps=0.1 means we accept 10% inaccuracy
+                                                eps=.1 if self.approx_nn else 0)
+
+                    # See `Dotprops.dist_dots` for handling of points
+                    # without a nearest neighbour within the upper bound
+                    if self.distance_upper_bound:
+                        no_nn = dists == np.inf
+                        dists[no_nn] = self.distance_upper_bound
+                        ix[no_nn] = 0
+
+                    dots = np.abs((this_vect * tn.vect[ix]).sum(axis=1))
+                    if self.use_alpha:
+                        dots *= np.sqrt(this_alpha * tn.alpha[ix])
+                    if self.distance_upper_bound:
+                        dots[no_nn] = 0
+
+                    scr = self.score_fn(dists, dots)
+                    # Accumulate in double precision even if scores are not
+                    res[this_block, k] = np.add.reduceat(scr, this_offsets,
+                                                         dtype=np.float64)
+
+                    pbar.update()
+
+        # Normalize against best hit
+        if self.normalized:
+            res /= self_hits[q_idx].reshape(-1, 1)
+
+        # Fix self-self comparisons
+        is_self = q_idx.reshape(-1, 1) == t_idx.reshape(1, -1)
+        if np.any(is_self):
+            res[is_self] = 1 if self.normalized else self_hits[q_idx[np.where(is_self)[0]]]
+
+        return res
+
+    def within_reach(self, q_idx, t_idx):
+        """Check which query/target pairs are within `limit_dist` of each other.
+
+        Uses the distance between the bounding boxes of the points which
+        is a lower bound for the distance between any two points.
+
+        Returns
+        -------
+        np.ndarray
+                    (len(q_idx), len(t_idx)) boolean array.
+
+        """
+        q_bbox = np.stack([self.bboxes[i] for i in q_idx])  # (Q, 2, 3)
+        t_bbox = np.stack([self.bboxes[i] for i in t_idx])  # (T, 2, 3)
+
+        # Per-axis gap between boxes (0 if they overlap along that axis)
+        gap = np.maximum(q_bbox[:, None, 0] - t_bbox[None, :, 1],
+                         t_bbox[None, :, 0] - q_bbox[:, None, 1])
+        gap = np.maximum(gap, 0)
+
+        # Note that comparisons with NaN (empty dotprops) are always False
+        return ~((gap ** 2).sum(axis=2) > self.distance_upper_bound ** 2)
+
+    def _query_blocks(self, q_idx):
+        """Split queries into blocks of at most `BATCH_MAX_POINTS` points."""
+        n_points = np.array([len(self.neurons[q].points) for q in q_idx])
+        # Block ID for each query
+        block_id = np.cumsum(n_points) // BATCH_MAX_POINTS
+        return [np.where(block_id == b)[0] for b in np.unique(block_id)]
+
+
+def calc_self_hits(x, configs=True):
+    """Calculate NBLAST self-hits to store with dotprops.
+
+    Parameters
+    ----------
+    x :         Dotprops
+    configs :   True | dict | list of dicts
+                Scoring configurations as keyword arguments for `NBlaster`,
+                e.g. `{'use_alpha': True}`. `True` uses the defaults.
+
+    Returns
+    -------
+    dict
+                Maps `NBlaster.self_hit_key` to self-hit values.
+
+    """
+    if configs is True:
+        configs = [{}]
+    elif isinstance(configs, dict):
+        configs = [configs]
+
+    self_hits = {}
+    for cfg in configs:
+        nb = NBlaster(progress=False, **cfg)
+        self_hits[nb.self_hit_key] = float(nb.calc_self_hit(x))
+    return self_hits
+
+
+def _score_fn_key(score_fn):
+    """Turn scoring function into something that can be hashed.
+
+    Lookup tables are represented by their boundaries and cell values. This
+    way the key does not depend on other (e.g. cached) attributes.
+    """
+    if isinstance(score_fn, LookupNd):
+        axes = []
+        for ax in score_fn.axes:
+            if isinstance(ax, Digitizer):
+                axes.append(('digitizer', np.asarray(ax.boundaries).tolist(),
+                             bool(ax.right)))
+            elif isinstance(ax, SimpleLookup):
+                axes.append(('items', list(ax.items)))
+            else:
+                axes.append(repr(ax))
+        return (axes, np.asarray(score_fn.cells).tolist())
+    return score_fn
+
 
 def nblast_smart(query: Union[Dotprops, NeuronList],
                  target: Optional[str] = None,
@@ -235,6 +507,8 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                  approx_nn: bool = False,
                  precision: Union[int, str, np.dtype] = 64,
                  n_cores: int = os.cpu_count() // 2,
+                 checkpoint: Optional[str] = None,
+                 cache: Optional[Union[str, ScoreCache]] = None,
                  progress: bool = True,
                  smat_kwargs: Optional[Dict] = dict()) -> pd.DataFrame:
     """Smart(er) NBLAST query against target neurons.
@@ -323,6 +597,19 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                     `os.cpu_count() // 2`. This should ideally be an even
                     number as that allows optimally splitting queries onto
                     individual processes.
+    checkpoint :    str, optional
+                    Path to a directory in which finished jobs are saved
+                    (see `navis.nbl.checkpoint.Checkpoint`). If the NBLAST is
+                    interrupted, re-running it with the same checkpoint
+                    directory will skip jobs that were already completed.
+                    Jobs are identified by the neurons' IDs and `core_md5`
+                    plus the scoring parameters.
+    cache :         str | ScoreCache, optional
+                    Persistent cache for scores (see
+                    `navis.nbl.cache.ScoreCache`) or path to one. Scores are
+                    keyed by the neurons' `core_md5` and the scoring
+                    parameters: only pairs not already in the cache are
+                    computed and then added to it.
     progress :      bool
                     Whether to show progress bars.
 
@@ -446,6 +733,19 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
     query_self_hits = np.array([nb.calc_self_hit(n) for n in query_dps_simp])
     target_self_hits = np.array([nb.calc_self_hit(n) for n in target_dps_simp])
 
+    # Set up checkpointing
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint,
+                                use_alpha=use_alpha,
+                                normalized=normalized,
+                                smat=smat,
+                                limit_dist=limit_dist,
+                                approx_nn=approx_nn,
+                                dtype=nb.dtype,
+                                smat_kwargs=smat_kwargs)
+        query_keys_simp = neuron_keys(query_dps_simp)
+        target_keys_simp = neuron_keys(target_dps_simp) if not aba else query_keys_simp
+
     # This makes sure we don't run into multiple layers of concurrency
     with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None):
         # Initialize a pool of workers
@@ -461,8 +761,20 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                              disable=not progress) as pbar:
                 futures = {}
                 nblasters = []
+                restored = []
                 for qix in np.array_split(np.arange(len(query_dps_simp)), n_rows):
                     for tix in np.array_split(np.arange(len(target_dps_simp)), n_cols):
+                        # Skip tiles we already have results for
+                        if checkpoint:
+                            key = checkpoint.key(query_keys_simp[qix],
+                                                 target_keys_simp[tix],
+                                                 pre_scores)
+                            res = checkpoint.load(key)
+                            if res is not None:
+                                restored.append((qix, tix, res))
+                                pbar.update()
+                                continue
+
                         # Initialize NBlaster
                         this = NBlaster(use_alpha=use_alpha,
                                         normalized=normalized,
@@ -484,6 +796,7 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                         this.targets = np.arange(len(tix)) + len(qix)
                         this.queries_ix = qix  # this facilitates filling in the big matrix later
                         this.targets_ix = tix  # this facilitates filling in the big matrix later
+                        this.checkpoint_key = key if checkpoint else None
                         this.pbar_position = len(nblasters) if not utils.is_jupyter() else None
 
                         nblasters.append(this)
@@ -497,36 +810,42 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                                                 t_idx=this.targets,
                                                 scores=pre_scores)] = this
 
+            # Prepare empty score matrix
+            scr = pd.DataFrame(np.empty((len(query_dps_simp),
+                                         len(target_dps_simp)),
+                                        dtype=nb.dtype),
+                               index=query_dps_simp.id,
+                               columns=target_dps_simp.id)
+            scr.index.name = 'query'
+            scr.columns.name = 'target'
+
             # Collect results
-            if futures and len(futures) > 1:
-                # Prepare empty score matrix
-                scr = pd.DataFrame(np.empty((len(query_dps_simp),
-                                             len(target_dps_simp)),
-                                            dtype=this.dtype),
-                                      index=query_dps_simp.id,
-                                      columns=target_dps_simp.id)
-                scr.index.name = 'query'
-                scr.columns.name = 'target'
-
-                # Collect results
+            if futures:
                 # We're dropping the "N / N_total" bit from the progress bar because
                 # it's not helpful here
                 fmt = ('{desc}: {percentage:3.0f}%|{bar}| [{elapsed}<{remaining}]')
-                for f in config.tqdm(as_completed(futures),
-                                     desc='Pre-NBLASTs',
-                                     bar_format=fmt,
-                                     total=len(futures),
-                                     smoothing=0,
-                                     disable=not progress,
-                                     leave=False):
-                    res = f.result()
-                    this = futures[f]
-                    # Fill-in big score matrix
-                    scr.iloc[this.queries_ix, this.targets_ix] = res.values
+                done = ((futures[f], f.result()) for f in config.tqdm(as_completed(futures),
+                                                                      desc='Pre-NBLASTs',
+                                                                      bar_format=fmt,
+                                                                      total=len(futures),
+                                                                      smoothing=0,
+                                                                      disable=not progress,
+                                                                      leave=False))
             else:
-                scr = this.multi_query_target(this.queries,
-                                              this.targets,
-                                              scores=scores)
+                done = ((this, this.multi_query_target(this.queries,
+                                                       this.targets,
+                                                       scores=pre_scores))
+                        for this in nblasters)
+
+            for qix, tix, res in restored:
+                scr.iloc[qix, tix] = res
+
+            for this, res in done:
+                res = res.values
+                if checkpoint:
+                    checkpoint.save(this.checkpoint_key, res)
+                # Fill-in big score matrix
+                scr.iloc[this.queries_ix, this.targets_ix] = res
 
     # If this is an all-by-all and we would have computed only forward scores
     # during pre-NBLAST
@@ -545,17 +864,45 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
     else:
         # Sort such that the top hit is to the left
         srt = np.argsort(scr.values, axis=1)[:, ::-1]
-        # Generate the mask
-        mask = pd.DataFrame(np.zeros(scr.shape, dtype=bool),
-                            columns=scr.columns, index=scr.index)
+        # Generate the mask (note that we can't write to `DataFrame.values`
+        # with copy-on-write enabled)
+        mask = np.zeros(scr.shape, dtype=bool)
         _ = np.arange(mask.shape[0])
         for N in range(t):
-            mask.values[_, srt[:, N]] = True
+            mask[_, srt[:, N]] = True
+        mask = pd.DataFrame(mask, columns=scr.columns, index=scr.index)
+
+    # Fetch full scores we already have from the cache
+    cache = parse_cache(cache)
+    if cache is not None:
+        params = dict(kind='nblast',
+                      use_alpha=use_alpha,
+                      normalized=normalized,
+                      smat=smat,
+                      limit_dist=limit_dist,
+                      approx_nn=approx_nn,
+                      precision=np.dtype(nb.dtype).str,
+                      smat_kwargs=smat_kwargs)
+        # Forward scores are shared with `navis.nblast`
+        if scores != 'forward':
+            params['scores'] = scores
+        params = hash_params(**params)
+        cache_q_keys = np.array([n.core_md5 for n in query_dps])
+        cache_t_keys = np.array([n.core_md5 for n in target_dps])
+        cached = cache.lookup(params, cache_q_keys, cache_t_keys)
+        from_cache = mask.values & ~np.isnan(cached)
+        to_run = mask & ~from_cache
+    else:
+        to_run = mask
 
     # Calculate self-hits for full neurons
     query_self_hits = np.array([nb.calc_self_hit(n) for n in query_dps])
     target_self_hits = np.array([nb.calc_self_hit(n) for n in target_dps])
 
+    if checkpoint:
+        ckpt_q_keys = neuron_keys(query_dps)
+        ckpt_t_keys = neuron_keys(target_dps) if not aba else ckpt_q_keys
+
     # This makes sure we don't run into multiple layers of concurrency
     with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None):
         # Initialize a pool of workers
@@ -571,6 +918,7 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                              disable=not progress) as pbar:
                 futures = {}
                 nblasters = []
+                restored = []
                 for qix in np.array_split(np.arange(len(query_dps)), n_rows):
                     for tix in np.array_split(np.arange(len(target_dps)), n_cols):
                         # Initialize NBlaster
@@ -589,8 +937,8 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                             this.append(target_dps[ix], target_self_hits[ix])
 
                         # Find the pairs to NBLAST in this part of the matrix
-                        submask = mask.loc[query_dps[qix].id,
-                                           target_dps[tix].id]
+                        submask = to_run.loc[query_dps[qix].id,
+                                             target_dps[tix].id]
                         # `pairs` is an array of `[[query, target], [...]]` pairs
                         this.pairs = np.vstack(np.where(submask)).T
 
@@ -601,6 +949,18 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                         this.mask = np.zeros(mask.shape, dtype=bool)
                         this.mask[qix[0]:qix[-1]+1, tix[0]:tix[-1]+1] = submask
 
+                        # Skip tiles we already have results for
+                        if checkpoint:
+                            this.checkpoint_key = checkpoint.key(ckpt_q_keys[qix],
+                                                                 ckpt_t_keys[tix],
+                                                                 scores,
+                                                                 this.pairs)
+                            res = checkpoint.load(this.checkpoint_key)
+                            if res is not None:
+                                restored.append((this, res))
+                                pbar.update()
+                                continue
+
                         # Make sure position of progress bar checks out
                         this.pbar_position = len(nblasters) if not utils.is_jupyter() else None
                         this.desc = 'Full NBLAST'
@@ -616,25 +976,36 @@ def nblast_smart(query: Union[Dotprops, NeuronList],
                                                 scores=scores)] = this
 
             # Collect results
-            if futures and len(futures) > 1:
-                # Collect results
+            if futures:
                 # We're dropping the "N / N_total" bit from the progress bar because
                 # it's not helpful here
                 fmt = ('{desc}: {percentage:3.0f}%|{bar}| [{elapsed}<{remaining}]')
-                for f in config.tqdm(as_completed(futures),
-                                     desc='NBLASTing',
-                                     bar_format=fmt,
-                                     total=len(futures),
-                                     smoothing=0,
-                                     disable=not progress,
-                                     leave=False):
-                    res = f.result()
-                    this = futures[f]
-
-                    # Fill-in big score matrix
-                    scr[this.mask] = res
+                done = ((futures[f], f.result()) for f in config.tqdm(as_completed(futures),
+                                                                      desc='NBLASTing',
+                                                                      bar_format=fmt,
+                                                                      total=len(futures),
+                                                                      smoothing=0,
+                                                                      disable=not progress,
+                                                                      leave=False))
             else:
-                scr[mask] = this.pair_query_target(this.pairs, scores=scores)
+                done = ((this, this.pair_query_target(this.pairs, scores=scores))
+                        for this in nblasters)
+
+            # Fill-in big score matrix
+            values = scr.to_numpy(copy=True)
+            for this, res in restored:
+                values[this.mask] = res
+
+            for this, res in done:
+                if checkpoint:
+                    checkpoint.save(this.checkpoint_key, res)
+                values[this.mask] = res
+
+            if cache is not None:
+                values[from_cache] = cached[from_cache]
+                cache.store(params, cache_q_keys, cache_t_keys, values, mask=to_run.values)
+
+            scr = pd.DataFrame(values, index=scr.index, columns=scr.columns)
 
     if return_mask:
         return scr, mask
@@ -653,8 +1024,14 @@ def nblast(query: Union[Dotprops, NeuronList],
            smat: Optional[Union[str, pd.DataFrame, Callable]] = 'auto',
            limit_dist: Optional[Union[Literal['auto'], int, float]] = None,
            approx_nn: bool = False,
+           prune_bbox: bool = False,
            precision: Union[int, str, np.dtype] = 64,
+           compute_precision: Optional[Union[int, str, np.dtype]] = None,
            n_cores: int = os.cpu_count() // 2,
+           shared_memory: bool = False,
+           out: Optional[Union[str, ScoreWriter]] = None,
+           checkpoint: Optional[str] = None,
+           cache: Optional[Union[str, ScoreCache]] = None,
            progress: bool = True,
            smat_kwargs: Optional[Dict] = dict()) -> pd.DataFrame:
     """NBLAST query against target neurons.
@@ -720,17 +1097,69 @@ def nblast(query: Union[Dotprops, NeuronList],
                     If True, will use approximate nearest neighbors. This gives
                     a >2X speed up but also produces only approximate scores.
                     Impact depends on the use case - testing highly recommended!
+    prune_bbox :    bool
+                    If True and `limit_dist` is set, will skip the nearest-
+                    neighbour search for query/target pairs whose bounding
+                    boxes are farther apart than `limit_dist` and instead fill
+                    in the score for "no nearest neighbour within limit_dist".
+                    This gives the same scores but can be much faster for
+                    spatially spread-out neurons (e.g. whole-brain datasets).
     n_cores :       int, optional
                     Max number of cores to use for nblasting. Default is
                     `os.cpu_count() // 2`. This should ideally be an even
                     number as that allows optimally splitting queries onto
                     individual processes.
+    shared_memory : bool
+                    If True and using multiple cores, will pack the dotprops
+                    into shared memory (see `navis.nbl.shared.DotpropsStore`)
+                    instead of pickling them for every job. Workers will attach
+                    to that memory and re-use their KD-trees across jobs. This
+                    reduces overhead and memory footprint for large NBLASTs.
+    out :           str | ScoreWriter, optional
+                    Where to put the scores. By default (None), scores are
+                    collected in an in-memory DataFrame. Use this to stream
+                    results to disk as they come in and/or to keep only the
+                    useful part:
+
+                      - filepath ending with `.npy` will write to a
+                        memory-mapped array (see `navis.nbl.writers.NpyWriter`)
+                      - filepath ending with `.h5` will write to an HDF5
+                        dataset (see `navis.nbl.writers.H5Writer`)
+                      - `navis.nbl.writers.TopNWriter(N)` keeps only the top N
+                        targets for each query
+                      - `navis.nbl.writers.ThresholdWriter(threshold)` keeps
+                        only scores above a given threshold
+
+                    See the respective writer for what is returned.
+    checkpoint :    str, optional
+                    Path to a directory in which finished jobs are saved
+                    (see `navis.nbl.checkpoint.Checkpoint`). If the NBLAST is
+                    interrupted, re-running it with the same checkpoint
+                    directory will skip jobs that were already completed.
+                    Jobs are identified by the neurons' IDs and `core_md5`
+                    plus the scoring parameters.
+    cache :         str | ScoreCache, optional
+                    Persistent cache for scores (see
+                    `navis.nbl.cache.ScoreCache`) or path to one. Scores are
+                    keyed by the neurons' `core_md5` and the scoring
+                    parameters: only pairs not already in the cache are
+                    computed and then added to it.
     precision :     int [16, 32, 64] | str [e.g. "float64"] | np.dtype
                     Precision for scores. Defaults to 64 bit (double) floats.
                     This is useful to reduce the memory footprint for very large
                     matrices. In real-world scenarios 32 bit (single)- and
                     depending on the purpose even 16 bit (half) - are typically
                     sufficient.
+    compute_precision : int [32, 64] | str [e.g. "float32"] | np.dtype, optional
+                    Precision used for the computation itself (as opposed to
+                    `precision` which only affects the returned scores). If
+                    provided, points, tangent vectors and alpha values of all
+                    dotprops are cast (copies, not in place) to this precision
+                    once before NBLASTing. With 32 bit, KD-tree queries and
+                    score lookups all run in single precision which halves
+                    memory (bandwidth) compared to 64 bit. Scores typically
+                    match those of the 64 bit path to the third decimal. By
+                    default (None), dotprops are used as they are.
     progress :      bool
                     Whether to show progress bars. This may cause some overhead,
                     so switch off if you don't really need it.
@@ -775,6 +1204,7 @@ def nblast(query: Union[Dotprops, NeuronList],
 
     """
     utils.eval_param(scores, name='scores', allowed_values=ALLOWED_SCORES)
+    writer = parse_writer(out)
 
     if isinstance(target, type(None)):
         target = query
@@ -788,29 +1218,57 @@ def nblast(query: Union[Dotprops, NeuronList],
                      req_unique_ids=True,
                      req_microns=isinstance(smat, str) and smat=='auto')
 
-    # Find a partition that produces batches that each run in approximately
-    # 10 seconds
-    if n_cores and n_cores > 1:
-        if progress:
-            # If progress bar, we need to make smaller mini batches.
-            # These mini jobs must not be too small - otherwise the overhead
-            # from spawning and sending results between processes slows things
-            # down dramatically. Hence we want to make sure that each job runs
-            # for >10s. The run time depends on the system and how big the neurons
-            # are. Here, we run a quick test and try to extrapolate from there
-            n_rows, n_cols = find_batch_partition(query_dps, target_dps,
-                                                  T=10 * JOB_SIZE_MULTIPLIER)
+    # Cast dotprops to the compute precision
+    if compute_precision is not None:
+        compute_precision = parse_compute_precision(compute_precision)
+        query_dps, target_dps = align_dtypes(query_dps, target_dps,
+                                             dtype=compute_precision,
+                                             inplace=False)
+
+    # If we have a cache, we will run NBLASTs only for missing pairs
+    cache = parse_cache(cache)
+    if cache is not None:
+        dtype = np.dtype(FLOAT_DTYPES.get(precision, precision))
+        params = dict(kind='nblast',
+                      use_alpha=use_alpha,
+                      normalized=normalized,
+                      smat=smat,
+                      limit_dist=limit_dist,
+                      approx_nn=approx_nn,
+                      precision=dtype.str,
+                      compute_precision=str(compute_precision),
+                      smat_kwargs=smat_kwargs)
+        kwargs = dict(scores='forward',
+                      use_alpha=use_alpha,
+                      normalized=normalized,
+                      smat=smat,
+                      limit_dist=limit_dist,
+                      approx_nn=approx_nn,
+                      prune_bbox=prune_bbox,
+                      precision=precision,
+                      compute_precision=compute_precision,
+                      n_cores=n_cores,
+                      shared_memory=shared_memory,
+                      checkpoint=checkpoint,
+                      progress=progress,
+                      smat_kwargs=smat_kwargs)
+        query_keys = np.array([n.core_md5 for n in query_dps])
+        target_keys = np.array([n.core_md5 for n in target_dps])
+
+        fwd = cached_scores(nblast, query_dps, target_dps, cache, params,
+                            query_keys, target_keys, **kwargs)
+        if scores != 'forward':
+            rev = cached_scores(nblast, target_dps, query_dps, cache, params,
+                                target_keys, query_keys, **kwargs).T
+
+        writer.open(query_dps.id, target_dps.id, dtype, both=scores == 'both')
+        if scores == 'forward':
+            writer.write(fwd.astype(dtype), np.arange(len(query_dps)), np.arange(len(target_dps)))
         else:
-            # If no progress bar needed, we could just split neurons evenly across
-            # all available cores but that can lead to one core lagging behind
-            # and finishing much later than all the others. To avoid this, we
-            # should aim for each batch to finish in a certain amount of time
-            n_rows, n_cols = find_batch_partition(query_dps, target_dps,
-                                                  T=JOB_MAX_TIME_SECONDS)
-            if (n_rows * n_cols) < n_cores:
-                n_rows, n_cols = find_optimal_partition(n_cores, query_dps, target_dps)
-    else:
-        n_rows = n_cols = 1
+            collect_scores(writer, fwd.astype(dtype), rev.astype(dtype), scores=scores)
+        return writer.close()
+
+    use_pool = bool(n_cores and n_cores > 1)
 
     # Calculate self-hits once for all neurons
     nb = NBlaster(use_alpha=use_alpha,
@@ -824,8 +1282,104 @@ def nblast(query: Union[Dotprops, NeuronList],
     query_self_hits = np.array([nb.calc_self_hit(n) for n in query_dps])
     target_self_hits = np.array([nb.calc_self_hit(n) for n in target_dps])
 
+    # Set up checkpointing
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint,
+                                use_alpha=use_alpha,
+                                normalized=normalized,
+                                smat=smat,
+                                limit_dist=limit_dist,
+                                approx_nn=approx_nn,
+                                dtype=nb.dtype,
+                                compute_precision=str(compute_precision),
+                                smat_kwargs=smat_kwargs)
+        query_keys = neuron_keys(query_dps)
+        target_keys = neuron_keys(target_dps)
+        keys = {'forward': (query_keys, target_keys),
+                'reverse': (target_keys, query_keys)}
+
+    # Jobs only ever compute forward scores. For anything but
+    # `scores="forward"` we also run target->query jobs and combine forward
+    # and reverse scores at collection time (like `nblast_allbyall`). This
+    # way, pairs present in both queries and targets are computed only once.
+    q_cost = point_cost(query_dps.n_points)
+    t_cost = point_cost(target_dps.n_points)
+    regions = [Tile('forward', np.arange(len(query_dps)), np.arange(len(target_dps)),
+                    q_cost[0], t_cost[1])]
+    if scores != 'forward':
+        q_ov, t_ov = find_overlap(query_dps, target_dps)
+        q_rest = np.setdiff1d(np.arange(len(query_dps)), q_ov)
+        t_rest = np.setdiff1d(np.arange(len(target_dps)), t_ov)
+        # Targets that aren't also queries -> need reverse scores for all queries
+        # Targets that are also queries -> need reverse scores only for those
+        # queries that aren't also targets
+        for rows, cols in ((t_rest, np.arange(len(query_dps))), (t_ov, q_rest)):
+            regions.append(Tile('reverse', rows, cols, t_cost[0][rows], q_cost[1][cols]))
+
+    # Cut the score matrix into tiles of about equal cost. Without multiple
+    # cores we compute each region in one go
+    tiles = make_tiles(regions, n_tiles=n_cores * TILES_PER_WORKER if use_pool else 1)
+
+    # Skip tiles we already have results for
+    restored = []
+    if checkpoint:
+        to_run = []
+        for tile in tiles:
+            tile.key = checkpoint.key(keys[tile.direction][0][tile.rows],
+                                      keys[tile.direction][1][tile.cols],
+                                      'forward')
+            res = checkpoint.load(tile.key)
+            if res is not None:
+                restored.append((tile, res))
+            else:
+                to_run.append(tile)
+        tiles = to_run
+
+    use_pool = use_pool and len(tiles) > 1
+
+    # Tiles are only split further at run time if we don't need them to be
+    # stable for checkpointing
+    scheduler = TileScheduler(tiles, split=not checkpoint)
+
+    # Only pack dotprops into shared memory if we're actually using multiple
+    # processes
+    shared_memory = shared_memory and use_pool
+
     # This makes sure we don't run into multiple layers of concurrency
-    with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None):
+    with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None), \
+         share_dotprops(query_dps, target_dps,
+                        enabled=shared_memory,
+                        alpha=use_alpha) as (query_src, target_src):
+        sources = {'forward': (query_src, query_self_hits,
+                               target_src, target_self_hits),
+                   'reverse': (target_src, target_self_hits,
+                               query_src, query_self_hits)}
+
+        def make_job(tile):
+            # Initialize NBlaster
+            this = NBlaster(use_alpha=use_alpha,
+                            normalized=normalized,
+                            smat=smat,
+                            limit_dist=limit_dist,
+                            dtype=precision,
+                            approx_nn=approx_nn,
+                            prune_bbox=prune_bbox,
+                            # No progress bar for individual NBLASTERs
+                            progress=progress and not use_pool,
+                            smat_kwargs=smat_kwargs)
+
+            # Add queries and targets
+            q_src, q_self_hits, t_src, t_self_hits = sources[tile.direction]
+            for ix in tile.rows:
+                this.append(q_src[ix], q_self_hits[ix])
+            for ix in tile.cols:
+                this.append(t_src[ix], t_self_hits[ix])
+
+            return partial(this.multi_query_target,
+                           q_idx=np.arange(len(tile.rows)),
+                           t_idx=np.arange(len(tile.cols)) + len(tile.rows),
+                           scores='forward')
+
         # Initialize a pool of workers
         # Note that we're forcing "spawn" instead of "fork" (default on linux)!
         # This is to reduce the memory footprint since "fork" appears to inherit all
@@ -833,78 +1387,38 @@ def nblast(query: Union[Dotprops, NeuronList],
         # what's required to run the job?
         with ProcessPoolExecutor(max_workers=n_cores,
                                  mp_context=mp.get_context('spawn')) as pool:
-            with config.tqdm(desc='Preparing',
-                             total=n_rows * n_cols,
-                             leave=False,
-                             disable=not progress) as pbar:
-                futures = {}
-                nblasters = []
-                for qix in np.array_split(np.arange(len(query_dps)), n_rows):
-                    for tix in np.array_split(np.arange(len(target_dps)), n_cols):
-                        # Initialize NBlaster
-                        this = NBlaster(use_alpha=use_alpha,
-                                        normalized=normalized,
-                                        smat=smat,
-                                        limit_dist=limit_dist,
-                                        dtype=precision,
-                                        approx_nn=approx_nn,
-                                        progress=progress,
-                                        smat_kwargs=smat_kwargs)
-
-                        # Add queries and targets
-                        for i, ix in enumerate(qix):
-                            this.append(query_dps[ix], query_self_hits[ix])
-                        for i, ix in enumerate(tix):
-                            this.append(target_dps[ix], target_self_hits[ix])
-
-                        # Keep track of indices of queries and targets
-                        this.queries = np.arange(len(qix))
-                        this.targets = np.arange(len(tix)) + len(qix)
-                        this.queries_ix = qix  # this facilitates filling in the big matrix later
-                        this.targets_ix = tix  # this facilitates filling in the big matrix later
-                        this.pbar_position = len(nblasters) if not utils.is_jupyter() else None
-
-                        nblasters.append(this)
-                        pbar.update()
-
-                        # If multiple cores requested, submit job to the pool right away
-                        if n_cores and n_cores > 1 and (n_cols > 1 or n_rows > 1):
-                            this.progress=False  # no progress bar for individual NBLASTERs
-                            futures[pool.submit(this.multi_query_target,
-                                                q_idx=this.queries,
-                                                t_idx=this.targets,
-                                                scores=scores)] = this
+            # Prepare the output. Forward scores are passed straight to the
+            # writer; for anything else we need to (temporarily) keep forward
+            # and (transposed) reverse scores around
+            writer.open(query_dps.id, target_dps.id, nb.dtype, both=scores == 'both')
+            if scores != 'forward':
+                fwd = writer.buffer((len(query_dps), len(target_dps)), dtype=nb.dtype)
+                rev = writer.buffer((len(query_dps), len(target_dps)), dtype=nb.dtype)
 
             # Collect results
-            if futures and len(futures) > 1:
-                # Prepare empty score matrix
-                scores = pd.DataFrame(np.empty((len(query_dps), len(target_dps)),
-                                               dtype=this.dtype),
-                                      index=query_dps.id, columns=target_dps.id)
-                scores.index.name = 'query'
-                scores.columns.name = 'target'
-
-                # Collect results
-                # We're dropping the "N / N_total" bit from the progress bar because
-                # it's not helpful here
-                fmt = ('{desc}: {percentage:3.0f}%|{bar}| [{elapsed}<{remaining}]')
-                for f in config.tqdm(as_completed(futures),
-                                     desc='NBLASTing',
-                                     bar_format=fmt,
-                                     total=len(futures),
-                                     smoothing=0,
-                                     disable=not progress,
-                                     leave=False):
-                    res = f.result()
-                    this = futures[f]
-                    # Fill-in big score matrix
-                    scores.iloc[this.queries_ix, this.targets_ix] = res.values
-            else:
-                scores = this.multi_query_target(this.queries,
-                                                 this.targets,
-                                                 scores=scores)
+            done = run_tiles(scheduler, make_job,
+                             pool=pool if use_pool else None,
+                             n_workers=n_cores,
+                             progress=progress)
+            for tile, res in itertools.chain(restored, done):
+                # Results from the checkpoint are already arrays
+                if isinstance(res, pd.DataFrame):
+                    res = res.values
+                    if checkpoint:
+                        checkpoint.save(tile.key, res)
+
+                if scores == 'forward':
+                    writer.write(res, tile.rows, tile.cols)
+                elif tile.direction == 'forward':
+                    fwd[np.ix_(tile.rows, tile.cols)] = res
+                else:
+                    rev[np.ix_(tile.cols, tile.rows)] = res.T
+
+    if scores != 'forward':
+        collect_scores(writer, fwd, rev, scores=scores, overlap=(q_ov, t_ov))
+        del fwd, rev
 
-    return scores
+    return writer.close()
 
 
 def nblast_allbyall(x: NeuronList,
@@ -913,8 +1427,13 @@ def nblast_allbyall(x: NeuronList,
                     smat: Optional[Union[str, pd.DataFrame, Callable]] = 'auto',
                     limit_dist: Optional[Union[Literal['auto'], int, float]] = None,
                     approx_nn: bool = False,
+                    prune_bbox: bool = False,
                     precision: Union[int, str, np.dtype] = 64,
+                    compute_precision: Optional[Union[int, str, np.dtype]] = None,
                     n_cores: int = os.cpu_count() // 2,
+                    shared_memory: bool = False,
+                    out: Optional[Union[str, ScoreWriter]] = None,
+                    checkpoint: Optional[str] = None,
                     progress: bool = True,
                     smat_kwargs: Optional[Dict] = dict()) -> pd.DataFrame:
     """All-by-all NBLAST of inputs neurons.
@@ -932,6 +1451,35 @@ def nblast_allbyall(x: NeuronList,
                     `os.cpu_count() // 2`. This should ideally be an even
                     number as that allows optimally splitting queries onto
                     individual processes.
+    shared_memory : bool
+                    If True and using multiple cores, will pack the dotprops
+                    into shared memory (see `navis.nbl.shared.DotpropsStore`)
+                    instead of pickling them for every job. Workers will attach
+                    to that memory and re-use their KD-trees across jobs. This
+                    reduces overhead and memory footprint for large NBLASTs.
+    out :           str | ScoreWriter, optional
+                    Where to put the scores. By default (None), scores are
+                    collected in an in-memory DataFrame. Use this to stream
+                    results to disk as they come in and/or to keep only the
+                    useful part:
+
+                      - filepath ending with `.npy` will write to a
+                        memory-mapped array (see `navis.nbl.writers.NpyWriter`)
+                      - filepath ending with `.h5` will write to an HDF5
+                        dataset (see `navis.nbl.writers.H5Writer`)
+                      - `navis.nbl.writers.TopNWriter(N)` keeps only the top N
+                        targets for each query
+                      - `navis.nbl.writers.ThresholdWriter(threshold)` keeps
+                        only scores above a given threshold
+
+                    See the respective writer for what is returned.
+    checkpoint :    str, optional
+                    Path to a directory in which finished jobs are saved
+                    (see `navis.nbl.checkpoint.Checkpoint`). If the NBLAST is
+                    interrupted, re-running it with the same checkpoint
+                    directory will skip jobs that were already completed.
+                    Jobs are identified by the neurons' IDs and `core_md5`
+                    plus the scoring parameters.
     use_alpha :     bool, optional
                     Emphasizes neurons' straight parts (backbone) over parts
                     that have lots of branches.
@@ -966,12 +1514,29 @@ def nblast_allbyall(x: NeuronList,
                     If True, will use approximate nearest neighbors. This gives
                     a >2X speed up but also produces only approximate scores.
                     Impact depends on the use case - testing highly recommended!
+    prune_bbox :    bool
+                    If True and `limit_dist` is set, will skip the nearest-
+                    neighbour search for query/target pairs whose bounding
+                    boxes are farther apart than `limit_dist` and instead fill
+                    in the score for "no nearest neighbour within limit_dist".
+                    This gives the same scores but can be much faster for
+                    spatially spread-out neurons (e.g. whole-brain datasets).
     precision :     int [16, 32, 64] | str [e.g. "float64"] | np.dtype
                     Precision for scores. Defaults to 64 bit (double) floats.
                     This is useful to reduce the memory footprint for very large
                     matrices. In real-world scenarios 32 bit (single)- and
                     depending on the purpose even 16 bit (half) - are typically
                     sufficient.
+    compute_precision : int [32, 64] | str [e.g. "float32"] | np.dtype, optional
+                    Precision used for the computation itself (as opposed to
+                    `precision` which only affects the returned scores). If
+                    provided, points, tangent vectors and alpha values of all
+                    dotprops are cast (copies, not in place) to this precision
+                    once before NBLASTing. With 32 bit, KD-tree queries and
+                    score lookups all run in single precision which halves
+                    memory (bandwidth) compared to 64 bit. Scores typically
+                    match those of the 64 bit path to the third decimal. By
+                    default (None), dotprops are used as they are.
     progress :      bool
                     Whether to show progress bars. This cause may some overhead,
                     so switch off if you don't really need it.
@@ -1017,6 +1582,7 @@ def nblast_allbyall(x: NeuronList,
 
     # Make sure we're working on NeuronLists
     dps = NeuronList(x)
+    writer = parse_writer(out)
 
     # Run NBLAST preflight checks
     # Note that we are passing the same dotprops twice to avoid having to
@@ -1025,24 +1591,12 @@ def nblast_allbyall(x: NeuronList,
                      req_unique_ids=True,
                      req_microns=isinstance(smat, str) and smat=='auto')
 
-    # Find a partition that produces batches that each run in approximately
-    # 10 seconds
-    if n_cores and n_cores > 1:
-        if progress:
-            # If progress bar, we need to make smaller mini batches.
-            # These mini jobs must not be too small - otherwise the overhead
-            # from spawning and sending results between processes slows things
-            # down dramatically. Hence we want to make sure that each job runs
-            # for >10s. The run time depends on the system and how big the neurons
-            # are. Here, we run a quick test and try to extrapolate from there:
-            n_rows, n_cols = find_batch_partition(dps, dps,
-                                                  T=10 * JOB_SIZE_MULTIPLIER)
-        else:
-            # If no progress bar needed, we can just split neurons evenly across
-            # all available cores
-            n_rows, n_cols = find_optimal_partition(n_cores, dps, dps)
-    else:
-        n_rows = n_cols = 1
+    # Cast dotprops to the compute precision
+    if compute_precision is not None:
+        compute_precision = parse_compute_precision(compute_precision)
+        dps, = align_dtypes(dps, dtype=compute_precision, inplace=False)
+
+    use_pool = bool(n_cores and n_cores > 1)
 
     # Calculate self-hits once for all neurons
     nb = NBlaster(use_alpha=use_alpha,
@@ -1055,8 +1609,76 @@ def nblast_allbyall(x: NeuronList,
                   smat_kwargs=smat_kwargs)
     self_hits = np.array([nb.calc_self_hit(n) for n in dps])
 
+    # Set up checkpointing
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint,
+                                use_alpha=use_alpha,
+                                normalized=normalized,
+                                smat=smat,
+                                limit_dist=limit_dist,
+                                approx_nn=approx_nn,
+                                dtype=nb.dtype,
+                                compute_precision=str(compute_precision),
+                                smat_kwargs=smat_kwargs)
+        keys = neuron_keys(dps)
+
+    # Cut the score matrix into tiles of about equal cost
+    row_cost, col_cost = point_cost(dps.n_points)
+    tiles = make_tiles([Tile('forward', np.arange(len(dps)), np.arange(len(dps)),
+                             row_cost, col_cost)],
+                       n_tiles=n_cores * TILES_PER_WORKER if use_pool else 1)
+
+    # Skip tiles we already have results for
+    restored = []
+    if checkpoint:
+        to_run = []
+        for tile in tiles:
+            tile.key = checkpoint.key(keys[tile.rows], keys[tile.cols], 'forward')
+            res = checkpoint.load(tile.key)
+            if res is not None:
+                restored.append((tile, res))
+            else:
+                to_run.append(tile)
+        tiles = to_run
+
+    use_pool = use_pool and len(tiles) > 1
+
+    # Tiles are only split further at run time if we don't need them to be
+    # stable for checkpointing
+    scheduler = TileScheduler(tiles, split=not checkpoint)
+
+    # Only pack dotprops into shared memory if we're actually using multiple
+    # processes
+    shared_memory = shared_memory and use_pool
+
     # This makes sure we don't run into multiple layers of concurrency
-    with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None):
+    with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT if n_cores and (n_cores > 1) else None), \
+         share_dotprops(dps, enabled=shared_memory, alpha=use_alpha) as (dps_src, ):
+
+        def make_job(tile):
+            # Initialize NBlaster
+            this = NBlaster(use_alpha=use_alpha,
+                            normalized=normalized,
+                            smat=smat,
+                            limit_dist=limit_dist,
+                            dtype=precision,
+                            approx_nn=approx_nn,
+                            prune_bbox=prune_bbox,
+                            # No progress bar for individual NBLASTERs
+                            progress=progress and not use_pool,
+                            smat_kwargs=smat_kwargs)
+
+            # Make sure we don't add the same neuron twice
+            to_add, inv = np.unique(np.append(tile.rows, tile.cols),
+                                    return_inverse=True)
+            for ix in to_add:
+                this.append(dps_src[ix], self_hits[ix])
+
+            return partial(this.multi_query_target,
+                           q_idx=inv[:len(tile.rows)],
+                           t_idx=inv[len(tile.rows):],
+                           scores='forward')
+
         # Initialize a pool of workers
         # Note that we're forcing "spawn" instead of "fork" (default on linux)!
         # This is to reduce the memory footprint since "fork" appears to inherit all
@@ -1064,80 +1686,23 @@ def nblast_allbyall(x: NeuronList,
         # what's required to run the job?
         with ProcessPoolExecutor(max_workers=n_cores,
                                  mp_context=mp.get_context('spawn')) as pool:
-            with config.tqdm(desc='Preparing',
-                             total=n_rows * n_cols,
-                             leave=False,
-                             disable=not progress) as pbar:
-                futures = {}
-                nblasters = []
-                for qix in np.array_split(np.arange(len(dps)), n_rows):
-                    for tix in np.array_split(np.arange(len(dps)), n_cols):
-                        # Initialize NBlaster
-                        this = NBlaster(use_alpha=use_alpha,
-                                        normalized=normalized,
-                                        smat=smat,
-                                        limit_dist=limit_dist,
-                                        dtype=precision,
-                                        approx_nn=approx_nn,
-                                        progress=progress,
-                                        smat_kwargs=smat_kwargs)
-
-                        # Make sure we don't add the same neuron twice
-                        # Map indices to neurons
-                        to_add = list(set(qix) | set(tix))
-
-                        # Add neurons
-                        ixmap = {}
-                        for i, ix in enumerate(to_add):
-                            this.append(dps[ix], self_hits[ix])
-                            ixmap[ix] = i
-
-                        # Keep track of indices of queries and targets
-                        this.queries = [ixmap[ix] for ix in qix]
-                        this.targets = [ixmap[ix] for ix in tix]
-                        this.queries_ix = qix  # this facilitates filling in the big matrix later
-                        this.targets_ix = tix  # this facilitates filling in the big matrix later
-                        this.pbar_position = len(nblasters) if not utils.is_jupyter() else None
-
-                        nblasters.append(this)
-                        pbar.update()
-
-                        # If multiple cores requested, submit job to the pool right away
-                        if n_cores and n_cores > 1 and (n_cols > 1 or n_rows > 1):
-                            this.progress=False  # no progress bar for individual NBLASTERs
-                            futures[pool.submit(this.multi_query_target,
-                                                q_idx=this.queries,
-                                                t_idx=this.targets,
-                                                scores='forward')] = this
+            writer.open(dps.id, dps.id, nb.dtype)
 
             # Collect results
-            if futures and len(futures) > 1:
-                # Prepare empty score matrix
-                scores = pd.DataFrame(np.empty((len(dps), len(dps)),
-                                               dtype=this.dtype),
-                                      index=dps.id, columns=dps.id)
-                scores.index.name = 'query'
-                scores.columns.name = 'target'
-
-                # Collect results
-                # We're dropping the "N / N_total" bit from the progress bar because
-                # it's not helpful here
-                fmt = ('{desc}: {percentage:3.0f}%|{bar}| [{elapsed}<{remaining}]')
-                for f in config.tqdm(as_completed(futures),
-                                     desc='NBLASTing',
-                                     bar_format=fmt,
-                                     total=len(futures),
-                                     smoothing=0,
-                                     disable=not progress,
-                                     leave=False):
-                    res = f.result()
-                    this = futures[f]
-                    # Fill-in big score matrix
-                    scores.iloc[this.queries_ix, this.targets_ix] = res.values
-            else:
-                scores = this.all_by_all()
-
-    return scores
+            done = run_tiles(scheduler, make_job,
+                             pool=pool if use_pool else None,
+                             n_workers=n_cores,
+                             progress=progress)
+            for tile, res in itertools.chain(restored, done):
+                # Results from the checkpoint are already arrays
+                if isinstance(res, pd.DataFrame):
+                    res = res.values
+                    if checkpoint:
+                        checkpoint.save(tile.key, res)
+                # Pass this tile on to the writer
+                writer.write(res, tile.rows, tile.cols)
+
+    return writer.close()
 
 
 def test_single_query_time(q, t, it=100):
@@ -1231,6 +1796,28 @@ def find_optimal_partition(N_cores, q, t):
     return int(n_rows), int(n_cols)
 
 
+def find_overlap(q, t):
+    """Find neurons present in both `q` and `t`.
+
+    Parameters
+    ----------
+    q,t :       NeuronList
+                Query and targets, respectively.
+
+    Returns
+    -------
+    q_ix, t_ix : np.ndarray
+                Indices into `q` and `t` such that `q[q_ix[i]] is t[t_ix[i]]`.
+
+    """
+    # We're using the objects' memory addresses rather than neuron IDs
+    # because the latter are not guaranteed to be unique between lists
+    t_pos = {id(n): i for i, n in enumerate(t)}
+    pairs = np.array([(i, t_pos[id(n)]) for i, n in enumerate(q) if id(n) in t_pos],
+                     dtype=int).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
 def force_dotprops(x, k, resample, progress=False):
     """Force data into Dotprops."""
     if isinstance(x, (NeuronList, list)):
@@ -1266,6 +1853,9 @@ def check_microns(x):
     for n in x:
         if isinstance(n._unit_str, str):
             unit_str.append(n._unit_str)
+        elif n._unit_str is None:
+            # No units -> unclear
+            unit_str.append('')
         else:
             unit_str += list(n._unit_str)
     unit_str = np.unique(unit_str)
@@ -1291,7 +1881,7 @@ def check_microns(x):
     return None
 
 
-def align_dtypes(*x, downcast=False, inplace=True):
+def align_dtypes(*x, downcast=False, dtype=None, inplace=True):
     """Align data types of dotprops.
 
     Parameters
@@ -1300,40 +1890,73 @@ def align_dtypes(*x, downcast=False, inplace=True):
     downcast :  bool
                 If True, will downcast all points to the lowest precision
                 dtype.
+    dtype :     str | np.dtype, optional
+                If provided, will cast all dotprops to this data type
+                (ignores `downcast`).
     inplace :   bool
                 If True, will modify the original neuron objects. If False, will
-                make a copy before changing dtypes.
+                make a copy before changing dtypes. Dotprops that already have
+                the target dtype are not copied.
 
     Returns
     -------
     *x
-                Input data with aligned dtypes.
+                Input data with aligned dtypes. This includes points,
+                tangent vectors and alpha values.
 
     """
-    dtypes = get_dtypes(x)
-
-    if len(dtypes) == 1:
-        return x
-
-    if not inplace:
-        for i in range(x):
-            x[i] = x[i].copy()
+    if dtype is None:
+        dtypes = get_dtypes(*x)
 
-    if downcast:
-        target = lowest_type(*x)
-    else:
-        target = np.result_type(*dtypes)
+        if len(dtypes) <= 1:
+            return x
 
-    for n in x:
+        if downcast:
+            dtype = lowest_type(*x)
+        else:
+            dtype = np.result_type(*dtypes)
+    dtype = np.dtype(dtype)
+
+    # Keep track of copies so that neurons present in multiple inputs
+    # are only copied once (and stay identical)
+    copies = {}
+
+    def cast(n):
+        if (n.points.dtype == dtype
+            and (n._vect is None or n._vect.dtype == dtype)
+            and (n._alpha is None or n._alpha.dtype == dtype)):
+            return n
+        if not inplace:
+            if id(n) not in copies:
+                copies[id(n)] = n.copy()
+            n = copies[id(n)]
+        # Note: setting points also resets the KD-tree
+        n.points = n.points.astype(dtype, copy=False)
+        if n._vect is not None:
+            n._vect = n._vect.astype(dtype, copy=False)
+        if n._alpha is not None:
+            n._alpha = n._alpha.astype(dtype, copy=False)
+        return n
+
+    x = list(x)
+    for i, n in enumerate(x):
         if isinstance(n, NeuronList):
-            for i in range(len(n)):
-                n[i].points = n[i].points.astype(target, copy=False)
+            x[i] = NeuronList([cast(dp) for dp in n])
         elif isinstance(n, Dotprops):
-            n.points = n.points.astype(target, copy=False)
+            x[i] = cast(n)
         else:
             raise TypeError(f'Unable to process "{type(n)}"')
 
-    return x
+    return tuple(x)
+
+
+def parse_compute_precision(x):
+    """Parse `compute_precision` parameter into a numpy dtype."""
+    dtype = np.dtype(FLOAT_DTYPES.get(x, x))
+    if dtype not in (np.float32, np.float64):
+        raise ValueError('`compute_precision` must be 32 or 64 bit, got '
+                         f'"{dtype}"')
+    return dtype
 
 
 def get_dtypes(*x):
@@ -1341,7 +1964,7 @@ def get_dtypes(*x):
     dtypes = set()
     for n in x:
         if isinstance(n, NeuronList):
-            dtypes = dtypes | get_dtypes(n)
+            dtypes = dtypes | get_dtypes(*n)
         elif isinstance(n, Dotprops):
             dtypes.add(n.points.dtype)
         else:
@@ -1351,7 +1974,7 @@ def get_dtypes(*x):
 
 def lowest_type(*x):
     """Find the lowest data type."""
-    dtypes = get_dtypes(x)
+    dtypes = list(get_dtypes(*x))
 
     if len(dtypes) == 1:
         return dtypes[0]
@@ -0,0 +1,314 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Cost-based scheduling of BLAST tiles across worker processes.
+
+The (query x target) score matrix is cut into tiles whose estimated cost is
+about the same. Cost is modelled after what the NBLAST kernel actually does:
+each query point runs one nearest-neighbour search against each target's
+KD-tree, i.e. `sum(query points) * sum(log2(target points))`. Tiles are
+handed out largest-first and only as workers become available. If there are
+fewer tiles left than idle workers, the next tile is split so that we don't
+end up waiting on a single straggler.
+"""
+
+import heapq
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from .. import config
+
+__all__ = ['Tile', 'TileScheduler', 'make_tiles', 'run_tiles']
+
+logger = config.get_logger(__name__)
+
+# Min estimated cost for a tile to be worth running as separate job. One
+# unit of cost (one query point against a KD-tree of depth 1) takes about
+# 0.1 microseconds, i.e. this corresponds to jobs of a few seconds.
+MIN_TILE_COST = 5e7
+
+# Number of tiles to aim for per worker. More tiles = better load balancing
+# but also more overhead from sending neurons to the workers.
+TILES_PER_WORKER = 4
+
+
+class Tile:
+    """A block of the score matrix.
+
+    Parameters
+    ----------
+    direction :     "forward" | "reverse"
+                    Whether rows are queries and columns targets (forward) or
+                    the other way around (reverse).
+    rows,cols :     np.ndarray
+                    Indices of the row/column neurons.
+    row_cost :      np.ndarray
+                    Per-row cost (number of points).
+    col_cost :      np.ndarray
+                    Per-column cost (KD-tree depth).
+
+    """
+
+    __slots__ = ('direction', 'rows', 'cols', 'row_cost', 'col_cost', 'key')
+
+    def __init__(self, direction, rows, cols, row_cost, col_cost):
+        self.direction = direction
+        self.rows = np.asarray(rows)
+        self.cols = np.asarray(cols)
+        self.row_cost = np.asarray(row_cost, dtype=np.float64)
+        self.col_cost = np.asarray(col_cost, dtype=np.float64)
+        self.key = None
+
+    def __repr__(self):
+        return (f'<{type(self).__name__}({self.direction}, {len(self.rows)}x'
+                f'{len(self.cols)}, cost={self.cost:.2g})>')
+
+    @property
+    def cost(self):
+        """Estimated cost of this tile."""
+        return self.row_cost.sum() * self.col_cost.sum()
+
+    @property
+    def splittable(self):
+        return len(self.rows) > 1 or len(self.cols) > 1
+
+    def split(self):
+        """Split tile into two tiles of roughly equal cost.
+
+        Splits along the dimension with more neurons to keep tiles (and
+        therefore the number of neurons we need to send to the workers)
+        small.
+
+        """
+        if len(self.rows) >= len(self.cols):
+            i = _split_point(self.row_cost)
+            return (Tile(self.direction, self.rows[:i], self.cols,
+                         self.row_cost[:i], self.col_cost),
+                    Tile(self.direction, self.rows[i:], self.cols,
+                         self.row_cost[i:], self.col_cost))
+        else:
+            i = _split_point(self.col_cost)
+            return (Tile(self.direction, self.rows, self.cols[:i],
+                         self.row_cost, self.col_cost[:i]),
+                    Tile(self.direction, self.rows, self.cols[i:],
+                         self.row_cost, self.col_cost[i:]))
+
+
+def _split_point(cost):
+    """Index that splits `cost` into two halves with about the same sum."""
+    cs = np.cumsum(cost)
+    return int(np.clip(np.searchsorted(cs, cs[-1] / 2), 1, len(cost) - 1))
+
+
+def point_cost(n_points):
+    """Cost for neurons as queries (rows) and targets (columns).
+
+    Parameters
+    ----------
+    n_points :  (N, ) array
+                Number of points per neuron.
+
+    Returns
+    -------
+    row_cost :  (N, ) array
+                Number of points.
+    col_cost :  (N, ) array
+                Depth of the KD-tree plus 1 for the per-query overhead.
+
+    """
+    n_points = np.asarray(n_points, dtype=np.float64)
+    return n_points, np.log2(n_points + 1) + 1
+
+
+class TileScheduler:
+    """Hand out tiles largest-first.
+
+    Parameters
+    ----------
+    tiles :     iterable of Tile
+    split :     bool
+                Whether tiles may be split further when workers run out of
+                work. Disable this if tiles need to be stable (e.g. for
+                checkpointing).
+    min_cost :  float, optional
+                Tiles will not be split below this cost. Defaults to
+                `MIN_TILE_COST`.
+
+    """
+
+    def __init__(self, tiles, split=True, min_cost=None):
+        self.split = split
+        self.min_cost = MIN_TILE_COST if min_cost is None else min_cost
+        self._heap = []
+        self._counter = itertools.count()
+        for t in tiles:
+            self.push(t)
+        self.total_cost = sum(-c for c, _, _ in self._heap)
+        self._timings = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, tile):
+        """Add tile to the queue."""
+        heapq.heappush(self._heap, (-tile.cost, next(self._counter), tile))
+
+    def pop(self, n_idle=1):
+        """Get the next (largest) tile.
+
+        Parameters
+        ----------
+        n_idle :    int
+                    Number of workers currently waiting for work. If there
+                    are fewer tiles left than that, the tile will be split
+                    so that every worker gets something to do.
+
+        """
+        tile = heapq.heappop(self._heap)[-1]
+        while (self.split
+               and len(self._heap) + 1 < n_idle
+               and tile.splittable
+               and tile.cost >= 2 * self.min_cost):
+            a, b = tile.split()
+            self.push(a)
+            self.push(b)
+            tile = heapq.heappop(self._heap)[-1]
+        return tile
+
+    def record(self, tile, seconds):
+        """Record time it took to run `tile`."""
+        self._timings.append((tile.direction, len(tile.rows), len(tile.cols),
+                              tile.cost, seconds))
+
+    @property
+    def timings(self):
+        """Per-tile timings as DataFrame (in order of completion)."""
+        return pd.DataFrame(self._timings,
+                            columns=['direction', 'n_rows', 'n_cols',
+                                     'cost', 'seconds'])
+
+    def report(self):
+        """Log per-tile timings."""
+        t = self.timings
+        if t.empty:
+            return
+        logger.debug(f'Ran {len(t)} tiles in {t.seconds.sum():.1f}s (total): '
+                     f'median {t.seconds.median():.2f}s, max {t.seconds.max():.2f}s, '
+                     f'{t.seconds.sum() / t.cost.sum() * 1e9:.1f}s per 1e9 cost\n{t}')
+
+
+def make_tiles(regions, n_tiles, min_cost=None):
+    """Cut regions of the score matrix into tiles of similar cost.
+
+    Parameters
+    ----------
+    regions :   iterable of Tile
+                Regions of the score matrix to compute.
+    n_tiles :   int
+                Number of tiles to aim for. The most expensive tile is split
+                until we have at least `n_tiles` tiles or none of the tiles
+                can be split further without going below `min_cost`.
+    min_cost :  float, optional
+                Min cost per tile. Defaults to `MIN_TILE_COST`.
+
+    Returns
+    -------
+    list of Tile
+
+    """
+    if min_cost is None:
+        min_cost = MIN_TILE_COST
+
+    heap = []
+    counter = itertools.count()
+    for r in regions:
+        if len(r.rows) and len(r.cols):
+            heapq.heappush(heap, (-r.cost, next(counter), r))
+
+    while heap and len(heap) < n_tiles:
+        cost, _, tile = heap[0]
+        if -cost < 2 * min_cost or not tile.splittable:
+            break
+        heapq.heappop(heap)
+        for t in tile.split():
+            heapq.heappush(heap, (-t.cost, next(counter), t))
+
+    return [t for _, _, t in heap]
+
+
+def run_tiles(scheduler, make_job, pool=None, n_workers=1, progress=True,
+              desc='NBLASTing'):
+    """Run tiles and yield results as they come in.
+
+    Parameters
+    ----------
+    scheduler : TileScheduler
+    make_job :  callable
+                Must accept a tile and return a function that produces the
+                results for it when called without arguments. Must be
+                picklable if `pool` is used.
+    pool :      concurrent.futures.Executor, optional
+                If provided, will run jobs in this pool.
+    n_workers : int
+                Number of workers in the pool. We only ever submit that many
+                jobs at a time.
+
+    Yields
+    ------
+    tile, result
+
+    """
+    # We're dropping the "N / N_total" bit from the progress bar because
+    # progress is tracked in units of cost
+    fmt = ('{desc}: {percentage:3.0f}%|{bar}| [{elapsed}<{remaining}]')
+    with config.tqdm(desc=desc,
+                     total=scheduler.total_cost,
+                     bar_format=fmt,
+                     smoothing=0,
+                     disable=not progress or pool is None,
+                     leave=False) as pbar:
+        if pool is None:
+            while scheduler:
+                tile = scheduler.pop()
+                res, seconds = timed(make_job(tile))
+                scheduler.record(tile, seconds)
+                yield tile, res
+        else:
+            futures = {}
+            while scheduler or futures:
+                # Keep all workers busy
+                while scheduler and len(futures) < n_workers:
+                    tile = scheduler.pop(n_idle=n_workers - len(futures))
+                    futures[pool.submit(timed, make_job(tile))] = tile
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    tile = futures.pop(f)
+                    res, seconds = f.result()
+                    scheduler.record(tile, seconds)
+                    pbar.update(tile.cost)
+                    yield tile, res
+
+    scheduler.report()
+
+
+def timed(func):
+    """Run `func()` and return result and run time in seconds."""
+    start = time.time()
+    res = func()
+    return res, time.time() - start
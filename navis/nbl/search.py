@@ -0,0 +1,354 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Candidate search for NBLAST using fixed-length dotprops embeddings."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from typing import Union, Optional, Dict, Callable
+from typing_extensions import Literal
+
+from .. import config, utils
+from ..core import NeuronList, Dotprops
+from .nblast_funcs import (NBlaster, ALLOWED_SCORES, OMP_NUM_THREADS_LIMIT,
+                           nblast_preflight, set_omp_flag)
+
+__all__ = ['DotpropsIndex', 'nblast_search']
+
+logger = config.get_logger(__name__)
+
+# The 13 undirected directions connecting a voxel to its 26 neighbours. We
+# use these to bin the dotprops' tangent vectors by orientation.
+DIRECTIONS = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1],
+                       [1, 1, 0], [1, -1, 0], [1, 0, 1],
+                       [1, 0, -1], [0, 1, 1], [0, 1, -1],
+                       [1, 1, 1], [1, 1, -1], [1, -1, 1],
+                       [-1, 1, 1]], dtype=np.float64)
+DIRECTIONS /= np.linalg.norm(DIRECTIONS, axis=1, keepdims=True)
+
+# Mersenne prime used for hashing
+HASH_PRIME = 2 ** 31 - 1
+
+
+class DotpropsIndex:
+    """Nearest-neighbour index over fixed-length embeddings of dotprops.
+
+    Each dotprop is embedded as a histogram of its points over a shared
+    spatial grid and over 13 tangent vector orientations. That (sparse)
+    histogram is reduced to `n_dims` dimensions using a (fixed) sparse random
+    projection (feature hashing) and normalized to unit length. Neurons with
+    similar embeddings occupy the same parts of space with similarly oriented
+    tangent vectors, i.e. they are likely to have a high NBLAST score.
+
+    Parameters
+    ----------
+    targets :       NeuronList of Dotprops
+                    The dotprops to index.
+    voxel_size :    float, optional
+                    Size of the grid voxels (in the units of the dotprops).
+                    Should be roughly the distance at which the NBLAST scoring
+                    function stops rewarding matches. If not provided, will
+                    divide the targets' bounding box into 16 voxels along its
+                    longest axis.
+    n_dims :        int
+                    Number of dimensions of the embeddings.
+    n_hashes :      int
+                    Number of dimensions each histogram bin is projected onto.
+                    More hashes reduce the noise introduced by the projection.
+    seed :          int
+                    Seed for the random projection.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(n=5)
+    >>> dps = navis.make_dotprops(nl, k=5) / 125
+    >>> ix = navis.nbl.search.DotpropsIndex(dps)
+    >>> dist, cand = ix.query(dps[:2], k=3)
+    >>> cand.shape
+    (2, 3)
+
+    """
+
+    def __init__(self,
+                 targets: NeuronList,
+                 voxel_size: Optional[float] = None,
+                 n_dims: int = 64,
+                 n_hashes: int = 4,
+                 seed: int = 1985):
+        self.targets = NeuronList(targets)
+        if self.targets.types != (Dotprops, ):
+            raise TypeError(f'Expected Dotprops, got "{self.targets.types}"')
+
+        bbox = self.targets.bbox
+        if not voxel_size:
+            voxel_size = (bbox[:, 1] - bbox[:, 0]).max() / 16
+        self.voxel_size = float(voxel_size)
+        self.offset = bbox[:, 0]
+        self.grid = np.ceil((bbox[:, 1] - bbox[:, 0]) / self.voxel_size).astype(int) + 1
+
+        self.n_dims = n_dims
+        self.seed = seed
+
+        # Parameters for the hash functions that map histogram bins to
+        # dimensions (and signs) of the embedding
+        rng = np.random.default_rng(seed)
+        self._hash_params = rng.integers(1, HASH_PRIME, size=(4, n_hashes))
+
+        self.embeddings = self.embed(self.targets)
+        self.tree = cKDTree(self.embeddings)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def embed(self, x):
+        """Embed dotprops.
+
+        Parameters
+        ----------
+        x :         Dotprops | NeuronList thereof
+
+        Returns
+        -------
+        (N, n_dims) np.ndarray
+
+        """
+        x = NeuronList(x)
+        emb = np.zeros((len(x), self.n_dims), dtype=np.float32)
+        for i, n in enumerate(x):
+            if not len(n.points):
+                continue
+            # Find the voxel for each point (points outside of the grid
+            # are assigned to the closest voxel at the edge)
+            vxl = np.floor((n.points - self.offset) / self.voxel_size).astype(int)
+            vxl = np.clip(vxl, 0, self.grid - 1)
+            vxl = np.ravel_multi_index(vxl.T, self.grid)
+            # Find the closest orientation for each tangent vector
+            ori = np.abs(n.vect @ DIRECTIONS.T).argmax(axis=1)
+            # Generate the histogram and project
+            bins, counts = np.unique(vxl * len(DIRECTIONS) + ori, return_counts=True)
+            dims, signs = self._hash(bins)
+            np.add.at(emb[i], dims.ravel(), (signs * counts.reshape(-1, 1)).ravel())
+
+        # Normalize such that Euclidean distance tracks cosine similarity
+        norm = np.linalg.norm(emb, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        return emb / norm
+
+    def _hash(self, bins):
+        """Map histogram bins to dimensions and signs."""
+        a, b, c, d = self._hash_params
+        bins = bins.astype(np.int64).reshape(-1, 1) % HASH_PRIME
+        dims = ((bins * a + b) % HASH_PRIME) % self.n_dims
+        signs = ((bins * c + d) % HASH_PRIME) % 2 * 2 - 1
+        return dims, signs
+
+    def query(self, x, k=10):
+        """Find the `k` closest targets for each of the query dotprops.
+
+        Parameters
+        ----------
+        x :         Dotprops | NeuronList thereof
+                    Dotprops to find candidates for.
+        k :         int
+                    Number of candidates to return for each query.
+
+        Returns
+        -------
+        dist :      (N, k) np.ndarray
+                    Distances between embeddings.
+        ix :        (N, k) np.ndarray
+                    Indices of the targets.
+
+        """
+        k = min(k, len(self))
+        dist, ix = self.tree.query(self.embed(x), k=k)
+        return dist.reshape(-1, k), ix.reshape(-1, k)
+
+
+def nblast_search(query: Union[Dotprops, NeuronList],
+                  target: Union[NeuronList, DotpropsIndex],
+                  N: int = 10,
+                  candidates: int = 100,
+                  scores: Union[Literal['forward'],
+                                Literal['mean'],
+                                Literal['min'],
+                                Literal['max']] = 'forward',
+                  normalized: bool = True,
+                  use_alpha: bool = False,
+                  smat: Optional[Union[str, pd.DataFrame, Callable]] = 'auto',
+                  limit_dist: Optional[Union[Literal['auto'], int, float]] = None,
+                  approx_nn: bool = False,
+                  precision: Union[int, str, np.dtype] = 64,
+                  n_cores: int = os.cpu_count() // 2,
+                  progress: bool = True,
+                  smat_kwargs: Optional[Dict] = dict()) -> pd.DataFrame:
+    """Find the top NBLAST matches for queries among a large set of targets.
+
+    In contrast to [`navis.nblast`][] and [`navis.nblast_smart`][], this
+    function does not compute (or pre-compute) scores for all query-target
+    pairs. Instead, it uses a nearest-neighbour index over fixed-length
+    embeddings of the target dotprops (see
+    [`navis.nbl.search.DotpropsIndex`][]) to pick `candidates` targets for
+    each query and then runs a full NBLAST only for those pairs. This makes
+    searches against very large libraries sublinear in the number of
+    targets.
+
+    Note that this is an approximation: good matches that are not among the
+    candidates will be missed. Increase `candidates` to trade speed for
+    recall.
+
+    Parameters
+    ----------
+    query :         Dotprops | NeuronList
+                    Query neuron(s).
+    target :        NeuronList | DotpropsIndex
+                    Target neurons. If you run multiple searches against the
+                    same targets, pass a pre-computed `DotpropsIndex`.
+    N :             int
+                    Number of top matches to return for each query.
+    candidates :    int
+                    Number of candidates to run a full NBLAST for. Must be
+                    larger than or equal to `N`.
+    scores :        'forward' | 'mean' | 'min' | 'max'
+                    Which scores to calculate (see [`navis.nblast`][]).
+    normalized :    bool, optional
+                    Whether to return normalized NBLAST scores.
+    use_alpha :     bool, optional
+                    Emphasizes neurons' straight parts (backbone) over parts
+                    that have lots of branches.
+    smat :          str | pd.DataFrame | Callable
+                    Score matrix. See [`navis.nblast`][].
+    limit_dist :    float | "auto" | None
+                    Sets the max distance for the nearest neighbor search. See
+                    [`navis.nblast`][].
+    approx_nn :     bool
+                    If True, will use approximate nearest neighbors.
+    precision :     int [16, 32, 64] | str [e.g. "float64"] | np.dtype
+                    Precision for scores.
+    n_cores :       int, optional
+                    Max number of cores to use for nblasting.
+    progress :      bool
+                    Whether to show progress bars.
+    smat_kwargs:    Dictionary with additional parameters passed to scoring
+                    functions.
+
+    Returns
+    -------
+    pandas.DataFrame
+                    Top matches in the same format as
+                    [`navis.nbl.extract_matches`][] with `N`: one row per
+                    query with `match_{i}` and `score_{i}` columns.
+
+    Examples
+    --------
+    >>> import navis
+    >>> nl = navis.example_neurons(n=5)
+    >>> dps = navis.make_dotprops(nl, k=5) / 125
+    >>> matches = navis.nblast_search(dps[:2], dps, N=2, candidates=3,
+    ...                               n_cores=1, progress=False)
+
+    See Also
+    --------
+    [`navis.nblast`][]
+                The conventional full NBLAST.
+    [`navis.nblast_smart`][]
+                Uses a downsampled pre-NBLAST to pick pairs.
+
+    """
+    utils.eval_param(scores, name='scores',
+                     allowed_values=tuple(s for s in ALLOWED_SCORES if s != 'both'))
+
+    if N > candidates:
+        raise ValueError(f'`N` ({N}) must not be larger than `candidates` ({candidates})')
+
+    query_dps = NeuronList(query)
+    if isinstance(target, DotpropsIndex):
+        index = target
+    else:
+        index = DotpropsIndex(target)
+    target_dps = index.targets
+
+    # Run NBLAST preflight checks
+    nblast_preflight(query_dps, target_dps, n_cores,
+                     req_unique_ids=True,
+                     req_microns=isinstance(smat, str) and smat=='auto')
+
+    N = min(N, len(target_dps))
+
+    # Find candidates
+    _, cand = index.query(query_dps, k=candidates)
+
+    # Split queries into one chunk per core
+    n_chunks = max(1, min(n_cores if n_cores else 1, len(query_dps)))
+    nblasters = []
+    for qix in np.array_split(np.arange(len(query_dps)), n_chunks):
+        this = NBlaster(use_alpha=use_alpha,
+                        normalized=normalized,
+                        smat=smat,
+                        limit_dist=limit_dist,
+                        dtype=precision,
+                        approx_nn=approx_nn,
+                        progress=progress and n_chunks == 1,
+                        smat_kwargs=smat_kwargs)
+        tix = np.unique(cand[qix])
+        for ix in qix:
+            this.append(query_dps[ix])
+        for ix in tix:
+            this.append(target_dps[ix])
+
+        # Map candidates to their index in this NBlaster
+        t_local = np.searchsorted(tix, cand[qix]) + len(qix)
+        q_local = np.repeat(np.arange(len(qix)), cand.shape[1])
+        this.pairs = np.vstack((q_local, t_local.ravel())).T
+        this.queries_ix = qix
+        nblasters.append(this)
+
+    # Run the NBLASTs
+    scr = np.zeros(cand.shape, dtype=nblasters[0].dtype)
+    if n_chunks > 1:
+        with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT):
+            with ProcessPoolExecutor(max_workers=n_chunks,
+                                     mp_context=mp.get_context('spawn')) as pool:
+                futures = {pool.submit(this.pair_query_target,
+                                       pairs=this.pairs,
+                                       scores=scores): this for this in nblasters}
+                for f in config.tqdm(futures,
+                                     desc='NBLASTing',
+                                     disable=not progress,
+                                     leave=False):
+                    this = futures[f]
+                    scr[this.queries_ix] = np.reshape(f.result(), (len(this.queries_ix), -1))
+    else:
+        this = nblasters[0]
+        scr[:] = np.reshape(this.pair_query_target(this.pairs, scores=scores), scr.shape)
+
+    # Sort candidates by score and extract the top N
+    srt = np.argsort(scr, axis=1)[:, ::-1][:, :N]
+    top_scores = np.take_along_axis(scr, srt, axis=1)
+    top_ix = np.take_along_axis(cand, srt, axis=1)
+
+    matches = pd.DataFrame()
+    matches['id'] = query_dps.id
+    target_ids = np.asarray(target_dps.id)
+    for i in range(N):
+        matches[f'match_{i + 1}'] = target_ids[top_ix[:, i]]
+        matches[f'score_{i + 1}'] = top_scores[:, i]
+
+    return matches
@@ -0,0 +1,548 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Long-lived NBLAST service answering queries against a warm target library.
+
+[`navis.nblast`][] validates the inputs, partitions the work and spins up a
+new process pool on every call. That is fine for large batch jobs but adds
+a lot of overhead if queries come in one neuron at a time. An
+[`navis.nbl.server.NBlastServer`][] does all of that only once: targets are
+split into shards (one per core), each shard lives in a dedicated worker
+process with its KD-trees and self-hits already computed, and queries are
+scored against all shards in parallel.
+
+The server can also be exposed via a small JSON-over-HTTP front end (see
+`NBlastServer.serve`) and queried from other processes using
+[`navis.nbl.server.NBlastClient`][].
+"""
+
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Union, Optional, Dict, Callable
+from typing_extensions import Literal
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+
+from .. import config, utils
+from ..core import NeuronList, Dotprops
+from .nblast_funcs import (NBlaster, ALLOWED_SCORES, OMP_NUM_THREADS_LIMIT,
+                           nblast_preflight, check_microns, set_omp_flag)
+
+__all__ = ['NBlastServer', 'NBlastClient']
+
+logger = config.get_logger(__name__)
+
+# Shard of the target library held by this (worker) process
+_SHARD = None
+
+
+class _Shard:
+    """Targets appended to an NBlaster with queries being swapped in and out."""
+
+    def __init__(self, targets, blaster_kwargs):
+        self.blaster = NBlaster(progress=False, **blaster_kwargs)
+        for n in targets:
+            # Build the KD-tree now rather than on the first query
+            _ = n.kdtree
+            self.blaster.append(n)
+        self.n_targets = len(targets)
+
+    def __len__(self):
+        return self.n_targets
+
+    def scores(self, queries, scores='forward'):
+        """(queries, targets) array of scores."""
+        bl = self.blaster
+        q_idx = bl.append(list(queries))
+        try:
+            res = bl.multi_query_target(q_idx, range(self.n_targets),
+                                        scores=scores)
+        finally:
+            # Drop the queries again
+            for attr in ('neurons', 'ids', 'self_hits', 'bboxes'):
+                del getattr(bl, attr)[self.n_targets:]
+        return res.values
+
+    def top(self, queries, N, scores='forward'):
+        """Indices and scores of the top `N` targets for each query."""
+        scr = self.scores(queries, scores=scores)
+        N = min(N, scr.shape[1])
+        # Partition first: much faster than a full sort for large shards
+        ix = np.argpartition(-scr, N - 1, axis=1)[:, :N]
+        top = np.take_along_axis(scr, ix, axis=1)
+        return ix, top
+
+
+def _init_shard(targets, blaster_kwargs):
+    """Initialize worker process with its shard of the library."""
+    global _SHARD
+    _SHARD = _Shard(targets, blaster_kwargs)
+
+
+def _shard_call(method, *args):
+    """Call method of this worker's shard."""
+    return getattr(_SHARD, method)(*args)
+
+
+class NBlastServer:
+    """NBLAST service with a warm target library.
+
+    Targets are validated and their KD-trees and self-hits computed once on
+    initialization. With `n_cores > 1`, the library is split into one shard
+    per core, each held by its own long-lived worker process, and queries
+    are scored against all shards in parallel. Use as context manager (or
+    call `.close()`) to shut down the worker processes.
+
+    Parameters
+    ----------
+    targets :       NeuronList of Dotprops
+                    The target library.
+    use_alpha :     bool, optional
+                    Emphasizes neurons' straight parts (backbone) over parts
+                    that have lots of branches.
+    normalized :    bool, optional
+                    Whether to return normalized NBLAST scores.
+    smat :          str | pd.DataFrame | Callable
+                    Score matrix. See [`navis.nblast`][].
+    limit_dist :    float | "auto" | None
+                    Sets the max distance for the nearest neighbor search.
+                    See [`navis.nblast`][].
+    approx_nn :     bool
+                    If True, will use approximate nearest neighbors.
+    prune_bbox :    bool
+                    If True and `limit_dist` is set, will skip targets whose
+                    bounding boxes are out of reach of the query.
+    precision :     int [16, 32, 64] | str [e.g. "float64"] | np.dtype
+                    Precision for scores.
+    n_cores :       int
+                    Number of worker processes (i.e. shards). With
+                    `n_cores=1` queries are run in this process.
+    smat_kwargs:    Dictionary with additional parameters passed to scoring
+                    functions.
+
+    Examples
+    --------
+    >>> import navis
+    >>> from navis.nbl.server import NBlastServer
+    >>> nl = navis.example_neurons(n=5)
+    >>> dps = navis.make_dotprops(nl, k=5) / 125
+    >>> with NBlastServer(dps, n_cores=1) as server:
+    ...     matches = server.query(dps[:2], N=3)
+    >>> # Each query is its own best match
+    >>> matches.match_1.tolist() == dps[:2].id.tolist()
+    True
+
+    See Also
+    --------
+    [`navis.nbl.server.NBlastClient`][]
+                Query a server running in a different process.
+    [`navis.nblast_search`][]
+                Find top matches among candidates picked from an embedding.
+
+    """
+
+    def __init__(self,
+                 targets: NeuronList,
+                 use_alpha: bool = False,
+                 normalized: bool = True,
+                 smat: Optional[Union[str, pd.DataFrame, Callable]] = 'auto',
+                 limit_dist: Optional[Union[Literal['auto'], int, float]] = None,
+                 approx_nn: bool = False,
+                 prune_bbox: bool = False,
+                 precision: Union[int, str, np.dtype] = 64,
+                 n_cores: int = 1,
+                 smat_kwargs: Optional[Dict] = dict()):
+        targets = NeuronList(targets)
+
+        # Run NBLAST preflight checks once for the library
+        nblast_preflight(targets, targets, n_cores,
+                         req_unique_ids=True,
+                         req_microns=False)
+        self.check_microns = isinstance(smat, str) and smat == 'auto'
+        if self.check_microns and check_microns(targets) is False:
+            logger.warning('NBLAST is optimized for data in microns and it looks '
+                           'like your targets are not in microns.')
+
+        self.targets = targets
+        self.target_ids = np.asarray(targets.id)
+        self.blaster_kwargs = dict(use_alpha=use_alpha,
+                                   normalized=normalized,
+                                   smat=smat,
+                                   limit_dist=limit_dist,
+                                   approx_nn=approx_nn,
+                                   prune_bbox=prune_bbox,
+                                   dtype=precision,
+                                   smat_kwargs=smat_kwargs)
+        self.lock = threading.Lock()
+
+        # Split targets into shards with about the same number of points
+        n_shards = max(1, min(int(n_cores), len(targets)))
+        n_points = targets.n_points.astype(np.float64)
+        start = np.cumsum(n_points) - n_points
+        shard = np.minimum(start * n_shards // n_points.sum(), n_shards - 1)
+        self.shards = [np.where(shard == i)[0] for i in range(n_shards)]
+
+        if n_shards == 1:
+            self.pools = None
+            self.local = _Shard(targets, self.blaster_kwargs)
+        else:
+            self.local = None
+            self.pools = []
+            with set_omp_flag(limits=OMP_NUM_THREADS_LIMIT):
+                for ix in self.shards:
+                    pool = ProcessPoolExecutor(max_workers=1,
+                                               mp_context=mp.get_context('spawn'),
+                                               initializer=_init_shard,
+                                               initargs=(targets[ix], self.blaster_kwargs))
+                    self.pools.append(pool)
+                # Workers are started lazily -> make sure they are up and
+                # have loaded their shard before we return
+                for pool in self.pools:
+                    pool.submit(_shard_call, '__len__').result()
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        return (f'<{type(self).__name__}({len(self)} targets, '
+                f'{len(self.shards)} shard(s))>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Shut down worker processes."""
+        for pool in self.pools or []:
+            pool.shutdown()
+        self.pools = self.local = None
+
+    def _prep_queries(self, query, scores):
+        utils.eval_param(scores, name='scores',
+                         allowed_values=tuple(s for s in ALLOWED_SCORES if s != 'both'))
+        query = NeuronList(query)
+        if query.types != (Dotprops, ):
+            raise TypeError(f'`query` must be Dotprop(s), got "{query.types}". '
+                            'Use `navis.make_dotprops` to convert neurons.')
+        no_points = query.n_points == 0
+        if any(no_points):
+            raise ValueError('Some query dotprops appear to have no points: '
+                             f'{query.id[no_points]}')
+        if self.check_microns and check_microns(query) is False:
+            logger.warning('NBLAST is optimized for data in microns and it looks '
+                           'like your queries are not in microns.')
+        return query
+
+    def _map(self, method, *args):
+        """Call `method` on each shard and return results in order of shards."""
+        # Only one query at a time: shards are not thread-safe
+        with self.lock:
+            if self.local is not None:
+                return [getattr(self.local, method)(*args)]
+            if self.pools is None:
+                raise ValueError('Server has been closed.')
+            futures = [pool.submit(_shard_call, method, *args) for pool in self.pools]
+            return [f.result() for f in futures]
+
+    def scores(self,
+               query: Union[Dotprops, NeuronList],
+               scores: Union[Literal['forward'],
+                             Literal['mean'],
+                             Literal['min'],
+                             Literal['max']] = 'forward') -> pd.DataFrame:
+        """NBLAST query(s) against the full library.
+
+        Parameters
+        ----------
+        query :     Dotprops | NeuronList
+                    Query neuron(s).
+        scores :    'forward' | 'mean' | 'min' | 'max'
+                    Which scores to calculate (see [`navis.nblast`][]).
+
+        Returns
+        -------
+        pandas.DataFrame
+                    Queries as rows, targets as columns.
+
+        """
+        query = self._prep_queries(query, scores)
+        res = self._map('scores', query, scores)
+
+        scr = np.empty((len(query), len(self)), dtype=res[0].dtype)
+        for ix, r in zip(self.shards, res):
+            scr[:, ix] = r
+
+        return pd.DataFrame(scr,
+                            index=pd.Index(query.id, name='query'),
+                            columns=pd.Index(self.target_ids, name='target'))
+
+    def query(self,
+              query: Union[Dotprops, NeuronList],
+              N: int = 10,
+              scores: Union[Literal['forward'],
+                            Literal['mean'],
+                            Literal['min'],
+                            Literal['max']] = 'forward') -> pd.DataFrame:
+        """Find the top `N` matches for query(s) in the library.
+
+        Parameters
+        ----------
+        query :     Dotprops | NeuronList
+                    Query neuron(s).
+        N :         int
+                    Number of top matches to return for each query.
+        scores :    'forward' | 'mean' | 'min' | 'max'
+                    Which scores to calculate (see [`navis.nblast`][]).
+
+        Returns
+        -------
+        pandas.DataFrame
+                    Top matches in the same format as
+                    [`navis.nbl.extract_matches`][]: one row per query with
+                    `match_{i}` and `score_{i}` columns.
+
+        """
+        query = self._prep_queries(query, scores)
+        N = min(int(N), len(self))
+        res = self._map('top', query, N, scores)
+
+        # Combine the top N of each shard
+        ix = np.hstack([shard[i] for shard, (i, _) in zip(self.shards, res)])
+        scr = np.hstack([s for _, s in res])
+        srt = np.argsort(-scr, axis=1, kind='stable')[:, :N]
+        top_scores = np.take_along_axis(scr, srt, axis=1)
+        top_ix = np.take_along_axis(ix, srt, axis=1)
+
+        matches = pd.DataFrame()
+        matches['id'] = query.id
+        for i in range(N):
+            matches[f'match_{i + 1}'] = self.target_ids[top_ix[:, i]]
+            matches[f'score_{i + 1}'] = top_scores[:, i]
+
+        return matches
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8000,
+              block: bool = True) -> HTTPServer:
+        """Expose this server via HTTP.
+
+        Accepts `POST` requests to `/query` and `/scores` with a JSON body of
+        `{"queries": [...], "N": 10, "scores": "forward"}` where each query
+        is a dictionary with `points`, `vect` and (optionally) `alpha`, `id`
+        and `k` (see `dotprops_to_json`). `GET /info` returns basic info on
+        the library. Use [`navis.nbl.server.NBlastClient`][] to send queries.
+
+        Parameters
+        ----------
+        host :      str
+                    Address to listen on. Defaults to localhost only.
+        port :      int
+                    Port to listen on. Use `0` to pick a free port.
+        block :     bool
+                    If True, will serve until interrupted. If False, will
+                    serve from a background thread and return immediately.
+
+        Returns
+        -------
+        http.server.HTTPServer
+                    Use `.server_address` to get the address and port,
+                    `.shutdown()` to stop serving and `.server_close()` to
+                    release the socket.
+
+        """
+        handler = type('Handler', (_RequestHandler, ), {'nblast_server': self})
+        httpd = HTTPServer((host, port), handler)
+        logger.info(f'Serving {len(self)} NBLAST targets at '
+                    f'http://{httpd.server_address[0]}:{httpd.server_address[1]}')
+
+        if not block:
+            thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+            thread.start()
+            return httpd
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+        return httpd
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Translate HTTP requests into calls to an NBlastServer."""
+
+    nblast_server = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/info':
+            return self._reply(404, {'error': f'Unknown endpoint "{self.path}"'})
+        server = self.nblast_server
+        self._reply(200, {'n_targets': len(server),
+                          'n_shards': len(server.shards),
+                          'target_ids': server.target_ids.tolist()})
+
+    def do_POST(self):
+        endpoint = self.path.rstrip('/')
+        if endpoint not in ('/query', '/scores'):
+            return self._reply(404, {'error': f'Unknown endpoint "{self.path}"'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+            queries = NeuronList([dotprops_from_json(q) for q in payload['queries']])
+            scores = payload.get('scores', 'forward')
+            if endpoint == '/query':
+                res = self.nblast_server.query(queries,
+                                               N=payload.get('N', 10),
+                                               scores=scores)
+                data = res.to_dict(orient='list')
+            else:
+                res = self.nblast_server.scores(queries, scores=scores)
+                data = {'query': res.index.tolist(),
+                        'target': res.columns.tolist(),
+                        'scores': res.values.tolist()}
+        except (KeyError, ValueError, TypeError) as e:
+            return self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+        except Exception as e:
+            # Anything else is on us - but the client still deserves an answer
+            logger.error(f'Error while processing {endpoint} request: {e}')
+            return self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+
+        self._reply(200, data)
+
+
+def dotprops_to_json(x: Dotprops) -> dict:
+    """Turn Dotprops into a JSON-serializable dictionary."""
+    d = {'id': x.id.item() if isinstance(x.id, np.generic) else x.id,
+         'k': x.k,
+         'units': x._unit_str,
+         'points': x.points.tolist(),
+         'vect': x.vect.tolist()}
+    if x.has_alpha:
+        d['alpha'] = x.alpha.tolist()
+    return d
+
+
+def dotprops_from_json(d: dict) -> Dotprops:
+    """Turn dictionary (see `dotprops_to_json`) back into Dotprops."""
+    alpha = d.get('alpha', None)
+    return Dotprops(np.asarray(d['points'], dtype=np.float64),
+                    k=d.get('k', 5),
+                    vect=np.asarray(d['vect'], dtype=np.float64),
+                    alpha=np.asarray(alpha, dtype=np.float64) if alpha is not None else None,
+                    units=d.get('units', None),
+                    id=d.get('id', None))
+
+
+class NBlastClient:
+    """Query an [`navis.nbl.server.NBlastServer`][] over HTTP.
+
+    Parameters
+    ----------
+    url :       str
+                Address of the server, e.g. "http://127.0.0.1:8000".
+    timeout :   float, optional
+                Timeout for requests in seconds.
+
+    Examples
+    --------
+    >>> import navis
+    >>> from navis.nbl.server import NBlastServer, NBlastClient
+    >>> nl = navis.example_neurons(n=5)
+    >>> dps = navis.make_dotprops(nl, k=5) / 125
+    >>> server = NBlastServer(dps, n_cores=1)
+    >>> httpd = server.serve(port=0, block=False)
+    >>> client = NBlastClient('http://{}:{}'.format(*httpd.server_address))
+    >>> matches = client.query(dps[0], N=3)
+    >>> # Stop serving and release the socket and workers
+    >>> httpd.shutdown()
+    >>> httpd.server_close()
+    >>> server.close()
+
+    """
+
+    def __init__(self, url: str, timeout: Optional[float] = None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.url})>'
+
+    def _request(self, endpoint, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urlrequest.Request(f'{self.url}/{endpoint}', data=data,
+                                 headers={'Content-Type': 'application/json'})
+        try:
+            with urlrequest.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read())
+        except HTTPError as e:
+            # Surface the error message sent by the server
+            try:
+                msg = json.loads(e.read())['error']
+            except Exception:
+                raise e
+            raise ValueError(f'Server responded with error: {msg}')
+
+    def _payload(self, query, **kwargs):
+        query = NeuronList(query)
+        if query.types != (Dotprops, ):
+            raise TypeError(f'`query` must be Dotprop(s), got "{query.types}". '
+                            'Use `navis.make_dotprops` to convert neurons.')
+        return dict(queries=[dotprops_to_json(n) for n in query], **kwargs)
+
+    def info(self) -> dict:
+        """Get info on the server's library."""
+        return self._request('info')
+
+    def query(self,
+              query: Union[Dotprops, NeuronList],
+              N: int = 10,
+              scores: str = 'forward') -> pd.DataFrame:
+        """Find the top `N` matches for query(s).
+
+        See `NBlastServer.query` for details.
+        """
+        res = self._request('query', self._payload(query, N=N, scores=scores))
+        return pd.DataFrame(res)
+
+    def scores(self,
+               query: Union[Dotprops, NeuronList],
+               scores: str = 'forward') -> pd.DataFrame:
+        """NBLAST query(s) against the full library.
+
+        See `NBlastServer.scores` for details.
+        """
+        res = self._request('scores', self._payload(query, scores=scores))
+        return pd.DataFrame(res['scores'],
+                            index=pd.Index(res['query'], name='query'),
+                            columns=pd.Index(res['target'], name='target'))
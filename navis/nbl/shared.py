@@ -0,0 +1,264 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Shared-memory storage of dotprops for multi-process NBLASTs."""
+
+import atexit
+import copy
+import uuid
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from multiprocessing import shared_memory
+
+from .. import config
+from ..core import Dotprops, NeuronList
+
+__all__ = ['DotpropsStore', 'share_dotprops']
+
+logger = config.get_logger(__name__)
+
+# Per-process registry of attached shared memory blocks and the dotprops
+# we already reconstructed from them. Worker processes will re-use those
+# across jobs which means that e.g. KD-trees are only built once per worker.
+_ATTACHED = {}
+_DOTPROPS = {}
+
+
+class DotpropsStore:
+    """Packed points, vectors and alpha values of dotprops in shared memory.
+
+    The data of all dotprops is concatenated into contiguous arrays that
+    live in `multiprocessing.shared_memory` blocks. Indexing the store returns
+    [`navis.Dotprops`][] that, when pickled (e.g. to be sent to a worker
+    process), are reduced to a reference (block names + offsets) instead of
+    their data. Workers then attach to the shared memory and reconstruct the
+    dotprops as views into those blocks.
+
+    Use as context manager to make sure the shared memory is released::
+
+        with DotpropsStore(dps) as store:
+            ...
+
+    Parameters
+    ----------
+    x :         NeuronList of Dotprops
+                Dotprops to pack into the store.
+    alpha :     bool
+                Whether to also pack the alpha values. Only necessary if you
+                want to use `use_alpha=True` for NBLAST.
+
+    """
+
+    def __init__(self, x, alpha=False):
+        x = NeuronList(x)
+        if x.types != (Dotprops, ):
+            raise TypeError(f'Expected Dotprops, got "{x.types}"')
+
+        self.alpha = alpha
+        self.ids = list(x.id)
+        self._neurons = x
+        self._meta = [(n.id, getattr(n, 'name', None), n.k, n._unit_str) for n in x]
+
+        n_points = np.array([len(n.points) for n in x])
+        self.offsets = np.zeros(len(x) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(n_points)
+
+        arrays = {'points': [n.points for n in x],
+                  'vect': [n.vect for n in x]}
+        if alpha:
+            arrays['alpha'] = [n.alpha for n in x]
+
+        # Generate a shared memory block for each type of data
+        self._shm = {}
+        self._arrays = {}
+        self.spec = {}
+        prefix = f'navis_{uuid.uuid4().hex[:12]}'
+        for k, v in arrays.items():
+            dtype = np.result_type(*v)
+            shape = (int(self.offsets[-1]), ) + v[0].shape[1:]
+            size = max(1, int(np.prod(shape)) * dtype.itemsize)
+            shm = shared_memory.SharedMemory(name=f'{prefix}_{k}',
+                                             create=True,
+                                             size=size)
+            arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            np.concatenate(v, axis=0, out=arr, casting='unsafe')
+            self._shm[k] = shm
+            self._arrays[k] = arr
+            self.spec[k] = (shm.name, shape, dtype.str)
+
+        # Make the spec hashable so that we can use it as key
+        self.spec = tuple(sorted(self.spec.items()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __getitem__(self, ix):
+        if not isinstance(ix, (int, np.integer)):
+            raise TypeError(f'Can only index `DotpropsStore` by integer, got "{type(ix)}"')
+        # Note that in this process we are using the original data instead of
+        # views into the shared memory: this way we don't have to keep track
+        # of exported buffers when closing the store
+        n = self._neurons[ix]
+        arrays = {'points': n.points, 'vect': n.vect}
+        if self.alpha:
+            arrays['alpha'] = n.alpha
+        s, e = self.offsets[ix], self.offsets[ix + 1]
+        return _make_dotprops(arrays, 0, len(n.points), self._meta[ix],
+                              ref=(self.spec, s, e, self._meta[ix]))
+
+    def __getstate__(self):
+        raise TypeError('`DotpropsStore` can not be pickled. Pickle the '
+                        'dotprops obtained from it instead.')
+
+    @property
+    def nbytes(self):
+        """Size of the shared memory in bytes."""
+        return sum(a.nbytes for a in self._arrays.values())
+
+    def close(self):
+        """Release (and unlink) the shared memory."""
+        # Arrays must be dropped before we can close the memory
+        self._arrays = {}
+        for k, shm in self._shm.items():
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._shm = {}
+
+
+@contextmanager
+def share_dotprops(*x, enabled=True, alpha=False):
+    """Context manager that packs NeuronLists of dotprops into shared memory.
+
+    Parameters
+    ----------
+    *x :        NeuronList of Dotprops
+                Dotprops to share. Lists consisting of the same neurons will
+                share a single store.
+    enabled :   bool
+                If False, will simply yield the input.
+    alpha :     bool
+                Whether to also share the alpha values.
+
+    Yields
+    ------
+    tuple
+                One `DotpropsStore` (or, if `enabled=False`, the original
+                NeuronList) for each input.
+
+    """
+    if not enabled:
+        yield x
+        return
+
+    stores = []
+    try:
+        for nl in x:
+            for other, st in zip(x, stores):
+                if len(other) == len(nl) and all(a is b for a, b in zip(other, nl)):
+                    stores.append(st)
+                    break
+            else:
+                stores.append(DotpropsStore(nl, alpha=alpha))
+        yield tuple(stores)
+    finally:
+        for st in stores:
+            st.close()
+
+
+class SharedDotprops(Dotprops):
+    """Dotprops whose data lives in a [`navis.nbl.shared.DotpropsStore`][].
+
+    Pickles as reference into the shared memory rather than as data.
+    Copies are regular [`navis.Dotprops`][].
+
+    """
+
+    def __reduce__(self):
+        return (_from_shared, self._shared_ref)
+
+    def copy(self) -> 'Dotprops':
+        """Return a (regular, non-shared) copy of the dotprops."""
+        x = Dotprops(points=np.zeros((0, 3)), k=1,
+                     vect=np.zeros((0, 3)), alpha=np.zeros(0))
+        no_copy = ['_lock', '_tree', '_shared_ref']
+        x.__dict__.update({k: copy.copy(v) for k, v in self.__dict__.items() if k not in no_copy})
+        return x
+
+
+def _make_dotprops(arrays, s, e, meta, ref):
+    """Generate dotprops from views into the packed arrays."""
+    id, name, k, units = meta
+    alpha = arrays['alpha'][s:e] if 'alpha' in arrays else None
+    dp = SharedDotprops(points=arrays['points'][s:e],
+                        k=k,
+                        vect=arrays['vect'][s:e],
+                        alpha=alpha,
+                        units=units,
+                        id=id)
+    # Avoid registering `name` if there isn't one
+    if name is not None:
+        dp.name = name
+    dp._shared_ref = ref
+    return dp
+
+
+def _attach(spec):
+    """Attach to shared memory blocks (once per process)."""
+    if spec not in _ATTACHED:
+        shms, arrays = [], {}
+        for k, (name, shape, dtype) in spec:
+            # Note: worker processes share the resource tracker with the
+            # parent process which owns (and eventually unlinks) the blocks
+            shm = shared_memory.SharedMemory(name=name)
+            shms.append(shm)
+            arrays[k] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            arrays[k].flags.writeable = False
+        if not _ATTACHED:
+            atexit.register(_detach_all)
+        _ATTACHED[spec] = (shms, arrays)
+    return _ATTACHED[spec][1]
+
+
+def _detach_all():
+    """Detach from all shared memory blocks."""
+    # Views must be dropped before we can close the memory
+    _DOTPROPS.clear()
+    for shms, arrays in _ATTACHED.values():
+        arrays.clear()
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+    _ATTACHED.clear()
+
+
+def _from_shared(spec, s, e, meta):
+    """Reconstruct dotprops from shared memory reference (used for unpickling)."""
+    key = (spec, s, e)
+    if key not in _DOTPROPS:
+        arrays = _attach(spec)
+        _DOTPROPS[key] = _make_dotprops(arrays, s, e, meta, ref=(spec, s, e, meta))
+    return _DOTPROPS[key]
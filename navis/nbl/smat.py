@@ -1,10 +1,11 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 from itertools import permutations
+import itertools
 import sys
 import os
 from collections import Counter
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from typing import (
     Generic,
     Hashable,
@@ -40,6 +41,17 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_SEED = 1991
 
+# Number of values kept per dimension by `QuantileSketch` when building
+# score matrices in streaming mode
+SKETCH_SIZE = 1_000_000
+
+# Max number of cells in the grid `Digitizer` uses to look up bins for
+# irregular boundaries (see `Digitizer.compile`)
+DIGITIZER_MAX_CELLS = 100_000
+
+# Arrays smaller than this are digitized using a binary search
+DIGITIZER_MIN_SIZE = 1_000
+
 epsilon = sys.float_info.epsilon
 cpu_count = max(1, os.cpu_count() - 1)
 
@@ -76,6 +88,130 @@ def concat_results(
     return [np.concatenate(arrs) for arrs in intermediate.values()]
 
 
+class QuantileSketch:
+    """Mergeable fixed-size sample of a stream of values for estimating quantiles.
+
+    Each value is assigned a random key and we keep the `size` values with
+    the smallest keys ("bottom-k" sampling). This produces a uniform random
+    sample of everything seen so far that can be merged with other sketches
+    (e.g. from other processes) without loss. Min and max are tracked exactly.
+
+    Parameters
+    ----------
+    size :  int
+            Number of values to keep. The error of quantile estimates
+            scales with `1 / sqrt(size)`.
+
+    """
+
+    def __init__(self, size: int = SKETCH_SIZE):
+        self.size = size
+        self.n = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._values = [np.zeros(0)]
+        self._keys = [np.zeros(0)]
+
+    def __len__(self):
+        return self.n
+
+    def add(self, values: np.ndarray, keys: np.ndarray):
+        """Add values with their (uniform random) keys."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if not len(values):
+            return
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._values.append(values)
+        self._keys.append(np.asarray(keys, dtype=np.float64).ravel())
+        # Trim occasionally rather than on every addition
+        if sum(len(k) for k in self._keys) > 2 * self.size:
+            self._trim()
+
+    def merge(self, other: "QuantileSketch"):
+        """Merge another sketch into this one."""
+        other._trim()
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._values += other._values
+        self._keys += other._keys
+        self._trim()
+        return self
+
+    def _trim(self):
+        values = np.concatenate(self._values)
+        keys = np.concatenate(self._keys)
+        if len(keys) > self.size:
+            keep = np.argpartition(keys, self.size)[: self.size]
+            values, keys = values[keep], keys[keep]
+        self._values, self._keys = [values], [keys]
+
+    @property
+    def sample(self) -> np.ndarray:
+        """The sampled values."""
+        self._trim()
+        return self._values[0]
+
+    def to_digitizer(self, nbins: int, right=False, method="quantile"):
+        """Generate a digitizer from the values seen so far.
+
+        See `Digitizer.from_data` for parameters.
+
+        """
+        if method == "quantile":
+            data = self.sample
+        else:
+            # Linear and geometric partitions only need the exact min/max
+            data = np.array([self.min, self.max])
+        return Digitizer.from_data(data, nbins, right=right, method=method)
+
+
+def _pair_keys(seed, i, n):
+    """Random keys for `QuantileSketch` for the `i`-th pair.
+
+    Keys are seeded per pair so that the sketch does not depend on how the
+    pairs were split across workers.
+    """
+    return np.random.default_rng([seed, i]).random(n)
+
+
+def _sketch_pairs(match_fn, objects, pairs, offset, seed, size=SKETCH_SIZE):
+    """Apply `match_fn` to pairs of objects and collect results in sketches."""
+    sketches = None
+    for i, (q, t) in enumerate(pairs):
+        results = match_fn(objects[q], objects[t])
+        if sketches is None:
+            sketches = [QuantileSketch(size) for _ in results]
+        keys = _pair_keys(seed, offset + i, len(results[0]))
+        for sk, r in zip(sketches, results):
+            sk.add(r, keys)
+    for sk in sketches or []:
+        sk._trim()
+    return sketches
+
+
+def _count_pairs(match_fn, digitizers, objects, pairs, offset=0):
+    """Apply `match_fn` to pairs of objects and count digitized results.
+
+    `offset` is not used but part of the signature expected by
+    `LookupNdBuilder._map_chunks`.
+    """
+    counts = np.zeros([len(d) for d in digitizers], dtype=int)
+    for q, t in pairs:
+        digitize_counts(digitizers, match_fn(objects[q], objects[t]), counts)
+    return counts
+
+
+def digitize_counts(digitizers, results, counts):
+    """Digitize results (one array per dimension) and add them to `counts`."""
+    idxs = tuple(dig(r) for dig, r in zip(digitizers, results))
+    flat = np.ravel_multi_index(idxs, counts.shape)
+    counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+    return counts
+
+
 def _nblast_v1_scoring(dist: float, dp: float, sigma_scoring: int = 10):
     """NBLAST analytical scoring function following Kohl et al. (2013).
 
@@ -344,23 +480,11 @@ class LookupNdBuilder:
 
         Requires digitizers.
         """
-        # Digitize
-        idxs = [dig(r) for dig, r in zip(self.digitizers, results)]
-
-        # Make a stack
-        stack = np.vstack(idxs).T
-
         # Create empty matrix if necessary
         if counts is None:
             counts = self._empty_counts()
 
-        # Get counts per cell -> this is the actual bottleneck of this function
-        cells, cnt = np.unique(stack, axis=0, return_counts=True)
-
-        # Fill matrix
-        counts[tuple(cells[:, i] for i in range(cells.shape[1]))] += cnt
-
-        return counts
+        return digitize_counts(self.digitizers, results, counts)
 
     def _counts_array(
         self,
@@ -403,6 +527,79 @@ class LookupNdBuilder:
 
         return counts
 
+    def _map_chunks(self, func, idx_pairs, threads=None, progress=True,
+                    desc=None, **kwargs):
+        """Run `func` on chunks of index pairs and yield results.
+
+        In contrast to `_query_many`, each job gets a chunk of pairs plus the
+        objects they reference (each only once) and is expected to reduce
+        the raw match results to something small (e.g. counts). `func` is
+        called as `func(objects=..., pairs=..., offset=..., **kwargs)` where
+        `offset` is the index of the chunk's first pair.
+        """
+        idx_pairs = list(idx_pairs)
+        n_jobs = 1 if threads is None else (threads or cpu_count)
+        size = chunksize(len(idx_pairs), n_jobs)
+        chunks = [(i, idx_pairs[i:i + size]) for i in range(0, len(idx_pairs), size)]
+
+        def job_args(offset, chunk):
+            keys = {k for pair in chunk for k in pair}
+            objects = {k: self.objects[k] for k in keys}
+            return dict(objects=objects, pairs=chunk, offset=offset, **kwargs)
+
+        with config.tqdm(
+            desc=desc, total=len(idx_pairs), leave=False, disable=not progress
+        ) as pbar:
+            if n_jobs == 1 or len(chunks) == 1:
+                for offset, chunk in chunks:
+                    yield func(**job_args(offset, chunk))
+                    pbar.update(len(chunk))
+                return
+
+            with ProcessPoolExecutor(n_jobs) as exe:
+                # Submit lazily so that we don't hold all objects for all
+                # chunks in memory at the same time
+                futures = {}
+                chunks = iter(chunks)
+                for offset, chunk in itertools.islice(chunks, 2 * n_jobs):
+                    futures[exe.submit(func, **job_args(offset, chunk))] = len(chunk)
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        n = futures.pop(f)
+                        yield f.result()
+                        pbar.update(n)
+                    for offset, chunk in itertools.islice(chunks, len(done)):
+                        futures[exe.submit(func, **job_args(offset, chunk))] = len(chunk)
+
+    def _counts_array_streaming(self, idx_pairs, threads=None, progress=True, desc=None):
+        """Convert index pairs into a digitized counts array.
+
+        Workers digitize and count locally and only return the counts.
+        Requires digitizers.
+        """
+        counts = self._empty_counts()
+        for c in self._map_chunks(
+            _count_pairs, idx_pairs, threads=threads, progress=progress,
+            desc=desc, match_fn=self.match_fn, digitizers=self.digitizers,
+        ):
+            counts += c
+        return counts
+
+    def _sketch(self, idx_pairs, threads=None, progress=True, desc=None):
+        """Collect `QuantileSketch` for each dimension of the match results."""
+        sketches = None
+        # Note that the merged sketch does not depend on the order of merging
+        for sk in self._map_chunks(
+            _sketch_pairs, idx_pairs, threads=threads, progress=progress,
+            desc=desc, match_fn=self.match_fn, seed=self.seed, size=SKETCH_SIZE,
+        ):
+            if sketches is None:
+                sketches = sk
+            elif sk is not None:
+                sketches = [a.merge(b) for a, b in zip(sketches, sk)]
+        return sketches
+
     def _pick_nonmatching_pairs(self, n_matching_qual_vals, progress=True):
         """Using the seeded RNG, pick which non-matching pairs to use."""
         # pre-calculating which pairs we're going to use,
@@ -487,7 +684,9 @@ class LookupNdBuilder:
 
         return matching_pairs, nonmatching_pairs
 
-    def _build(self, threads, progress=True) -> Tuple[List[Digitizer], np.ndarray]:
+    def _build(
+        self, threads, progress=True, streaming=False
+    ) -> Tuple[List[Digitizer], np.ndarray]:
         # Asking for more threads than available CPUs seems to crash on Github
         # actions
         if threads and threads >= cpu_count:
@@ -500,9 +699,39 @@ class LookupNdBuilder:
 
         self.matching_pairs, self.nonmatching_pairs = self._get_pairs()
 
+        # In streaming mode, workers only return counts (and sketches of
+        # the data for fitting digitizers) instead of the raw data
+        counts_array = self._counts_array_streaming if streaming else self._counts_array
+
         logger.info("Comparing matching pairs")
         if self.digitizers:
-            self.match_counts_ = self._counts_array(
+            self.match_counts_ = counts_array(
+                self.matching_pairs,
+                threads=threads,
+                progress=progress,
+                desc="Comparing matching pairs",
+            )
+        elif streaming:
+            sketches = self._sketch(
+                self.matching_pairs,
+                threads=threads,
+                progress=progress,
+                desc="Sketching matching pairs",
+            )
+            self.digitizers = []
+            for i, (sk, nbins) in enumerate(zip(sketches, self.bin_counts)):
+                if not isinstance(nbins, Digitizer):
+                    try:
+                        self.digitizers.append(
+                            sk.to_digitizer(nbins, method=self.bin_method)
+                        )
+                    except BaseException as e:
+                        logger.error(f"Error creating digitizers for axes {i + 1}")
+                        raise e
+                else:
+                    self.digitizers.append(nbins)
+
+            self.match_counts_ = counts_array(
                 self.matching_pairs,
                 threads=threads,
                 progress=progress,
@@ -533,7 +762,7 @@ class LookupNdBuilder:
             self.match_counts_ = self._count_results(match_results)
 
         logger.info("Comparing non-matching pairs")
-        self.nonmatch_counts_ = self._counts_array(
+        self.nonmatch_counts_ = counts_array(
             self.nonmatching_pairs,
             threads=threads,
             progress=progress,
@@ -553,7 +782,7 @@ class LookupNdBuilder:
 
         return self.digitizers, self.cells_
 
-    def build(self, threads=None) -> LookupNd:
+    def build(self, threads=None, streaming=False) -> LookupNd:
         """Build the score matrix.
 
         All non-identical neuron pairs within all matching sets are selected,
@@ -575,12 +804,21 @@ class LookupNdBuilder:
                     Note that with the currently implementation a large number
                     of threads might (and somewhat counterintuitively) actually
                     be slower than running building the scoring function in serial.
+        streaming : bool
+                    If True, workers digitize the match results and
+                    accumulate counts locally so that only the (small)
+                    count arrays are returned. If digitizers have to be
+                    fitted (see `with_bin_counts`), quantiles are estimated
+                    from a fixed-size sample (see `QuantileSketch`) instead
+                    of from all data. This keeps memory usage constant
+                    regardless of the number of pairs at the cost of
+                    computing matching pairs twice when fitting digitizers.
 
         Returns
         -------
         LookupNd
         """
-        dig, cells = self._build(threads)
+        dig, cells = self._build(threads, streaming=streaming)
         return LookupNd(dig, cells)
 
 
@@ -650,8 +888,8 @@ class LookupDistDotBuilder(LookupNdBuilder):
         )
         self._ndim = 2
 
-    def build(self, threads=None) -> Lookup2d:
-        (dig0, dig1), cells = self._build(threads)
+    def build(self, threads=None, streaming=False) -> Lookup2d:
+        (dig0, dig1), cells = self._build(threads, streaming=streaming)
         return Lookup2d(dig0, dig1, cells)
 
 
@@ -779,19 +1017,139 @@ class Digitizer(LookupAxis[float]):
             )
 
         self.boundaries = np.asarray(boundaries)
+        self.boundaries32 = self.boundaries.astype(np.float32)
 
     def __len__(self):
         return len(self.boundaries) - 1
 
     def __call__(self, value: float):
+        boundaries = self.boundaries
+        # For single precision input, search in single precision boundaries -
+        # otherwise numpy would upcast (i.e. copy) the values
+        if getattr(value, "dtype", None) == np.float32:
+            boundaries = self.boundaries32
+
+        # For larger arrays, get the bins from arithmetic instead
+        if (
+            isinstance(value, np.ndarray)
+            and value.size >= DIGITIZER_MIN_SIZE
+            and value.dtype.kind in "fiu"
+        ):
+            layout = self.compile()
+            if layout is not None:
+                return self._digitize_compiled(value, boundaries, layout)
+
         # searchsorted is marginally faster than digitize as it skips monotonicity checks
         return (
             np.searchsorted(
-                self.boundaries, value, side="left" if self.right else "right"
+                boundaries, value, side="left" if self.right else "right"
             )
             - 1
         )
 
+    def compile(self):
+        """Work out how to get bin indices from arithmetic.
+
+        The bin of a value is estimated from its offset to the lowest
+        (finite) boundary:
+
+         - "linear": evenly spaced boundaries, `(value - lower) / width`
+         - "geometric": boundaries in a geometric sequence, the same in log
+           space
+         - "table": other boundaries, via a grid of cells half the width of
+           the narrowest bin which maps each cell to a bin
+
+        Estimates are then corrected by comparing against the boundaries
+        which means results for finite values are exactly the same as from a
+        binary search.
+
+        Returns
+        -------
+        tuple | None
+                `None` if boundaries don't allow for any of the above. The
+                result is cached.
+
+        """
+        if getattr(self, "_layout", False) is not False:
+            return self._layout
+
+        layout = None
+        inner = self.boundaries[1:-1]  # finite boundaries
+        if len(inner) >= 2:
+            widths = np.diff(inner)
+            ratios = inner[1:] / inner[:-1] if inner[0] > 0 else None
+            if np.allclose(widths, widths[0], rtol=1e-6, atol=0):
+                layout = ("linear", inner[0], 1 / widths[0], None)
+            elif ratios is not None and np.allclose(
+                ratios, ratios[0], rtol=1e-6, atol=0
+            ):
+                layout = (
+                    "geometric",
+                    math.log(inner[0]),
+                    1 / math.log(ratios[0]),
+                    None,
+                )
+            else:
+                step = widths.min() / 2
+                n_cells = int(math.ceil((inner[-1] - inner[0]) / step)) + 1
+                if n_cells <= DIGITIZER_MAX_CELLS:
+                    # Bin at the left edge of each cell
+                    edges = inner[0] + np.arange(n_cells) * step
+                    table = self._search(edges)
+                    layout = ("table", inner[0], 1 / step, table)
+
+        self._layout = layout
+        return layout
+
+    def _search(self, value, boundaries=None):
+        """Bins via binary search."""
+        if boundaries is None:
+            boundaries = self.boundaries
+        side = "left" if self.right else "right"
+        return np.searchsorted(boundaries, value, side=side) - 1
+
+    def _digitize_compiled(self, value, boundaries, layout):
+        """Bins via arithmetic (see `.compile`)."""
+        kind, offset, scale, table = layout
+        n_bins = len(self)
+
+        # Estimate position relative to the lowest boundary
+        if kind == "geometric":
+            x = np.maximum(value, np.finfo(np.float64).tiny, dtype=np.float64)
+            np.log(x, out=x)
+            x -= offset
+        else:
+            x = np.subtract(value, offset, dtype=np.float64)
+        x *= scale
+        np.floor(x, out=x)
+
+        if kind == "table":
+            np.maximum(x, 0, out=x)
+            np.minimum(x, len(table) - 1, out=x)
+            ix = table[x.astype(np.intp)]
+            n_pass = 2  # cells are half the narrowest bin -> off by up to 2
+        else:
+            # Bin 0 is everything below the lowest finite boundary
+            x += 1
+            np.maximum(x, 0, out=x)
+            np.minimum(x, n_bins - 1, out=x)
+            ix = x.astype(np.intp)
+            n_pass = 1
+
+        # Correct estimates that are off (e.g. due to rounding at the edges)
+        for _ in range(n_pass):
+            if self.right:
+                ix -= value <= boundaries[ix]
+                ix += value > boundaries[ix + 1]
+            else:
+                ix -= value < boundaries[ix]
+                ix += value >= boundaries[ix + 1]
+            # Only relevant for infinite values
+            np.maximum(ix, 0, out=ix)
+            np.minimum(ix, n_bins - 1, out=ix)
+
+        return ix
+
     def to_strings(self, round=None) -> List[str]:
         """Turn boundaries into list of labels.
 
@@ -977,6 +1335,21 @@ class LookupNd:
             )
 
         idxs = tuple(d(arg) for d, arg in zip(self.axes, args))
+
+        # For arrays of indices, a single lookup into the flattened cells is
+        # faster than fancy-indexing with multiple arrays
+        if (
+            len(idxs) > 1
+            and all(isinstance(i, np.ndarray) for i in idxs)
+            and all(i.shape == idxs[0].shape for i in idxs)
+            and idxs[0].size >= DIGITIZER_MIN_SIZE
+        ):
+            flat = idxs[0].astype(np.intp, copy=True)
+            for i, n in zip(idxs[1:], self.cells.shape[1:]):
+                flat *= n
+                flat += i
+            return self.cells.ravel().take(flat)
+
         out = self.cells[idxs]
         return out
 
@@ -14,6 +14,7 @@
 
 """Module contains functions implementing SyNBLAST."""
 
+import itertools
 import os
 import operator
 import time
@@ -29,8 +30,10 @@ from typing_extensions import Literal
 from .. import config, utils
 from ..core import NeuronList, BaseNeuron
 
-from .base import Blaster, NestedIndices
-from .smat import Lookup2d
+from .base import Blaster, NestedIndices, combine_scores, scores_to_frame
+from .cache import ScoreCache, cached_scores, parse_cache
+from .checkpoint import hash_params
+from .smat import Lookup2d, LookupNd
 
 from .nblast_funcs import (check_microns, find_optimal_partition,
                            nblast_preflight, smat_fcwb)
@@ -84,17 +87,27 @@ class SynBlaster(Blaster):
                     If `smat=None` the scores will be
                     generated as the product of the distances and the dotproduct
                     of the vectors of nearest-neighbor pairs.
+    batched :       bool
+                    If True (default) and the scoring function is a lookup
+                    table, `multi_query_target` will put the synapses of all
+                    targets (per type) into a single spatial index labelled
+                    by neuron. A single lookup per query against that index
+                    tells us which targets are in reach; only those need
+                    actual nearest-neighbor queries. This relies on distances
+                    beyond the last bin of the lookup table all getting the
+                    same score.
     progress :      bool
                     If True, will show a progress bar.
 
     """
 
     def __init__(self, normalized=True, by_type=True,
-                 smat='auto', progress=True):
+                 smat='auto', batched=True, progress=True):
         """Initialize class."""
         super().__init__(progress=progress)
         self.normalized = normalized
         self.by_type = by_type
+        self.batched = batched
 
         if smat is None:
             self.score_fn = operator.mul
@@ -187,7 +200,7 @@ class SynBlaster(Blaster):
             if ty not in t_trees:
                 # Note that this infinite distance will simply get the worst
                 # score possible in the scoring function
-                dists = np.append(dists, [self.score_fn.max_dist] * qt.data.shape[0])
+                dists.append(np.full(len(_points(qt)), np.inf))
             else:
                 # Note: we're building the trees lazily here once we actually need them.
                 # The main reason is that pykdtree is not picklable and hence
@@ -195,20 +208,11 @@ class SynBlaster(Blaster):
                 if not isinstance(t_trees[ty], KDTree):
                     t_trees[ty] = KDTree(t_trees[ty])
 
-                tt = t_trees[ty]
-                if isinstance(qt, KDTree):
-                    data = qt.data
-                else:
-                    data = qt
-
-                # pykdtree tracks data as flat array
-                if data.ndim == 1:
-                    data = data.reshape((qt.n, qt.ndim))
-                dists = np.append(dists, tt.query(data)[0])
+                dists.append(t_trees[ty].query(_points(qt))[0])
 
         # We use the same scoring function as for normal NBLAST but ignore the
         # vector dotproduct component
-        scr = self.score_fn(dists, 1).sum()
+        scr = self.score_fn(np.concatenate(dists), 1).sum()
 
         # Normalize against best possible hit (self hit)
         if self.normalized:
@@ -227,6 +231,189 @@ class SynBlaster(Blaster):
         return scr
 
 
+    def multi_query_target(self, q_idx, t_idx, scores='forward'):
+        """SyNBLAST multiple queries against multiple targets.
+
+        Parameters
+        ----------
+        q_idx,t_idx :       iterable
+                            Iterable of query/target neuron indices to BLAST.
+        scores :            "forward" | "mean" | "min" | "max" | "both"
+                            Which scores to return.
+
+        """
+        if not self.batched or self.cutoff is None:
+            return super().multi_query_target(q_idx, t_idx, scores=scores)
+
+        q_idx = np.asarray(q_idx, dtype=int)
+        t_idx = np.asarray(t_idx, dtype=int)
+
+        res = self._batched_scores(q_idx, t_idx)
+
+        # For anything but forward scores we also need the reverse scores
+        if scores != 'forward':
+            res = combine_scores(res, self._batched_scores(t_idx, q_idx).T,
+                                 scores=scores)
+
+        return self._results_to_frame(res.astype(self.dtype, copy=False),
+                                      q_idx, t_idx)
+
+    @property
+    def cutoff(self):
+        """Distance beyond which all synapses get the same score.
+
+        `None` if the scoring function is not a lookup table.
+        """
+        if not isinstance(self.score_fn, LookupNd):
+            return None
+        b = self.score_fn.axes[0].boundaries
+        if b[-1] != np.inf:
+            return None
+        return max(b[-2], 0) if len(b) > 2 else 0
+
+    def _batched_scores(self, q_idx, t_idx):
+        """Forward scores for all queries against all targets.
+
+        For each connector type, the synapses of all targets are binned
+        into a single voxel index labelled by neuron (see `SynapseIndex`).
+        A single lookup per query then tells us which targets have any
+        synapses within `cutoff`. Only those are queried; all other
+        targets get the score for "infinitely far away" for every synapse.
+
+        Returns
+        -------
+        np.ndarray
+                    (len(q_idx), len(t_idx)) array of forward scores.
+
+        """
+        res = np.zeros((len(q_idx), len(t_idx)), dtype=np.float64)
+        self_hits = np.asarray(self.self_hits, dtype=np.float64)
+
+        # Score for a synapse without a match within the cutoff
+        far = np.asarray(self.score_fn(np.array([np.inf]), 1)).ravel()[0]
+        cutoff = self.cutoff
+
+        types = {ty for q in q_idx for ty in self.neurons[q]}
+        with config.tqdm(desc=self.desc,
+                         total=len(types) * len(q_idx),
+                         leave=False,
+                         position=getattr(self, 'pbar_position', None),
+                         disable=not self.progress) as pbar:
+            for ty in types:
+                # A single index for this type's synapses across all targets
+                has_type = [k for k, t in enumerate(t_idx) if ty in self.neurons[t]]
+                index = None
+                if has_type and cutoff > 0:
+                    index = SynapseIndex([_points(self.neurons[t_idx[k]][ty]) for k in has_type],
+                                         labels=has_type,
+                                         voxel_size=cutoff)
+
+                for i, q in enumerate(q_idx):
+                    pbar.update()
+                    if ty not in self.neurons[q]:
+                        continue
+
+                    q_points = _points(self.neurons[q][ty])
+                    res[i] += len(q_points) * far
+
+                    if index is None or not len(q_points):
+                        continue
+
+                    for k in index.within(q_points):
+                        t_trees = self.neurons[t_idx[k]]
+                        # Build trees lazily (see `single_query_target`)
+                        if not isinstance(t_trees[ty], KDTree):
+                            t_trees[ty] = KDTree(t_trees[ty])
+                        dists = t_trees[ty].query(q_points, distance_upper_bound=cutoff)[0]
+                        dists = dists[dists <= cutoff]
+                        # Replace the "far" score with the actual score
+                        res[i, k] += (self.score_fn(dists, 1) - far).sum()
+
+        # Normalize against best hit
+        if self.normalized:
+            res /= self_hits[q_idx].reshape(-1, 1)
+
+        # Fix self-self comparisons
+        is_self = q_idx.reshape(-1, 1) == t_idx.reshape(1, -1)
+        if np.any(is_self):
+            res[is_self] = 1 if self.normalized else self_hits[q_idx[np.where(is_self)[0]]]
+
+        return res
+
+
+class SynapseIndex:
+    """Voxel index of point clouds labelled by the neuron they belong to.
+
+    Points are binned into voxels of size `voxel_size`. Any point within
+    `voxel_size` of a given point is therefore in the same or in one of the
+    26 neighbouring voxels.
+
+    Parameters
+    ----------
+    points :        list of (N, 3) arrays
+                    One point cloud per neuron.
+    labels :        list
+                    One label per point cloud.
+    voxel_size :    float
+                    Size of the voxels. Typically the max distance we care
+                    about.
+
+    """
+
+    # Offsets to the 27 voxels around (and including) a voxel
+    NEIGHBOURS = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+    def __init__(self, points, labels, voxel_size):
+        self.voxel_size = voxel_size
+        keys = [np.unique(self._keys(p)) for p in points]
+        labels = np.repeat(labels, [len(k) for k in keys])
+        keys = np.concatenate(keys)
+        srt = np.argsort(keys, kind='stable')
+        self.keys, self.labels = keys[srt], labels[srt]
+
+    def _voxels(self, points):
+        return np.floor(np.asarray(points) / self.voxel_size).astype(np.int64)
+
+    @staticmethod
+    def _encode(voxels):
+        # 21 bits per axis, i.e. up to ~1M voxels in either direction
+        voxels = voxels + 2 ** 20
+        return (voxels[..., 0] << 42) | (voxels[..., 1] << 21) | voxels[..., 2]
+
+    def _keys(self, points):
+        return self._encode(self._voxels(points))
+
+    def within(self, points):
+        """Labels of point clouds that may have points within `voxel_size`.
+
+        This is a superset: for some of the returned labels, the closest
+        point may be up to `2 * sqrt(3) * voxel_size` away.
+        """
+        vx = np.unique(self._voxels(points), axis=0)
+        keys = np.unique(self._encode(vx[:, None, :] + self.NEIGHBOURS[None, :, :]))
+        lo = np.searchsorted(self.keys, keys, side='left')
+        hi = np.searchsorted(self.keys, keys, side='right')
+        hit = hi > lo
+        if not hit.any():
+            return np.zeros(0, dtype=self.labels.dtype)
+        lo, hi = lo[hit], hi[hit]
+        # Indices of all entries in [lo, hi) ranges
+        n = hi - lo
+        ix = np.repeat(lo - np.cumsum(np.append(0, n[:-1])), n) + np.arange(n.sum())
+        return np.unique(self.labels[ix])
+
+
+def _points(x):
+    """Get points from array or KDTree."""
+    if not isinstance(x, KDTree):
+        return x
+    # pykdtree tracks data as flat array
+    data = x.data
+    if data.ndim == 1:
+        data = data.reshape((x.n, x.ndim))
+    return data
+
+
 def synblast(query: Union['BaseNeuron', 'NeuronList'],
              target: Union['BaseNeuron', 'NeuronList'],
              by_type: bool = False,
@@ -238,6 +425,7 @@ def synblast(query: Union['BaseNeuron', 'NeuronList'],
              normalized: bool = True,
              smat: Optional[Union[str, pd.DataFrame]] = 'auto',
              n_cores: int = os.cpu_count() // 2,
+             cache: Optional[Union[str, ScoreCache]] = None,
              progress: bool = True) -> pd.DataFrame:
     """Synapsed-based variant of NBLAST.
 
@@ -281,6 +469,12 @@ def synblast(query: Union['BaseNeuron', 'NeuronList'],
                     implementation. If `smat=None` the scores will be
                     generated as the product of the distances and the dotproduct
                     of the vectors of nearest-neighbor pairs.
+    cache :         str | ScoreCache, optional
+                    Persistent cache for scores (see
+                    `navis.nbl.cache.ScoreCache`) or path to one. Scores are
+                    keyed by a hash of the neurons' (relevant) connectors and
+                    the scoring parameters: only pairs not already in the
+                    cache are computed and then added to it.
     progress :      bool
                     Whether to show progress bars. This may cause some overhead,
                     so switch off if you don't really need it.
@@ -365,6 +559,31 @@ def synblast(query: Union['BaseNeuron', 'NeuronList'],
         else:
             return n.connectors
 
+    # If we have a cache, we will run SyNBLASTs only for missing pairs
+    cache = parse_cache(cache)
+    if cache is not None:
+        params = dict(kind='synblast',
+                      by_type=by_type,
+                      cn_types=cn_types,
+                      normalized=normalized,
+                      smat=smat)
+        kwargs = dict(scores='forward',
+                      n_cores=n_cores,
+                      progress=progress,
+                      **{k: v for k, v in params.items() if k != 'kind'})
+        cols = ['x', 'y', 'z'] + (['type'] if by_type else [])
+        query_keys = np.array([_connector_md5(get_connectors(n)[cols]) for n in query])
+        target_keys = np.array([_connector_md5(get_connectors(n)[cols]) for n in target])
+
+        fwd = cached_scores(synblast, query, target, cache, params,
+                            query_keys, target_keys, **kwargs)
+        if scores == 'forward':
+            return scores_to_frame(fwd, query.id, target.id)
+        rev = cached_scores(synblast, target, query, cache, params,
+                            target_keys, query_keys, **kwargs).T
+        return scores_to_frame(combine_scores(fwd, rev, scores=scores),
+                               query.id, target.id)
+
     query_self_hits = np.array([nb.calc_self_hit(get_connectors(n)) for n in query])
     target_self_hits = np.array([nb.calc_self_hit(get_connectors(n)) for n in target])
 
@@ -499,6 +718,11 @@ def synblast(query: Union['BaseNeuron', 'NeuronList'],
     return scores
 
 
+def _connector_md5(cn):
+    """Content hash for connector table."""
+    return hash_params(cn=pd.util.hash_pandas_object(cn, index=False).values)
+
+
 def find_batch_partition(q, t, T=10):
     """Find partitions such that each batch takes about `T` seconds."""
     # Get a median-sized query and target
@@ -0,0 +1,500 @@
+#    This script is part of navis (http://www.github.com/navis-org/navis).
+#    Copyright (C) 2018 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Module containing writers that collect (and optionally stream) scores."""
+
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from .. import config
+from .utils import _extract_matches_threshold
+
+__all__ = ['MemoryWriter', 'NpyWriter', 'H5Writer', 'TopNWriter',
+           'ThresholdWriter', 'read_scores']
+
+logger = config.get_logger(__name__)
+
+# Max size (in bytes) of row blocks when moving data between (possibly
+# memory-mapped) arrays
+BLOCK_SIZE_BYTES = 256 * 1024 ** 2
+
+
+class ScoreWriter(ABC):
+    """Base class for collecting the results of NBLAST jobs.
+
+    BLAST functions will call `.open()` once before any results come in,
+    then `.write()` for every finished tile and finally `.close()` to
+    produce the return value.
+
+    Parameters
+    ----------
+    out_of_core :   bool
+                    If True, intermediate buffers (e.g. forward and reverse
+                    scores before they are combined) are memory-mapped
+                    temporary files instead of in-memory arrays.
+    tmpdir :        str, optional
+                    Directory for temporary files. Defaults to the system's
+                    default temporary directory.
+
+    """
+
+    # Whether this writer only keeps a subset of the scores
+    sparse = False
+
+    def __init__(self, out_of_core=False, tmpdir=None):
+        self.out_of_core = out_of_core
+        self.tmpdir = tmpdir
+        self._tmp = None
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        """Prepare for receiving scores.
+
+        Parameters
+        ----------
+        query_ids :     iterable
+        target_ids :    iterable
+        dtype :         np.dtype
+                        Data type of the scores.
+        both :          bool
+                        If True, scores will be (N, M, 2) arrays of forward
+                        and reverse scores (i.e. `scores="both"`).
+
+        """
+        if both and self.sparse:
+            raise ValueError(f'`{type(self).__name__}` does not support '
+                             '`scores="both"`')
+
+        self.query_ids = np.asarray(query_ids)
+        self.target_ids = np.asarray(target_ids)
+        self.dtype = np.dtype(dtype)
+        self.both = both
+        self.shape = (len(self.query_ids), len(self.target_ids))
+        if both:
+            self.shape += (2, )
+
+    @abstractmethod
+    def write(self, scores, rows, cols):
+        """Write block of scores.
+
+        Parameters
+        ----------
+        scores :    (len(rows), len(cols)[, 2]) np.ndarray
+        rows :      np.ndarray
+                    Query indices of the block.
+        cols :      np.ndarray
+                    Target indices of the block.
+
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        """Finalize and return results."""
+        pass
+
+    def buffer(self, shape, dtype):
+        """Generate an empty array for intermediate results."""
+        if not self.out_of_core:
+            return np.empty(shape, dtype=dtype)
+
+        if self._tmp is None:
+            self._tmp = tempfile.mkdtemp(prefix='navis_', dir=self.tmpdir)
+            # Make sure temporary files are removed even if we never get to
+            # call `.close()` (e.g. because of an exception)
+            self._finalizer = weakref.finalize(self, shutil.rmtree,
+                                               self._tmp, ignore_errors=True)
+        fp = os.path.join(self._tmp, f'buffer_{len(os.listdir(self._tmp))}.npy')
+        return np.lib.format.open_memmap(fp, mode='w+', dtype=dtype, shape=shape)
+
+    def cleanup(self):
+        """Remove temporary files."""
+        if self._tmp is not None:
+            self._finalizer()
+            self._tmp = None
+
+    def row_blocks(self, n_cols, itemsize=8):
+        """Split rows into blocks of at most `BLOCK_SIZE_BYTES`."""
+        rows_per_block = max(1, BLOCK_SIZE_BYTES // max(1, n_cols * itemsize))
+        return [np.arange(i, min(i + rows_per_block, self.shape[0]))
+                for i in range(0, self.shape[0], rows_per_block)]
+
+
+class MemoryWriter(ScoreWriter):
+    """Collect scores in an in-memory DataFrame (the default)."""
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        super().open(query_ids, target_ids, dtype, both=both)
+        self.scores = np.empty(self.shape, dtype=self.dtype)
+
+    def write(self, scores, rows, cols):
+        self.scores[np.ix_(rows, cols)] = scores
+
+    def close(self):
+        from .base import scores_to_frame
+        return scores_to_frame(self.scores, self.query_ids, self.target_ids)
+
+
+class NpyWriter(ScoreWriter):
+    """Stream scores into a memory-mapped `.npy` file.
+
+    Query and target IDs are stored alongside in a `{filepath}.ids.npz` file
+    (see [`navis.nbl.writers.read_scores`][]).
+
+    Parameters
+    ----------
+    filepath :      str
+                    Path to the `.npy` file. Will be overwritten if it exists.
+    tmpdir :        str, optional
+                    Directory for temporary files. Defaults to the directory
+                    of `filepath`.
+
+    Returns
+    -------
+    pandas.DataFrame
+                    On `.close()`: a DataFrame backed by the read-only
+                    memory-mapped file.
+
+    """
+
+    def __init__(self, filepath, tmpdir=None):
+        self.filepath = Path(filepath).expanduser()
+        super().__init__(out_of_core=True,
+                         tmpdir=tmpdir if tmpdir else self.filepath.parent)
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        super().open(query_ids, target_ids, dtype, both=both)
+        self.scores = np.lib.format.open_memmap(self.filepath, mode='w+',
+                                                dtype=self.dtype,
+                                                shape=self.shape)
+        np.savez(_ids_path(self.filepath),
+                 query=self.query_ids, target=self.target_ids)
+
+    def write(self, scores, rows, cols):
+        # Contiguous blocks can be written as slices which is much faster
+        # than fancy indexing into a memory-mapped file
+        rows, cols = _as_slice(rows), _as_slice(cols)
+        if not isinstance(rows, slice) and not isinstance(cols, slice):
+            # Two index arrays would be paired up element-wise
+            self.scores[np.ix_(rows, cols)] = scores
+        else:
+            self.scores[rows, cols] = scores
+
+    def close(self):
+        self.scores.flush()
+        del self.scores
+        self.cleanup()
+        return read_scores(self.filepath)
+
+
+class H5Writer(ScoreWriter):
+    """Stream scores into an HDF5 dataset.
+
+    Query and target IDs are stored as `{dataset}_query` and
+    `{dataset}_target` datasets alongside the scores.
+
+    Parameters
+    ----------
+    filepath :      str
+                    Path to the HDF5 file. Will be created if it doesn't
+                    exist.
+    dataset :       str
+                    Name of the dataset. Will be overwritten if it exists.
+    compression :   str, optional
+                    Compression filter (e.g. "gzip" or "lzf") for the dataset.
+    tmpdir :        str, optional
+                    Directory for temporary files. Defaults to the directory
+                    of `filepath`.
+
+    Returns
+    -------
+    str
+                    On `.close()`: the filepath. Use
+                    [`navis.nbl.writers.read_scores`][] to load the scores.
+
+    """
+
+    def __init__(self, filepath, dataset='scores', compression=None, tmpdir=None):
+        self.filepath = Path(filepath).expanduser()
+        self.dataset = dataset
+        self.compression = compression
+        super().__init__(out_of_core=True,
+                         tmpdir=tmpdir if tmpdir else self.filepath.parent)
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        import h5py
+
+        super().open(query_ids, target_ids, dtype, both=both)
+        self.f = h5py.File(self.filepath, 'a')
+        for k in (self.dataset, f'{self.dataset}_query', f'{self.dataset}_target'):
+            if k in self.f:
+                del self.f[k]
+
+        chunks = (min(self.shape[0], 1024), min(self.shape[1], 1024)) + self.shape[2:]
+        self.scores = self.f.create_dataset(self.dataset,
+                                            shape=self.shape,
+                                            dtype=self.dtype,
+                                            chunks=chunks if all(chunks) else None,
+                                            compression=self.compression)
+        for k, ids in zip(('query', 'target'), (self.query_ids, self.target_ids)):
+            if ids.dtype.kind == 'U':
+                ids = ids.astype(h5py.string_dtype())
+            self.f.create_dataset(f'{self.dataset}_{k}', data=ids)
+
+    def write(self, scores, rows, cols):
+        rows, cols = _as_slice(rows), _as_slice(cols)
+        # h5py supports only increasing index lists (no fancy indexing on both
+        # axes at the same time)
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            self.scores[rows, cols] = scores
+        else:
+            for i, r in enumerate(np.arange(self.shape[0])[rows]):
+                self.scores[r, cols] = scores[i]
+
+    def close(self):
+        self.f.close()
+        self.cleanup()
+        return str(self.filepath)
+
+
+class TopNWriter(ScoreWriter):
+    """Keep only the top `N` targets for each query.
+
+    Tiles are reduced as they come in, so memory stays at (queries x N).
+
+    Parameters
+    ----------
+    N :             int
+                    Number of matches to keep for each query.
+    out_of_core :   bool
+                    Whether intermediate buffers (only needed for scores other
+                    than "forward") should be memory-mapped temporary files.
+    tmpdir :        str, optional
+                    Directory for temporary files.
+
+    Returns
+    -------
+    pandas.DataFrame
+                    On `.close()`: top matches in the same format as
+                    [`navis.nbl.extract_matches`][] with `N`.
+
+    """
+
+    sparse = True
+
+    def __init__(self, N, out_of_core=True, tmpdir=None):
+        if N < 1:
+            raise ValueError(f'`N` must be >= 1, got {N}')
+        self.N = int(N)
+        super().__init__(out_of_core=out_of_core, tmpdir=tmpdir)
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        super().open(query_ids, target_ids, dtype, both=both)
+        self.N = min(self.N, self.shape[1])
+        self.top_scores = np.full((self.shape[0], self.N), -np.inf, dtype=self.dtype)
+        self.top_ix = np.full((self.shape[0], self.N), -1, dtype=np.int64)
+
+    def write(self, scores, rows, cols):
+        # Combine the current top N with the new block and keep the top N
+        cand_scores = np.hstack((self.top_scores[rows], scores))
+        cand_ix = np.hstack((self.top_ix[rows],
+                             np.broadcast_to(np.asarray(cols).reshape(1, -1),
+                                             scores.shape)))
+        top = np.argpartition(cand_scores, -self.N, axis=1)[:, -self.N:]
+        self.top_scores[rows] = np.take_along_axis(cand_scores, top, axis=1)
+        self.top_ix[rows] = np.take_along_axis(cand_ix, top, axis=1)
+
+    def close(self):
+        self.cleanup()
+
+        # Sort from best to worst
+        srt = np.argsort(self.top_scores, axis=1)[:, ::-1]
+        top_scores = np.take_along_axis(self.top_scores, srt, axis=1)
+        top_ix = np.take_along_axis(self.top_ix, srt, axis=1)
+
+        matches = pd.DataFrame()
+        matches['id'] = self.query_ids
+        for i in range(self.N):
+            matches[f'match_{i + 1}'] = self.target_ids[top_ix[:, i]]
+            matches[f'score_{i + 1}'] = top_scores[:, i]
+
+        return matches
+
+
+class ThresholdWriter(ScoreWriter):
+    """Keep only scores at or above a given threshold.
+
+    Parameters
+    ----------
+    threshold :     float
+                    Scores below this value are dropped.
+    out_of_core :   bool
+                    Whether intermediate buffers (only needed for scores other
+                    than "forward") should be memory-mapped temporary files.
+    tmpdir :        str, optional
+                    Directory for temporary files.
+
+    Returns
+    -------
+    pandas.DataFrame
+                    On `.close()`: matches in the same format as
+                    [`navis.nbl.extract_matches`][] with `threshold`.
+
+    """
+
+    sparse = True
+
+    def __init__(self, threshold, out_of_core=True, tmpdir=None):
+        self.threshold = threshold
+        super().__init__(out_of_core=out_of_core, tmpdir=tmpdir)
+
+    def open(self, query_ids, target_ids, dtype, both=False):
+        super().open(query_ids, target_ids, dtype, both=both)
+        self.matches = []
+
+    def write(self, scores, rows, cols):
+        block = pd.DataFrame(scores,
+                             index=self.query_ids[rows],
+                             columns=self.target_ids[cols])
+        self.matches.append(_extract_matches_threshold(block,
+                                                       threshold=self.threshold))
+
+    def close(self):
+        self.cleanup()
+        if not self.matches:
+            return _extract_matches_threshold(pd.DataFrame(), self.threshold)
+        return pd.concat(self.matches).sort_index()
+
+
+def parse_writer(out):
+    """Parse `out` parameter into a ScoreWriter."""
+    if out is None:
+        return MemoryWriter()
+    elif isinstance(out, ScoreWriter):
+        return out
+    elif isinstance(out, (str, Path)):
+        ext = Path(out).suffix.lower()
+        if ext == '.npy':
+            return NpyWriter(out)
+        elif ext in ('.h5', '.hdf5', '.hdf'):
+            return H5Writer(out)
+        raise ValueError(f'Unable to infer output format from "{out}". '
+                         'Expected ".npy" or ".h5" file extension.')
+
+    raise TypeError(f'`out` must be None, a filepath or a ScoreWriter, got "{type(out)}"')
+
+
+def read_scores(filepath, dataset='scores', mmap=True):
+    """Read scores written by [`navis.nbl.writers.NpyWriter`][] or `H5Writer`.
+
+    Parameters
+    ----------
+    filepath :  str
+                Path to `.npy` or HDF5 file.
+    dataset :   str
+                For HDF5 files only: name of the dataset.
+    mmap :      bool
+                For `.npy` files only: if True, will memory-map the data
+                (read-only) instead of loading it into memory.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    filepath = Path(filepath).expanduser()
+
+    if filepath.suffix.lower() == '.npy':
+        scores = np.load(filepath, mmap_mode='r' if mmap else None)
+        with np.load(_ids_path(filepath)) as ids:
+            query_ids, target_ids = ids['query'], ids['target']
+    else:
+        import h5py
+        with h5py.File(filepath, 'r') as f:
+            scores = f[dataset][:]
+            query_ids = f[f'{dataset}_query'][:]
+            target_ids = f[f'{dataset}_target'][:]
+        if query_ids.dtype.kind == 'O':
+            query_ids = query_ids.astype(str)
+        if target_ids.dtype.kind == 'O':
+            target_ids = target_ids.astype(str)
+
+    # Forward and reverse scores (i.e. `scores="both"`)
+    if scores.ndim == 3:
+        from .base import scores_to_frame
+        return scores_to_frame(np.asarray(scores), query_ids, target_ids)
+
+    scores = pd.DataFrame(scores, index=query_ids, columns=target_ids, copy=False)
+    scores.index.name = 'query'
+    scores.columns.name = 'target'
+    return scores
+
+
+def collect_scores(writer, fwd, rev, scores, overlap=None):
+    """Combine forward and reverse scores and pass them to the writer.
+
+    Parameters
+    ----------
+    writer :    ScoreWriter
+    fwd :       (N, M) array
+                Forward scores. Can be memory-mapped.
+    rev :       (N, M) array
+                Reverse scores, transposed to match the shape of `fwd`. Can
+                be memory-mapped. Missing scores for neurons present in both
+                queries and targets are filled in from `fwd` (see `overlap`).
+    scores :    "mean" | "min" | "max" | "both"
+    overlap :   tuple of arrays, optional
+                Indices `(q_ix, t_ix)` of neurons present in both queries
+                and targets (see `navis.nbl.nblast_funcs.find_overlap`).
+
+    """
+    from .base import combine_scores
+
+    itemsize = np.dtype(fwd.dtype).itemsize
+
+    # Fill in reverse scores for pairs present in both queries and targets:
+    # target->query for target t_ix[i] and query q_ix[k] is the same as
+    # query->target for query q_ix[i] and target t_ix[k]
+    if overlap is not None and len(overlap[0]):
+        q_ix, t_ix = overlap
+        step = max(1, BLOCK_SIZE_BYTES // max(1, len(q_ix) * itemsize))
+        for i in range(0, len(q_ix), step):
+            b = slice(i, i + step)
+            rev[np.ix_(q_ix[b], t_ix)] = fwd[np.ix_(q_ix, t_ix[b])].T
+
+    for rows in writer.row_blocks(fwd.shape[1], itemsize=itemsize * 2):
+        r = _as_slice(rows)
+        writer.write(combine_scores(np.asarray(fwd[r]), np.asarray(rev[r]),
+                                    scores=scores),
+                     rows, np.arange(fwd.shape[1]))
+
+
+def _as_slice(ix):
+    """Turn contiguous, increasing indices into a slice."""
+    ix = np.asarray(ix)
+    if len(ix) and np.all(np.diff(ix) == 1):
+        return slice(int(ix[0]), int(ix[-1]) + 1)
+    return ix
+
+
+def _ids_path(filepath):
+    """Path to file containing IDs for given `.npy` file."""
+    filepath = Path(filepath)
+    return filepath.with_name(filepath.name + '.ids.npz')
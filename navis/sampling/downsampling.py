@@ -151,8 +151,8 @@ def _downsample_dotprops(x, downsampling_factor):
     if not isinstance(x._alpha, type(None)):
         x._alpha = x._alpha[mask]
 
-    # Finally mask points
-    x._points = x._points[mask]
+    # Finally mask points (use the setter so that the KD-tree gets reset)
+    x.points = x._points[mask]
 
 
 def _downsample_treeneuron(x, downsampling_factor, preserve_nodes):
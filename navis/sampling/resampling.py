@@ -444,6 +444,7 @@ def resample_along_axis(x: 'core.TreeNeuron',
         to_snap = x.nodes.loc[not_lined_up, ['x', 'y', 'z'][axis]].values
         snapped = (to_snap / interval).round() * interval
         x.nodes.loc[not_lined_up, ['x', 'y', 'z'][axis]] = snapped
+        x.mark_modified()
         to_remove = []
 
     if np.any(to_remove):
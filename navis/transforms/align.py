@@ -390,6 +390,7 @@ def _set_coords(n, new_co):
             n.vertices = new_co
         elif isinstance(n, core.TreeNeuron):
             n.nodes[['x', 'y', 'z']] = new_co
+            n.mark_modified()
         elif isinstance(n, core.Dotprops):
             n.points = new_co
         else:
@@ -407,6 +408,7 @@ def _set_coords(n, new_co):
                 n.points[:, i] = new_co
         else:
             raise TypeError(f'Unable to extract coordinates from {type(n)}')
+        n.mark_modified()
 
 
 def _reg_subsample(Registration, sample):
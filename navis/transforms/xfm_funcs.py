@@ -129,7 +129,7 @@ def xform(x: Union['core.NeuronObject', 'pd.DataFrame', 'np.ndarray'],
                     # Make sure we clear the coordinate map cache when done
                     _get_coordinates_map.cache_clear()
 
-            return x.__class__(xf)
+            return x._constructor(xf)
 
     if isinstance(x, core.BaseNeuron):
         # VoxelNeurons are a special case and have hence their own function
@@ -185,6 +185,7 @@ def xform(x: Union['core.NeuronObject', 'pd.DataFrame', 'np.ndarray'],
             # Fix radius based on our best estimate
             if 'radius' in xf.nodes.columns:
                 xf.nodes['radius'] *= 10**magnitude
+            xf.mark_modified()
         elif isinstance(xf, core.Dotprops):
             xf.points = xyz_xf[:xf.points.shape[0]]
 
@@ -22,7 +22,7 @@ from .eval import (eval_node_ids, eval_neurons, eval_id, eval_conditions,
 from .exceptions import (ConstructionError, VolumeError, CMTKError)
 from .cv import (patch_cloudvolume)
 from .decorators import (meshneuron_skeleton, map_neuronlist_df, map_neuronlist,
-                         lock_neuron)
+                         map_neuronlist_batched, lock_neuron)
 
 try:
     import navis_fastcore as fastcore
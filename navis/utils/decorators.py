@@ -29,7 +29,7 @@ import pandas as pd
 from functools import wraps
 from textwrap import dedent, indent
 
-from typing import Optional, Union, List, Iterable, Dict, Tuple, Any
+from typing import Optional, Union, List, Iterable, Dict, Tuple, Any, Callable
 from typing_extensions import Literal
 
 from .iterables import is_iterable, make_iterable
@@ -148,9 +148,10 @@ def map_neuronlist(desc: str = "",
                         raise ValueError(f'Got {len(values)} values of `{p}` for '
                                          f'{len(nl)} neurons.')
 
-                # If we use parallel processing it makes sense to modify neurons
+                # If we use multiprocessing it makes sense to modify neurons
                 # "inplace" since they will be copied into the child processes
-                # anyway and that way we can avoid making an additional copy
+                # anyway and that way we can avoid making an additional copy.
+                # Threads on the other hand would modify the original neurons
                 if 'inplace' in kwargs:
                     # First check keyword arguments
                     inplace = kwargs['inplace']
@@ -161,12 +162,13 @@ def map_neuronlist(desc: str = "",
                     # All things failing assume it's not inplace
                     inplace = False
 
-                if parallel and 'inplace' in sig.parameters:
+                backend = core.pool.resolve_backend(parallel)
+                if backend == 'processes' and 'inplace' in sig.parameters:
                     kwargs['inplace'] = True
 
                 # Prepare processor
                 n_cores = kwargs.pop('n_cores', os.cpu_count() // 2)
-                chunksize = kwargs.pop('chunksize', 1)
+                chunksize = kwargs.pop('chunksize', 'auto')
                 excl = list(kwargs.keys()) + list(range(1, len(args) + 1))
                 proc = core.NeuronProcessor(nl, function,
                                             parallel=parallel,
@@ -201,6 +203,63 @@ def map_neuronlist(desc: str = "",
     return decorator
 
 
+def map_neuronlist_batched(batched: Callable,
+                           when: Optional[Callable] = None):
+    """Decorate function to process NeuronLists in one batch.
+
+    Must be placed on top of `map_neuronlist`. If the function is called with
+    a NeuronList, `batched=True` (if the function has such a parameter) and
+    without `parallel=True`, the whole NeuronList is passed to the batched
+    implementation instead of calling the function for each neuron.
+
+    Parameters
+    ----------
+    batched :       callable
+                    Batched implementation. Will be called with the NeuronList
+                    as first argument plus all of the decorated function's
+                    arguments (after applying defaults) and the `progress`
+                    and `omit_failures` parameters of `map_neuronlist` that
+                    it accepts as keyword arguments.
+    when :          callable, optional
+                    Additional condition. Is passed the decorated function's
+                    arguments as dictionary and must return True if the
+                    batched implementation can be used.
+
+    """
+    accepts = inspect.signature(batched).parameters
+
+    def decorator(function):
+        sig = inspect.signature(function)
+        nl_key = list(sig.parameters.keys())[0]
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            from .. import core
+            # These are consumed by `map_neuronlist`
+            extra = {k: kwargs.pop(k) for k in ('parallel', 'n_cores', 'chunksize',
+                                                'progress', 'omit_failures')
+                     if k in kwargs}
+            params = sig.bind(*args, **kwargs)
+            params.apply_defaults()
+            p = params.arguments
+
+            if (isinstance(p[nl_key], core.NeuronList)
+                    and p.get('batched', True)
+                    and not extra.get('parallel', False)
+                    and (when is None or when(p))):
+                opts = {'progress': extra.get('progress', True),
+                        'omit_failures': extra.get('omit_failures', False),
+                        **p}
+                opts = {k: v for k, v in opts.items() if k in accepts and k != nl_key}
+                return batched(p[nl_key], **opts)
+
+            return function(*args, **kwargs, **extra)
+
+        return wrapper
+
+    return decorator
+
+
 def map_neuronlist_df(desc: str = "",
                       id_col: str = "neuron",
                       reset_index: bool = True,
@@ -276,7 +335,7 @@ def map_neuronlist_df(desc: str = "",
 
                 # Prepare processor
                 n_cores = kwargs.pop('n_cores', os.cpu_count() // 2)
-                chunksize = kwargs.pop('chunksize', 1)
+                chunksize = kwargs.pop('chunksize', 'auto')
                 excl = list(kwargs.keys()) + list(range(1, len(args) + 1))
                 proc = core.NeuronProcessor(nl, function,
                                             parallel=parallel,
@@ -332,9 +391,12 @@ def map_neuronlist_update_docstring(func, allow_parallel):
     msg = ''
     if allow_parallel:
         msg += dedent(f"""\
-        parallel :{" " * (offset - 10)}bool
+        parallel :{" " * (offset - 10)}bool | "processes" | "threads"
                   {" " * (offset - 10)}If True and input is NeuronList, use parallel
-                  {" " * (offset - 10)}processing. Requires `pathos`.
+                  {" " * (offset - 10)}processing. Requires `pathos`. True uses the
+                  {" " * (offset - 10)}default backend (`navis.config.parallel_backend`).
+                  {" " * (offset - 10)}Use "threads" only for functions that
+                  {" " * (offset - 10)}release the GIL.
         n_cores : {" " * (offset - 10)}int, optional
                   {" " * (offset - 10)}Numbers of cores to use if `parallel=True`.
                   {" " * (offset - 10)}Defaults to half the available cores.
@@ -0,0 +1,67 @@
+"""Benchmark NBLAST in single vs double precision.
+
+Usage:
+
+    python scripts/benchmark_nblast.py [N_NEURONS] [N_CORES]
+
+Builds dotprops from the example neurons (jittered copies to get the requested
+number of neurons), runs an all-by-all NBLAST with `compute_precision=64` and
+`compute_precision=32` and reports run time, dotprops memory and how much the
+scores differ.
+"""
+
+import sys
+import time
+
+import numpy as np
+
+import navis
+
+from navis.nbl.nblast_funcs import align_dtypes
+
+FLOAT = {32: np.float32, 64: np.float64}
+
+
+def make_dotprops(n_neurons, seed=0):
+    """Generate `n_neurons` double precision dotprops (in microns)."""
+    rng = np.random.default_rng(seed)
+    nl = navis.example_neurons(n=5, kind='skeleton')
+    nl = nl * (8 / 1000)
+    dps = []
+    for i in range(n_neurons):
+        n = nl[i % len(nl)].copy()
+        n.nodes[['x', 'y', 'z']] += rng.normal(scale=1, size=(n.n_nodes, 3))
+        n.id = i
+        dps.append(navis.make_dotprops(n, k=5, resample=1))
+    dps, = align_dtypes(navis.NeuronList(dps), dtype=np.float64)
+    return dps
+
+
+def memory(dps):
+    """Bytes used by points, tangent vectors and alpha."""
+    return sum(dp.points.nbytes + dp.vect.nbytes + dp.alpha.nbytes for dp in dps)
+
+
+def main(n_neurons=50, n_cores=1):
+    dps = make_dotprops(n_neurons)
+    print(f'{len(dps)} dotprops with {sum(dps.n_points):,} points, '
+          f'{n_cores} core(s)\n')
+
+    results = {}
+    for prec in (64, 32):
+        start = time.time()
+        scores = navis.nblast_allbyall(dps, compute_precision=prec,
+                                       n_cores=n_cores, progress=False)
+        elapsed = time.time() - start
+        mem = memory(align_dtypes(dps, dtype=FLOAT[prec], inplace=False)[0])
+        results[prec] = scores.values
+        print(f'float{prec}: {elapsed:.2f}s, dotprops: {mem / 1e6:.1f} MB')
+
+    diff = np.abs(results[64] - results[32])
+    print(f'\nAbsolute difference in scores: mean {diff.mean():.2e}, '
+          f'max {diff.max():.2e}')
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*args)
@@ -136,3 +136,30 @@ def test_neuron_connector_real(
         n = edata["weight"]
 
         assert exp[pre_skid][post_skid] == n
+
+
+@pytest.mark.parametrize("metric", ["matching_index", "matching_index_synapses",
+                                    "matching_index_weighted_synapses",
+                                    "vertex", "vertex_normalized", "cosine"])
+def test_connectivity_similarity_sparse(metric):
+    import scipy.sparse as sp
+
+    rng = np.random.default_rng(0)
+    adj = rng.poisson(0.3, (30, 20)) * rng.integers(1, 20, (30, 20))
+    adj[5] = 0  # disconnected neuron
+    adj = pd.DataFrame(adj, index=[f"n{i}" for i in range(30)])
+
+    pw = navis.connectivity_similarity(adj, metric, threshold=2, n_cores=1,
+                                       engine="pairwise")
+    sparse = navis.connectivity_similarity(adj, metric, threshold=2,
+                                           engine="sparse")
+    assert sparse.index.equals(pw.index) and sparse.columns.equals(pw.columns)
+    assert np.allclose(sparse.values, pw.values, equal_nan=True)
+    assert sparse.loc["n5"].isnull().all()
+
+    blocks = list(navis.connectivity_similarity_blocks(sp.csr_matrix(adj.values),
+                                                       metric, threshold=2,
+                                                       block_size=7,
+                                                       progress=False))
+    assert len(blocks) == 5
+    assert np.allclose(np.vstack(blocks), pw.values, equal_nan=True)
@@ -150,3 +150,34 @@ def test_strahler_index(method, to_ignore, min_twig_size):
         navis.utils.fastcore = fastcore
 
     assert np.allclose(si_with, si_without)
+
+
+def test_persistence_batched():
+    nl = navis.example_neurons(3, kind="skeleton")
+
+    # Make sure that the fastcore package is installed (otherwise this test is useless)
+    if navis.utils.fastcore is None:
+        return
+
+    # Batched (all neurons as one forest) vs one neuron at a time
+    p_with = navis.persistence_points(nl)
+    p_without = navis.persistence_points(nl, batched=False)
+
+    for a, b in zip(p_with, p_without):
+        assert a.equals(b)
+
+    # Vectors should match scipy's weighted Gaussian KDE
+    from scipy.stats import gaussian_kde
+
+    vec, samples = navis.persistence_vectors(p_without, bw=0.2)
+    for v, p in zip(vec, p_without):
+        kde = gaussian_kde(p.birth.values, weights=p.death.values - p.birth.values,
+                           bw_method=0.2)
+        assert np.allclose(v, kde(samples))
+
+    # Nearest neighbours must match the full distance matrix
+    dist = navis.persistence_distances(nl)
+    nn = navis.persistence_distances(nl, n_neighbors=2)
+    exp = navis.nbl.extract_matches(dist, N=2)
+    assert (nn.match_1.values == nl.id).all()
+    assert np.allclose(nn.score_2, exp.score_2)
@@ -2,8 +2,10 @@ import navis
 import pytest
 import tempfile
 import numpy as np
+import pandas as pd
 
 from pathlib import Path
+from scipy.spatial import cKDTree
 
 
 @pytest.mark.parametrize("filename", ['', '{neuron.id}.swc',
@@ -52,6 +54,145 @@ def test_precomputed_skeleton_io(filename):
         assert len(n) == len(n2)
 
 
+@pytest.mark.parametrize("fmt", ['parquet', 'h5'])
+def test_dotprops_kdtree_io(fmt, monkeypatch):
+    with tempfile.TemporaryDirectory() as tempdir:
+        filepath = Path(tempdir) / f'dotprops.{fmt}'
+
+        # Make dotprops (in microns)
+        n = navis.example_neurons(2, kind='skeleton')
+        dp = navis.make_dotprops(n, k=5, resample=1000) / 125
+
+        # Save to file with KD-trees and self-hits
+        write = getattr(navis, f'write_{fmt}')
+        write(dp, filepath, kdtree=True, self_hits=[{}, {'use_alpha': True}])
+
+        # Load again
+        dp2 = getattr(navis, f'read_{fmt}')(filepath).idx[dp.id]
+
+        for a, b in zip(dp, dp2):
+            assert isinstance(b.__dict__.get('_tree'), cKDTree)
+            assert len(b._self_hits) == 2
+            d1, ix1 = a.kdtree.query(a.points[:100])
+            d2, ix2 = b.kdtree.query(a.points[:100])
+            assert np.allclose(d1, d2)
+
+        # Scores must not change
+        sc1 = navis.nblast(dp, dp, n_cores=1, progress=False)
+        sc2 = navis.nblast(dp2, dp2, n_cores=1, progress=False)
+        assert np.allclose(sc1.values, sc2.values)
+
+        # Trees must be restored as written unless the file was tampered with
+        built = []
+        class Tree(cKDTree):
+            def __init__(self, *args, **kwargs):
+                built.append(self)
+                super().__init__(*args, **kwargs)
+        monkeypatch.setattr(navis.core.dotprop, 'cKDTree', Tree)
+        dp3 = getattr(navis, f'read_{fmt}')(filepath).idx[dp.id]
+        assert all(isinstance(b.__dict__.get('_tree'), Tree) for b in dp3)
+        assert not built
+
+        if fmt == 'h5':
+            import h5py
+            with h5py.File(filepath, 'r+') as f:
+                for id in dp.id:
+                    f[f'{id}/dotprops/.kdtree_buffer'][...] = 0xFF
+            dp3 = navis.read_h5(filepath).idx[dp.id]
+            assert len(built) == len(dp)
+            for a, b in zip(dp, dp3):
+                d, ix = b.kdtree.query(a.points[:100])
+                assert np.all(d == 0)
+
+        # Trees written in another format must be rebuilt
+        monkeypatch.setattr(navis.core.dotprop, 'KDTREE_FORMAT', 'other')
+        dp3 = getattr(navis, f'read_{fmt}')(filepath).idx[dp.id]
+        for a, b in zip(dp, dp3):
+            assert isinstance(b.__dict__.get('_tree'), cKDTree)
+            assert np.allclose(a.kdtree.query(a.points[:100])[0],
+                               b.kdtree.query(a.points[:100])[0])
+
+
+@pytest.mark.parametrize("fmt", ['swc', 'h5'])
+def test_compact_skeleton_io(fmt):
+    with tempfile.TemporaryDirectory() as tempdir:
+        n = navis.example_neurons(2, kind='skeleton')
+        if fmt == 'swc':
+            navis.write_swc(n, tempdir)
+            kwargs = dict(f=tempdir, parallel=False)
+        else:
+            kwargs = dict(filepath=Path(tempdir) / 'neurons.h5', prefer_raw=True)
+            navis.write_h5(n, kwargs['filepath'], raw=True)
+
+        read = getattr(navis, f'read_{fmt}')
+        nl = read(**kwargs).idx[n.id]
+        cmp = read(compact=True, **kwargs).idx[n.id]
+
+        for a, b in zip(nl, cmp):
+            # Summary properties must not generate the node table
+            assert a.n_nodes == b.n_nodes
+            assert a.n_branches == b.n_branches
+            assert a.cable_length == b.cable_length
+            assert np.array_equal(a.root, b.root)
+            assert np.array_equal(a.soma, b.soma)
+            assert a.core_md5 == b.core_md5
+            assert '_node_arrays' in b.__dict__
+
+            pd.testing.assert_frame_equal(a.nodes[b.nodes.columns], b.nodes)
+            assert '_node_arrays' not in b.__dict__
+            assert not b.is_stale
+
+        # Data types follow `precision`
+        if fmt == 'swc':
+            cmp = read(compact=True, precision=64, **kwargs)
+            assert cmp[0].nodes.x.dtype == np.float64
+            assert cmp[0].nodes.node_id.dtype == np.int64
+
+
+def test_compact_skeleton_no_radius():
+    nodes = navis.example_neurons(1, kind='skeleton').nodes.drop(columns=['radius', 'type'])
+    arrays = navis.core.NodeArrays.from_dataframe(nodes)
+    n = navis.TreeNeuron(arrays)
+    assert 'radius' not in n.nodes.columns
+    assert np.allclose((n / 2).nodes.x, nodes.x / 2)
+
+
+@pytest.mark.parametrize("fmt", ['h5', 'parquet'])
+def test_lazy_neuronlist(fmt):
+    with tempfile.TemporaryDirectory() as tempdir:
+        n = navis.example_neurons(5, kind='skeleton')
+        filepath = Path(tempdir) / f'neurons.{fmt}'
+        getattr(navis, f'write_{fmt}')(n, filepath)
+
+        lazy = getattr(navis, f'read_{fmt}')(filepath, lazy=2)
+        assert isinstance(lazy, navis.core.LazyNeuronList)
+        assert len(lazy) == len(n)
+        assert lazy.n_loaded == 0
+
+        # Summary and subsets must not load any neurons
+        assert len(lazy.summary()) == len(n)
+        sub = lazy.idx[n.id[:3]]
+        assert isinstance(sub, navis.core.LazyNeuronList)
+        assert len(sub) == 3
+        assert lazy.n_loaded == 0
+
+        # Accessing neurons loads them (and shares the cache with subsets)
+        assert sub[0].id == n[0].id
+        assert lazy.n_loaded == 1
+        assert [x.n_nodes for x in lazy] == [n.idx[i].n_nodes for i in lazy.id]
+        assert lazy.n_loaded == 2
+
+        # Anything derived from the neurons is a regular NeuronList
+        assert type(lazy * 2) is navis.NeuronList
+        assert np.array_equal(lazy.load().idx[n.id].n_nodes, n.n_nodes)
+
+        # IDs and order must match the loaded neurons and a normal read
+        nl = getattr(navis, f'read_{fmt}')(filepath)
+        assert all(lazy.id == lazy.load().id)
+        assert all(lazy.id == nl.id)
+        assert all(lazy.summary()['id'] == nl.id)
+
+
 @pytest.mark.parametrize("filename", ['',
                                       'neurons.zip',
                                       '{neuron.id}@neurons.zip'])
@@ -0,0 +1,383 @@
+import numpy as np
+import pytest
+
+import navis
+from navis.nbl import AlignmentCache, ScoreCache, extract_matches
+from navis.nbl import NBlastServer, NBlastClient
+from navis.nbl.checkpoint import Checkpoint
+from navis.nbl import scheduler
+from navis.nbl.nblast_funcs import NBlaster, align_dtypes
+from navis.nbl.search import DotpropsIndex
+from navis.nbl.synblast_funcs import SynBlaster
+from navis.nbl.writers import (ThresholdWriter, TopNWriter, parse_writer,
+                               read_scores)
+
+
+@pytest.fixture(scope="module")
+def dotprops():
+    nl = navis.example_neurons(5, kind="skeleton") / 125
+    return navis.make_dotprops(nl, k=5).downsample(10)
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean", "min", "max", "both"])
+@pytest.mark.parametrize("kwargs", [{}, {"use_alpha": True},
+                                    {"limit_dist": "auto"},
+                                    {"normalized": False}])
+def test_batched_kernel(dotprops, scores, kwargs):
+    res = []
+    for batched in (False, True):
+        nb = NBlaster(batched=batched, progress=False, **kwargs)
+        nb.append(dotprops)
+        res.append(nb.multi_query_target(range(3), range(1, 5), scores=scores))
+
+    assert np.allclose(res[0].values, res[1].values)
+    assert all(res[0].index == res[1].index)
+    assert all(res[0].columns == res[1].columns)
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean", "min", "max", "both"])
+def test_nblast_overlap(dotprops, scores):
+    """Overlapping queries and targets must give the same scores as a per-pair NBLAST."""
+    nb = NBlaster(batched=False, progress=False)
+    nb.append(dotprops)
+    expected = nb.multi_query_target(range(0, 4), range(2, 5), scores=scores)
+
+    res = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                       n_cores=1, progress=False)
+
+    assert res.shape == expected.shape
+    assert np.allclose(res.values, expected.values)
+    assert all(res.index == expected.index)
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean", "both"])
+@pytest.mark.parametrize("ext", [".npy", ".h5"])
+def test_nblast_out_file(dotprops, scores, ext, tmp_path):
+    expected = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                            n_cores=1, progress=False)
+
+    res = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                       n_cores=1, progress=False, out=tmp_path / f"scores{ext}")
+    if ext == ".h5":
+        res = read_scores(res)
+
+    assert np.allclose(res.values, expected.values)
+    assert all(res.index == expected.index)
+    assert all(res.columns.astype(str) == expected.columns.astype(str))
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean"])
+def test_nblast_out_sparse(dotprops, scores):
+    expected = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                            n_cores=1, progress=False)
+
+    top = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                       n_cores=1, progress=False, out=TopNWriter(2))
+    assert np.allclose(top.filter(like='score').values,
+                       extract_matches(expected, N=2).filter(like='score').values)
+
+    thr = navis.nblast(dotprops[:4], dotprops[2:], scores=scores,
+                       n_cores=1, progress=False, out=ThresholdWriter(0.1))
+    assert thr.equals(extract_matches(expected, threshold=0.1))
+
+
+@pytest.mark.parametrize("ext", [None, ".npy", ".h5"])
+def test_writer_fancy_index(ext, tmp_path):
+    writer = parse_writer(tmp_path / f"scores{ext}" if ext else None)
+    writer.open(np.arange(4), np.arange(4), np.float32)
+    writer.write(np.zeros((4, 4), dtype=np.float32), np.arange(4), np.arange(4))
+    # Non-contiguous rows and columns address a block
+    writer.write(np.array([[1, 2], [3, 4]], dtype=np.float32), [0, 2], [1, 3])
+    res = writer.close()
+    if ext == ".h5":
+        res = read_scores(res)
+
+    expected = np.zeros((4, 4))
+    expected[np.ix_([0, 2], [1, 3])] = [[1, 2], [3, 4]]
+    assert np.array_equal(res.values, expected)
+
+
+def test_nblast_allbyall_out(dotprops, tmp_path):
+    expected = navis.nblast_allbyall(dotprops, n_cores=1, progress=False)
+    res = navis.nblast_allbyall(dotprops, n_cores=1, progress=False,
+                                out=tmp_path / "scores.npy")
+    assert np.allclose(res.values, expected.values)
+
+
+def test_nblast_checkpoint(dotprops, tmp_path, monkeypatch):
+    expected = navis.nblast(dotprops[:4], dotprops[2:], scores="mean",
+                            n_cores=1, progress=False)
+    res = navis.nblast(dotprops[:4], dotprops[2:], scores="mean",
+                       n_cores=1, progress=False, checkpoint=tmp_path)
+    assert np.allclose(res.values, expected.values)
+    assert Checkpoint(tmp_path).n_tiles > 0
+
+    # Re-running must use the checkpoint instead of computing anything
+    def fail(*args, **kwargs):
+        raise AssertionError("Tile was re-computed")
+    monkeypatch.setattr(NBlaster, "multi_query_target", fail)
+    res = navis.nblast(dotprops[:4], dotprops[2:], scores="mean",
+                       n_cores=1, progress=False, checkpoint=tmp_path)
+    assert np.allclose(res.values, expected.values)
+
+    # Different parameters must not use the same tiles
+    with pytest.raises(AssertionError, match="re-computed"):
+        navis.nblast(dotprops[:4], dotprops[2:], scores="mean", use_alpha=True,
+                     n_cores=1, progress=False, checkpoint=tmp_path)
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean"])
+def test_nblast_cache(dotprops, scores, tmp_path, monkeypatch):
+    dps = dotprops.copy()
+    cache = ScoreCache(tmp_path / "cache.db")
+    res = navis.nblast(dps[:4], dps[2:], scores=scores, n_cores=1,
+                       progress=False, cache=cache)
+    expected = navis.nblast(dps[:4], dps[2:], scores=scores, n_cores=1,
+                            progress=False)
+    assert np.allclose(res.values, expected.values)
+
+    # After changing a neuron, only pairs involving it should be re-computed
+    dps[3].downsample(2, inplace=True)
+    expected = navis.nblast(dps[:4], dps[2:], scores=scores, n_cores=1,
+                            progress=False)
+
+    computed = []
+    multi_query_target = NBlaster.multi_query_target
+    def track(self, q_idx, t_idx, **kwargs):
+        computed.append((len(q_idx), len(t_idx)))
+        return multi_query_target(self, q_idx, t_idx, **kwargs)
+    monkeypatch.setattr(NBlaster, "multi_query_target", track)
+
+    res = navis.nblast(dps[:4], dps[2:], scores=scores, n_cores=1,
+                       progress=False, cache=cache)
+    assert np.allclose(res.values, expected.values)
+    # Forward: changed target vs all 4 queries + changed query vs other 2 targets
+    assert sum(q * t for q, t in computed) == (6 if scores == "forward" else 12)
+
+
+def test_nblast_smart_cache_checkpoint(dotprops, tmp_path):
+    cache = ScoreCache(tmp_path / "cache.db")
+    kwargs = dict(t=2, n_cores=1, progress=False)
+    res = navis.nblast_smart(dotprops, dotprops, cache=cache,
+                             checkpoint=tmp_path / "ckpt1", **kwargs)
+
+    # Second run (with a fresh checkpoint) must get the full scores from the
+    # cache, i.e. the full NBLAST tile has no pairs to compute
+    res2 = navis.nblast_smart(dotprops, dotprops, cache=cache,
+                              checkpoint=tmp_path / "ckpt2", **kwargs)
+    assert np.allclose(res.values, res2.values)
+    sizes = [np.load(f).size for f in (tmp_path / "ckpt2").glob("*.npy")]
+    assert len(sizes) == 2 and min(sizes) == 0
+
+
+def test_nblast_search(dotprops):
+    expected = extract_matches(navis.nblast(dotprops, dotprops, n_cores=1,
+                                            progress=False), N=2)
+    # With all targets as candidates, we must get the exact top matches
+    res = navis.nblast_search(dotprops, dotprops, N=2, candidates=len(dotprops),
+                              n_cores=1, progress=False)
+    assert np.allclose(res.filter(like='score').values,
+                       expected.filter(like='score').values)
+
+    index = DotpropsIndex(dotprops)
+    _, cand = index.query(dotprops, k=1)
+    # Each neuron should be its own best candidate
+    assert all(cand[:, 0] == np.arange(len(dotprops)))
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean"])
+@pytest.mark.parametrize("batched", [True, False])
+def test_nblast_prune_bbox(dotprops, scores, batched):
+    # Add translated copies so that some pairs are out of reach
+    far = []
+    for n in dotprops[:3]:
+        n = n.copy()
+        n.points = n.points + np.array([1000, 0, 0])
+        n.id = f"{n.id}_far"
+        far.append(n)
+    dps = navis.NeuronList(list(dotprops[:3]) + far)
+
+    nb = NBlaster(limit_dist=10, batched=batched, progress=False)
+    nb.append(dps)
+    expected = nb.multi_query_target(range(6), range(6), scores=scores)
+
+    nb = NBlaster(limit_dist=10, batched=batched, prune_bbox=True, progress=False)
+    nb.append(dps)
+    assert nb.within_reach(range(6), range(6)).sum() < 36
+    res = nb.multi_query_target(range(6), range(6), scores=scores)
+    assert np.allclose(res.values, expected.values)
+
+
+def test_tile_scheduler():
+    n_points = np.array([10, 5000, 200, 30, 1000, 7, 80])
+    row_cost, col_cost = scheduler.point_cost(n_points)
+    region = scheduler.Tile("forward", np.arange(7), np.arange(7), row_cost, col_cost)
+    tiles = scheduler.make_tiles([region], n_tiles=4, min_cost=1)
+    assert len(tiles) >= 4
+
+    # Splitting tiles for idle workers must still cover each pair exactly once
+    sched = scheduler.TileScheduler(tiles, min_cost=1)
+    costs, covered = [], np.zeros((7, 7), dtype=int)
+    while sched:
+        tile = sched.pop(n_idle=10)
+        costs.append(tile.cost)
+        covered[np.ix_(tile.rows, tile.cols)] += 1
+        sched.record(tile, 0)
+    assert (covered == 1).all()
+    assert len(costs) >= 10
+    assert len(sched.timings) == len(costs)
+
+
+def test_nblast_tiles(dotprops, monkeypatch):
+    expected = navis.nblast(dotprops[:4], dotprops[2:], scores="mean",
+                            n_cores=1, progress=False)
+    # Make tiles small enough to get more than one
+    monkeypatch.setattr(scheduler, "MIN_TILE_COST", 1e4)
+    res = navis.nblast(dotprops[:4], dotprops[2:], scores="mean",
+                       n_cores=2, progress=False)
+    assert np.allclose(res.values, expected.values)
+
+
+def test_self_hit_key(dotprops):
+    key = NBlaster(progress=False).self_hit_key
+
+    # Compiling the digitizers (which caches their layout) must not change
+    # the key
+    nb = NBlaster(progress=False)
+    for ax in nb.score_fn.axes:
+        ax.compile()
+    assert nb.score_fn.axes[0].__dict__.get("_layout", False) is not False
+    assert nb.self_hit_key == key
+    assert NBlaster(use_alpha=True, progress=False).self_hit_key != key
+
+
+def test_nblast_compute_precision(dotprops):
+    dps64, = align_dtypes(dotprops, dtype=np.float64, inplace=False)
+    assert dotprops[0].points.dtype == np.float32  # not in place
+    assert dps64[0].vect.dtype == np.float64
+
+    expected = navis.nblast(dps64[:3], dps64, n_cores=1, progress=False)
+    res = navis.nblast(dps64[:3], dps64, compute_precision=32,
+                       n_cores=1, progress=False)
+    assert dps64[0].points.dtype == np.float64
+    assert np.allclose(res.values, expected.values, atol=1e-3)
+
+
+@pytest.mark.parametrize("by_type", [True, False])
+def test_synblast_batched(by_type):
+    nl = navis.example_neurons(3, kind="skeleton") * (8 / 1000)
+    # Add a translated copy that is out of reach of everything else
+    far = nl[0].copy()
+    for df in (far.nodes, far.connectors):
+        df[["x", "y", "z"]] += np.array([1000, 0, 0])
+    far.id = "far"
+    nl = navis.NeuronList(list(nl) + [far])
+
+    res = []
+    for batched in (False, True):
+        sb = SynBlaster(by_type=by_type, batched=batched, progress=False)
+        sb.append(nl)
+        res.append(sb.multi_query_target(range(4), range(4), scores="mean"))
+
+    assert np.allclose(res[0].values, res[1].values)
+
+
+ALIGN_CALLS = []
+
+
+def _align_centroids(x, target, sample=None, progress=False):
+    """Move neurons so that their centroid matches the target's."""
+    ALIGN_CALLS.append(1)
+    xf = navis.NeuronList(x).copy()
+    for n in xf:
+        n.points = n.points - n.points.mean(axis=0) + target.points.mean(axis=0)
+    return xf, None
+
+
+def test_nblast_align_cache(dotprops, tmp_path):
+    kwargs = dict(align_method=_align_centroids, n_cores=1, progress=False)
+    expected = navis.nblast_align(dotprops[:3], dotprops[1:], **kwargs)
+
+    cache = AlignmentCache(tmp_path / "alignments.db")
+    ALIGN_CALLS.clear()
+    res = navis.nblast_align(dotprops[:3], dotprops[1:], align_cache=cache, **kwargs)
+    assert np.allclose(res.values, expected.values)
+    # Forward + reverse alignments minus those shared by neurons 1 and 2
+    assert len(ALIGN_CALLS) == len(cache) == 3 * 4 * 2 - 4
+
+    # Re-scoring with a different smat must not run any alignments
+    ALIGN_CALLS.clear()
+    cache = AlignmentCache(tmp_path / "alignments.db")
+    res = navis.nblast_align(dotprops[:3], dotprops[1:], align_cache=cache,
+                             smat="v1", **kwargs)
+    assert not ALIGN_CALLS
+    expected = navis.nblast_align(dotprops[:3], dotprops[1:], smat="v1", **kwargs)
+    assert np.allclose(res.values, expected.values)
+
+
+def test_nblast_align_gate(dotprops):
+    from navis.nbl.ablast_funcs import pca_overlap
+
+    # A rotated copy should have the same extents, a shrunken copy should not
+    rot = dotprops[0].copy()
+    rot.points = rot.points[:, [1, 0, 2]] * [-1, 1, 1]
+    small = dotprops[1].copy()
+    small.points = small.points * 0.2
+    small.id = "small"
+    overlap = pca_overlap(dotprops[:2], navis.NeuronList([rot, small]))
+    assert overlap[0, 0] == pytest.approx(1)
+    assert overlap[1, 1] < 0.25
+
+    dps = navis.NeuronList(list(dotprops[:3]) + [small])
+    kwargs = dict(align_method=_align_centroids, n_cores=1, progress=False)
+    expected = navis.nblast_align(dps, dps, **kwargs)
+    ALIGN_CALLS.clear()
+    res = navis.nblast_align(dps, dps, gate="pca", **kwargs)
+    # Alignments between the small neuron and the others should have been
+    # skipped (2 alignments per pair with `two_way_align=True`)
+    assert len(ALIGN_CALLS) == 4 * 4 * 2 - 6 * 2
+    assert np.allclose(res.values[:3, :3], expected.values[:3, :3])
+    assert (res.values[:3, 3] < expected.values[:3, 3]).all()
+
+
+@pytest.mark.parametrize("scores", ["forward", "mean"])
+def test_nblast_server(dotprops, scores):
+    exp = navis.nblast(dotprops, dotprops, scores=scores,
+                       n_cores=1, progress=False)
+
+    with NBlastServer(dotprops, n_cores=1) as server:
+        scr = server.scores(dotprops[:2], scores=scores)
+        assert np.allclose(scr.values, exp.values[:2])
+
+        matches = server.query(dotprops, N=3, scores=scores)
+        assert (matches.match_1.values == dotprops.id).all()
+
+        # Queries over HTTP
+        httpd = server.serve(port=0, block=False)
+        try:
+            client = NBlastClient("http://{}:{}".format(*httpd.server_address))
+            assert client.info()["n_targets"] == len(dotprops)
+            scr = client.scores(dotprops[:2], scores=scores)
+            assert np.allclose(scr.values, exp.values[:2])
+            assert client.query(dotprops[0], N=2).match_1[0] == dotprops[0].id
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+def test_nblast_server_error(dotprops, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("out of cheese")
+
+    with NBlastServer(dotprops, n_cores=1) as server:
+        monkeypatch.setattr(server, "query", fail)
+        httpd = server.serve(port=0, block=False)
+        try:
+            client = NBlastClient("http://{}:{}".format(*httpd.server_address))
+            # Unexpected errors must be reported back instead of dropping
+            # the connection
+            with pytest.raises(ValueError, match="out of cheese"):
+                client.query(dotprops[0], N=2)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
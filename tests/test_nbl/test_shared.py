@@ -0,0 +1,40 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import navis
+from navis.nbl.shared import DotpropsStore, share_dotprops
+
+
+@pytest.fixture(scope="module")
+def dotprops():
+    nl = navis.example_neurons(3, kind="skeleton")
+    return navis.make_dotprops(nl, k=5)
+
+
+def test_store_roundtrip(dotprops):
+    with DotpropsStore(dotprops, alpha=True) as store:
+        assert len(store) == len(dotprops)
+        for i, dp in enumerate(dotprops):
+            shared = store[i]
+            # Pickled dotprops must be a reference, not the data
+            pickled = pickle.dumps(shared)
+            assert len(pickled) < dp.points.nbytes
+
+            restored = pickle.loads(pickled)
+            assert restored.id == dp.id
+            assert np.all(restored.points == dp.points)
+            assert np.all(restored.vect == dp.vect)
+            assert np.all(restored.alpha == dp.alpha)
+
+            # Copies must not be shared
+            assert type(restored.copy()) is navis.Dotprops
+
+
+def test_share_dotprops_dedupe(dotprops):
+    with share_dotprops(dotprops, navis.NeuronList(list(dotprops))) as (a, b):
+        assert a is b
+
+    with share_dotprops(dotprops, enabled=False) as (a, ):
+        assert a is dotprops
@@ -1,10 +1,11 @@
+import navis
 from navis import Dotprops
 import pytest
 
 import numpy as np
 
 from navis.nbl.smat import (
-    Digitizer, LookupNd, Lookup2d, LookupDistDotBuilder
+    Digitizer, LookupNd, Lookup2d, LookupDistDotBuilder, QuantileSketch
 )
 
 
@@ -91,6 +92,35 @@ def test_lookup2d_roundtrip():
         assert b1 == b2
 
 
+@pytest.mark.parametrize("right", [False, True])
+@pytest.mark.parametrize(
+    ["digitizer", "layout"],
+    [
+        (lambda r: Digitizer.from_linear(0, 1, 10, right=r), "linear"),
+        (lambda r: Digitizer.from_geom(0.1, 50, 12, right=r), "geometric"),
+        (lambda r: Digitizer([0, 0.75, 1.5, 2, 5, 12, 40], right=r), "table"),
+        (lambda r: Digitizer([0, 1e-9, 1e9], right=r), None),
+    ],
+    ids=["linear", "geometric", "table", "search"],
+)
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_digitizer_compiled(digitizer, layout, right, dtype):
+    dig = digitizer(right)
+    compiled = dig.compile()
+    assert (compiled[0] if compiled else None) == layout
+
+    # Random values plus values on and right next to the boundaries
+    rng = np.random.default_rng(SEED)
+    b = dig.boundaries[1:-1]
+    values = np.concatenate([rng.uniform(b[0] - 5, b[-1] * 1.5, 10_000),
+                             b, np.nextafter(b, -np.inf), np.nextafter(b, np.inf)])
+    values = values.astype(dtype)
+
+    bounds = dig.boundaries32 if dtype == np.float32 else dig.boundaries
+    expected = np.searchsorted(bounds, values, side="left" if right else "right") - 1
+    assert np.array_equal(dig(values), expected)
+
+
 def prepare_lookupdistdotbuilder(neurons, alpha=False, k=5):
     k = 5
     dotprops = [Dotprops(n.nodes[["x", "y", "z"]], k) for n in neurons]
@@ -140,3 +170,41 @@ def prepare_lookupdistdotbuilder(neurons, alpha=False, k=5):
 #     lookup = builder.build(threads)
 #     # `pytest -rP` to see output
 #     print(lookup.to_dataframe())
+
+
+def test_quantile_sketch():
+    rng = np.random.default_rng(SEED)
+    data = rng.normal(size=10_000)
+    # Sketch from two halves merged should be the same as from all data
+    sk1, sk2, sk = QuantileSketch(500), QuantileSketch(500), QuantileSketch(500)
+    keys = rng.random(len(data))
+    sk1.add(data[:5000], keys[:5000])
+    sk2.add(data[5000:], keys[5000:])
+    sk.add(data, keys)
+    merged = sk1.merge(sk2)
+    assert len(merged) == len(data)
+    assert np.array_equal(np.sort(merged.sample), np.sort(sk.sample))
+    assert merged.min == data.min() and merged.max == data.max()
+    assert len(merged.sample) == 500
+    assert abs(np.median(merged.sample) - np.median(data)) < 0.2
+
+
+@pytest.mark.parametrize("threads", [None, 2])
+def test_lookupdistdotbuilder_streaming(threads):
+    nl = navis.example_neurons(3, kind="skeleton") / 125
+    dps = list(navis.make_dotprops(nl, k=5).downsample(10))
+    rng = np.random.default_rng(SEED)
+    for dp in dps[:3]:
+        dps.append(Dotprops(dp.points + rng.normal(0, 1, dp.points.shape), k=5))
+    matching = [[0, 3], [1, 4], [2, 5]]
+
+    builder = LookupDistDotBuilder(dps, matching, seed=SEED).with_bin_counts([5, 5])
+    expected = builder.build()
+
+    # All data fit into the sketch -> exactly the same quantiles
+    builder = LookupDistDotBuilder(dps, matching, seed=SEED).with_bin_counts([5, 5])
+    lookup = builder.build(threads=threads, streaming=True)
+
+    for a, b in zip(lookup.axes, expected.axes):
+        assert a == b
+    assert np.allclose(lookup.cells, expected.cells)
@@ -1,6 +1,7 @@
 from copy import deepcopy
 
 import navis
+import numpy as np
 
 import pytest
 
@@ -27,3 +28,100 @@ def test_from_swc_multi(swc_source_multi, parallel):
 def test_from_gml():
     n = navis.example_neurons(n=1, source='gml')
     assert isinstance(n, navis.TreeNeuron)
+
+
+@pytest.mark.parametrize("n_threads", [None, 2])
+def test_make_dotprops_batched(n_threads, monkeypatch):
+    nl = navis.example_neurons(n=3, kind="skeleton")
+    # Force multiple batches
+    monkeypatch.setattr(navis.core.core_utils, "DOTPROPS_BATCH_POINTS", 5000)
+    single = navis.make_dotprops(nl, k=5, batched=False, progress=False)
+    batched = navis.make_dotprops(nl, k=5, n_threads=n_threads, progress=False)
+
+    for a, b in zip(single, batched):
+        assert a.id == b.id and a.k == b.k
+        assert np.allclose(a.points, b.points)
+        # Tangent vectors may point in opposite directions
+        assert np.allclose(np.abs((a.vect * b.vect).sum(axis=1)), 1, atol=1e-4)
+        assert np.allclose(a.alpha, b.alpha, atol=1e-4)
+
+
+def test_track_mutations(monkeypatch):
+    monkeypatch.setattr(navis.config, "track_mutations", True)
+    n = navis.example_neurons(n=1, kind="skeleton")
+    cl = n.cable_length
+    md5 = n.core_md5
+
+    # Accessing temporary properties does not hash core data
+    with monkeypatch.context() as m:
+        m.setattr(type(n), "core_md5", property(lambda x: 1 / 0))
+        assert not n.is_stale
+        assert n.cable_length == cl
+
+    # Replacing core data is picked up automatically
+    nodes = n.nodes.copy()
+    nodes.loc[nodes.type == "branch", "parent_id"] = -1
+    n.nodes = nodes
+    assert n.is_stale
+    assert n.cable_length < cl
+    assert n.core_md5 != md5
+
+    # In-place changes need to be flagged
+    n = navis.example_neurons(n=1, kind="skeleton")
+    _ = n.cable_length
+    n.nodes.loc[n.nodes.type == "branch", "parent_id"] = -1
+    assert not n.is_stale
+    n.mark_modified()
+    assert n.cable_length < cl
+
+    # navis' own in-place edits are flagged
+    n = navis.example_neurons(n=1, kind="skeleton")
+    leaf = n.leafs.node_id.values[0]
+    _ = n.graph, n.segments
+    navis.reroot_skeleton(n, leaf, inplace=True)
+    assert n.root[0] == leaf
+    assert [x for x, d in n.graph.out_degree() if d == 0] == [leaf]
+    assert n.segments[0][-1] == leaf
+
+    # Same for the other neuron types
+    for x in (navis.make_dotprops(n, k=5), navis.example_neurons(n=1, kind="mesh")):
+        md5 = x.core_md5
+        x *= 2
+        assert x.core_md5 != md5
+
+
+@pytest.mark.parametrize("kind", ["skeleton", "dotprops"])
+def test_packed_neuronlist(kind):
+    nl = navis.example_neurons(n=3, kind="skeleton")
+    if kind == "dotprops":
+        nl = navis.make_dotprops(nl, k=5)
+
+    p = nl.pack()
+    assert len(p) == len(nl)
+    assert np.allclose(p.bbox, nl.bbox)
+    if kind == "skeleton":
+        assert all(p.n_nodes == nl.n_nodes)
+        assert np.allclose(p.cable_length, nl.cable_length)
+        assert all(p.nodes.type.values == nl.nodes.type.values)
+    else:
+        assert all(p.n_points == nl.n_points)
+
+    # Round trip
+    for a, b in zip(nl, p.unpack()):
+        assert a.id == b.id and a.name == b.name
+        assert a.core_md5 == b.core_md5
+        assert not b.is_stale
+
+    # Unit conversion
+    conv = p.convert_units("um").unpack()
+    ref = nl.convert_units("um")
+    assert all(a.units == b.units for a, b in zip(ref, conv))
+    assert np.allclose(ref.bbox, conv.bbox)
+    if kind == "skeleton":
+        assert np.allclose(ref.cable_length, conv.cable_length)
+
+    # Views do not track units -> no in-place unit conversion afterwards
+    _ = p.unpack(copy=False)
+    with pytest.raises(ValueError):
+        p.convert_units("um", inplace=True)
+    assert p.copy().convert_units("um", inplace=True) is None
@@ -62,3 +62,30 @@ def test_apply():
     assert isinstance(pr, navis.NeuronList)
     assert len(pr) == len(nl)
     assert all(pr.n_nodes == nl.n_nodes)
+
+
+def test_parallel_pools():
+    from navis.core import pool
+
+    nl = navis.example_neurons(kind='skeleton')
+
+    # Threads must not modify the original neurons
+    pr = navis.prune_by_strahler(nl, 1, parallel='threads', inplace=False)
+    assert all(pr.n_nodes < nl.n_nodes)
+
+    # Persistent pools are re-used across calls
+    navis.prune_by_strahler(nl, 1, parallel=True, n_cores=1, inplace=False)
+    p = pool.get_pool(1, 'processes')
+    pr = navis.prune_by_strahler(nl, 1, parallel=True, n_cores=1, inplace=False)
+    assert pool.get_pool(1, 'processes') is p
+    assert all(pr.n_nodes < nl.n_nodes)
+
+    pool.shutdown_pools()
+    assert not p.alive
+
+    # Chunks should be contiguous and of about equal cost
+    costs = [1, 1, 1, 1, 4, 4]
+    chunks = pool.make_chunks(costs, n_workers=1, min_cost=4)
+    assert np.array_equal(np.concatenate(chunks), np.arange(len(costs)))
+    assert [sum(np.take(costs, c)) for c in chunks] == [4, 4, 4]
+    assert [len(c) for c in pool.make_chunks(costs, 1, chunksize=4)] == [4, 2]